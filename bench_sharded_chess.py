@@ -0,0 +1,99 @@
+import argparse
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from typing import List
+import httpx
+
+# Measures how the move throughput of the sharded deployment scales with the
+# number of shard workers.  Every run starts sharded_chess.py in a fresh
+# directory, creates games between two users through the router and plays the
+# same moves on all of them, many requests in flight at once.  The router is a
+# single process, so the figures show where it becomes the bottleneck.
+#
+#     python bench_sharded_chess.py --shards 1 2 4 --games 400
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+# the last move draws by threefold repetition
+MOVES = ['g1f3', 'g8f6', 'f3g1', 'f6g8'] * 2
+
+
+async def wait_until_up(client: httpx.AsyncClient, deadline: float):
+    while True:
+        try:
+            await client.get('/')
+            return
+        except httpx.TransportError:
+            if time.monotonic() > deadline:
+                raise RuntimeError("the router did not start")
+            await asyncio.sleep(0.1)
+
+
+async def play_games(port: int, num_games: int, concurrency: int) -> float:
+    """
+    Plays MOVES on num_games new games through the router.
+
+    :return: moves played per second
+    """
+    async with httpx.AsyncClient(base_url=f'http://127.0.0.1:{port}', timeout=60) as client:
+        await wait_until_up(client, time.monotonic() + 60)
+        tokens = []
+        for username in ('white', 'black'):
+            password = (await client.post('/user/create', params={'username': username})).json()['password']
+            tokens.append((await client.post('/user/login', auth=(username, password))).json()['token'])
+        response = await client.post('/game/create_games', headers={'Authorization': f'Bearer {tokens[0]}'},
+                                     json={'games': [['white', 'black']] * num_games})
+        response.raise_for_status()
+        game_ids = [game['game_id'] for game in response.json()['games']]
+
+        limit = asyncio.Semaphore(concurrency)
+
+        async def move(game_id: str, player_idx: int, player_move: str):
+            async with limit:
+                response = await client.post(f'/game/{game_id}/player/{player_idx}/{player_move}',
+                                             headers={'Authorization': f'Bearer {tokens[player_idx]}'})
+                response.raise_for_status()
+
+        start = time.perf_counter()
+        for ply, player_move in enumerate(MOVES):
+            await asyncio.gather(*[move(game_id, ply % 2, player_move) for game_id in game_ids])
+        return len(game_ids) * len(MOVES) / (time.perf_counter() - start)
+
+
+def run(num_shards: int, port: int, num_games: int, concurrency: int) -> float:
+    """
+    Starts a deployment with num_shards workers, measures it and stops it.
+
+    :return: moves played per second
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        env = dict(os.environ, CHESS_SOCKET_DIR=tmp_dir, PYTHONPATH=REPO_DIR)
+        server = subprocess.Popen([sys.executable, os.path.join(REPO_DIR, 'sharded_chess.py'),
+                                   '--shards', str(num_shards), '--port', str(port)],
+                                  cwd=tmp_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            return asyncio.run(play_games(port, num_games, concurrency))
+        finally:
+            server.send_signal(signal.SIGTERM)
+            server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the router of the sharded Chess server.")
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4], help='shard counts to measure')
+    parser.add_argument('--games', type=int, default=400, help='games played at once')
+    parser.add_argument('--concurrency', type=int, default=64, help='requests in flight')
+    parser.add_argument('--port', type=int, default=8100, help='port the router listens on')
+    args = parser.parse_args()
+    results: List[float] = []
+    for num_shards in args.shards:
+        results.append(run(num_shards, args.port, args.games, args.concurrency))
+        print(f"{num_shards} shard(s): {results[-1]:8.0f} moves/s ({results[-1] / results[0]:.2f}x)")
+
+
+if __name__ == '__main__':
+    main()
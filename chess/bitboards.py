@@ -0,0 +1,278 @@
+from typing import List, Sequence
+import numpy as np
+
+# Struct-of-arrays board store: N boards are held as 12 uint64 bitboards each
+# (one per piece type and color) so move generation runs over the whole batch
+# with NumPy operations.  Bit x * 8 + y is Board.squares[x][y], so bit 0 is a8
+# and bit 63 is h1.  The move rules are those of the engine in chess.py, which
+# test_chess checks move for move: single step pawn pushes, no castling, en
+# passant or promotion, and capturing the king ends the game instead of check
+# detection.
+PIECE_NAMES = ["K ", "Q ", "R ", "B ", "N ", "P "]
+KING, QUEEN, ROOK, BISHOP, KNIGHT, PAWN = range(6)
+WHITE = 6  # plane offset of the white pieces, black pieces use planes 0-5
+
+EMPTY = np.uint64(0)
+FILE_MASKS = [np.uint64(0x0101010101010101 << y) for y in range(8)]
+SQUARE_BITS = [np.uint64(1 << sq) for sq in range(64)]
+
+KING_STEPS = [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]
+KNIGHT_STEPS = [(-2, -1), (-2, 1), (-1, -2), (-1, 2), (1, -2), (1, 2), (2, -1), (2, 1)]
+ROOK_STEPS = [(-1, 0), (1, 0), (0, -1), (0, 1)]
+BISHOP_STEPS = [(-1, -1), (-1, 1), (1, -1), (1, 1)]
+
+
+def shift(bitboards: np.ndarray, dx: int, dy: int) -> np.ndarray:
+    """
+    Moves every set bit dx rows and dy columns, dropping bits that leave the board
+
+    :param bitboards: array of uint64 bitboards
+    :param dx: rows to move, positive towards row 7 (rank 1)
+    :param dy: columns to move, positive towards column 7 (file h)
+    :return: shifted array of uint64 bitboards
+    """
+    amount = dx * 8 + dy
+    if amount > 0:
+        shifted = bitboards << np.uint64(amount)
+    else:
+        shifted = bitboards >> np.uint64(-amount)
+    # clear the columns that wrapped around to the other side of the board
+    for y in range(dy):
+        shifted = shifted & ~FILE_MASKS[y]
+    for y in range(8 + dy, 8):
+        shifted = shifted & ~FILE_MASKS[y]
+    return shifted
+
+
+def popcount(bitboards: np.ndarray) -> np.ndarray:
+    """
+    Counts the set bits of each bitboard
+
+    :param bitboards: array of uint64 bitboards
+    :return: int64 array of bit counts with the same shape
+    """
+    flat = np.ascontiguousarray(bitboards, dtype=np.uint64).reshape(-1)
+    counts = np.unpackbits(flat.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1, dtype=np.int64)
+    return counts.reshape(np.shape(bitboards))
+
+
+def slide(sources: np.ndarray, empty: np.ndarray, steps: Sequence) -> np.ndarray:
+    """
+    Computes the squares attacked by sliding pieces, stopping at the first piece hit
+
+    :param sources: uint64 bitboards of the sliding pieces
+    :param empty: uint64 bitboards of the empty squares
+    :param steps: (dx, dy) directions the pieces slide in
+    :return: uint64 attack bitboards
+    """
+    attacks = np.zeros_like(sources)
+    for dx, dy in steps:
+        ray = sources
+        for _ in range(7):
+            ray = shift(ray, dx, dy)
+            attacks |= ray
+            ray = ray & empty
+    return attacks
+
+
+def step(sources: np.ndarray, steps: Sequence) -> np.ndarray:
+    """
+    Computes the squares attacked by pieces that jump a fixed offset
+
+    :param sources: uint64 bitboards of the pieces
+    :param steps: (dx, dy) offsets the pieces can reach
+    :return: uint64 attack bitboards
+    """
+    attacks = np.zeros_like(sources)
+    for dx, dy in steps:
+        attacks |= shift(sources, dx, dy)
+    return attacks
+
+
+class BoardBatch(object):
+    """
+    N boards stored as bitboard arrays
+
+    pieces has shape (12, N): planes 0-5 are the black K, Q, R, B, N, P and
+    planes 6-11 the white ones.  white_to_move has shape (N,).
+    """
+    pieces: np.ndarray
+    white_to_move: np.ndarray
+
+    def __init__(self, pieces: np.ndarray, white_to_move: np.ndarray):
+        """
+        Initializes the batch from existing arrays
+
+        :param pieces: (12, N) uint64 array of piece bitboards
+        :param white_to_move: (N,) bool array, True where white is to move
+        """
+        self.pieces = np.asarray(pieces, dtype=np.uint64)
+        self.white_to_move = np.asarray(white_to_move, dtype=bool)
+
+    @classmethod
+    def from_boards(cls, boards: Sequence, white_to_move: Sequence[bool]) -> 'BoardBatch':
+        """
+        Encodes Board objects into a batch
+
+        :param boards: Board objects from chess.py
+        :param white_to_move: side to move of each board
+        :return: BoardBatch holding the boards
+        """
+        pieces = np.zeros((12, len(boards)), dtype=np.uint64)
+        for idx, board in enumerate(boards):
+            for i in range(8):
+                for j in range(8):
+                    piece = board.squares[i][j].get_piece()
+                    if piece is not None:
+                        plane = PIECE_NAMES.index(piece.piece_name) + (WHITE if piece.is_white else 0)
+                        pieces[plane, idx] |= SQUARE_BITS[i * 8 + j]
+        return cls(pieces, white_to_move)
+
+    @classmethod
+    def starting_position(cls, count: int) -> 'BoardBatch':
+        """
+        Creates a batch of boards in the starting position with white to move
+
+        :param count: number of boards
+        :return: BoardBatch of starting positions
+        """
+        start = [0] * 12
+        for color, back_row, pawn_row in [(0, 0, 1), (WHITE, 7, 6)]:
+            for y, plane in enumerate([ROOK, KNIGHT, BISHOP, QUEEN, KING, BISHOP, KNIGHT, ROOK]):
+                start[plane + color] |= 1 << (back_row * 8 + y)
+            start[PAWN + color] |= 0xFF << (pawn_row * 8)
+        pieces = np.repeat(np.array(start, dtype=np.uint64)[:, None], count, axis=1)
+        return cls(pieces, np.ones(count, dtype=bool))
+
+    def __len__(self) -> int:
+        return self.pieces.shape[1]
+
+    def side_pieces(self, white: np.ndarray) -> np.ndarray:
+        """
+        Selects the six piece planes of one side on every board
+
+        :param white: (N,) bool array, True to select the white planes of a board
+        :return: (6, N) uint64 array
+        """
+        return np.where(white, self.pieces[WHITE:], self.pieces[:WHITE])
+
+    def occupancy(self) -> np.ndarray:
+        """
+        :return: (N,) uint64 bitboards of all occupied squares
+        """
+        return np.bitwise_or.reduce(self.pieces, axis=0)
+
+    def attacks(self, white: np.ndarray) -> np.ndarray:
+        """
+        Computes every square attacked by one side on every board
+
+        :param white: (N,) bool array, True to compute the attacks of white
+        :return: (N,) uint64 attack bitboards
+        """
+        side = self.side_pieces(white)
+        empty = ~self.occupancy()
+        attacks = step(side[KING], KING_STEPS) | step(side[KNIGHT], KNIGHT_STEPS)
+        attacks |= slide(side[ROOK] | side[QUEEN], empty, ROOK_STEPS)
+        attacks |= slide(side[BISHOP] | side[QUEEN], empty, BISHOP_STEPS)
+        white_pawns = np.where(white, side[PAWN], EMPTY)
+        black_pawns = np.where(white, EMPTY, side[PAWN])
+        attacks |= step(white_pawns, [(-1, -1), (-1, 1)]) | step(black_pawns, [(1, -1), (1, 1)])
+        return attacks
+
+    def move_targets(self) -> np.ndarray:
+        """
+        Generates the moves of the side to move on every board
+
+        :return: (64, N) uint64 array, entry [sq, n] is the bitboard of squares
+            the piece on square sq of board n can move to
+        """
+        own = self.side_pieces(self.white_to_move)
+        enemy = self.side_pieces(~self.white_to_move)
+        own_all = np.bitwise_or.reduce(own, axis=0)
+        enemy_all = np.bitwise_or.reduce(enemy, axis=0)
+        empty = ~(own_all | enemy_all)
+        # boards where a king has been captured are finished games
+        in_play = (own[KING] != EMPTY) & (enemy[KING] != EMPTY)
+        not_own = np.where(in_play, ~own_all, EMPTY)
+        forward = np.where(self.white_to_move, -1, 1)
+
+        targets = np.zeros((64, len(self)), dtype=np.uint64)
+        for sq in range(64):
+            bit = SQUARE_BITS[sq]
+            if not np.any(own_all & bit):
+                continue
+            on_sq = [np.where(own[plane] & bit != EMPTY, bit, EMPTY) for plane in range(6)]
+            moves = step(on_sq[KING], KING_STEPS) | step(on_sq[KNIGHT], KNIGHT_STEPS)
+            moves |= slide(on_sq[ROOK] | on_sq[QUEEN], empty, ROOK_STEPS)
+            moves |= slide(on_sq[BISHOP] | on_sq[QUEEN], empty, BISHOP_STEPS)
+            pawn_push = np.where(forward < 0, shift(on_sq[PAWN], -1, 0), shift(on_sq[PAWN], 1, 0)) & empty
+            pawn_take = np.where(forward < 0, step(on_sq[PAWN], [(-1, -1), (-1, 1)]),
+                                 step(on_sq[PAWN], [(1, -1), (1, 1)])) & enemy_all
+            targets[sq] = (moves | pawn_push | pawn_take) & not_own
+        return targets
+
+    def count_moves(self) -> np.ndarray:
+        """
+        :return: (N,) int64 array with the number of moves on every board
+        """
+        return popcount(self.move_targets()).sum(axis=0)
+
+    def moves(self, idx: int, targets: np.ndarray = None) -> List[List[int]]:
+        """
+        Lists the moves of one board in the batch
+
+        :param idx: index of the board in the batch
+        :param targets: result of move_targets if already computed, so that listing
+            the moves of every board generates the moves of the batch only once
+        :return: List of [start_x, start_y, end_x, end_y] moves
+        """
+        if targets is None:
+            targets = self.move_targets()
+        targets = targets[:, idx]
+        moves = []
+        for start in range(64):
+            target = int(targets[start])
+            while target:
+                end = (target & -target).bit_length() - 1
+                moves.append([start // 8, start % 8, end // 8, end % 8])
+                target &= target - 1
+        return moves
+
+    def expand(self, targets: np.ndarray = None) -> 'BoardBatch':
+        """
+        Plays every move of every board
+
+        :param targets: result of move_targets if already computed
+        :return: BoardBatch with one board per move, ordered by parent board
+        """
+        if targets is None:
+            targets = self.move_targets()
+        # (64, N, 64) flags, [start, board, end] set for every move
+        flags = np.unpackbits(targets.view(np.uint8).reshape(64, len(self), 8), axis=2, bitorder='little')
+        starts, parents, ends = np.nonzero(flags)
+        order = np.argsort(parents, kind='stable')
+        starts, parents, ends = starts[order], parents[order], ends[order]
+        start_bits = np.left_shift(np.uint64(1), starts.astype(np.uint64))
+        end_bits = np.left_shift(np.uint64(1), ends.astype(np.uint64))
+
+        parent_pieces = self.pieces[:, parents]
+        moving = (parent_pieces & start_bits) != EMPTY
+        pieces = parent_pieces & ~start_bits & ~end_bits
+        pieces |= np.where(moving, end_bits, EMPTY)
+        return BoardBatch(pieces, ~self.white_to_move[parents])
+
+    def perft(self, depth: int) -> np.ndarray:
+        """
+        Counts the move sequences of the given length from every board
+
+        :param depth: number of halfmoves
+        :return: (N,) int64 array of leaf counts per board
+        """
+        if depth == 0:
+            return np.ones(len(self), dtype=np.int64)
+        if depth == 1:
+            return self.count_moves()
+        targets = self.move_targets()
+        parents = np.repeat(np.arange(len(self)), popcount(targets).sum(axis=0))
+        leaves = self.expand(targets).perft(depth - 1)
+        return np.bincount(parents, weights=leaves, minlength=len(self)).astype(np.int64)
@@ -1,6 +1,39 @@
-from typing import List
+from typing import List, Dict, Optional, Tuple
+from collections import OrderedDict
+from array import array
 import math
+import random
+import struct
+import time
 from dataclasses import dataclass
+import numpy as np
+
+# Zobrist keys used to hash a board position: one random 64-bit key per
+# (piece type, color, square).  Seeded so hashes are stable between runs.
+PIECE_INDEX = {"K ": 0, "Q ": 1, "R ": 2, "B ": 3, "N ": 4, "P ": 5}
+_zobrist_rng = random.Random(0x5EED)
+ZOBRIST_TABLE = [[_zobrist_rng.getrandbits(64) for _ in range(64)] for _ in range(12)]
+ZOBRIST_BLACK_TO_MOVE = _zobrist_rng.getrandbits(64)
+
+# Repetitions can only happen since the last pawn move or capture, and the
+# fifty-move rule ends the game after 100 such halfmoves, so a ring of 128
+# position hashes always covers the window that has to be scanned.
+HISTORY_RING_SIZE = 128
+FIFTY_MOVE_HALFMOVES = 100
+
+# Played moves are packed into 16 bits: from square (bits 0-5), to square
+# (bits 6-11), promotion piece (bits 12-14, 0 for none) and capture flag (bit 15).
+MOVE_TO_SHIFT = 6
+MOVE_PROMOTION_SHIFT = 12
+MOVE_CAPTURE_FLAG = 1 << 15
+
+# Header of ChessGame.encode: current turn, halfmove clock, winner flags and the
+# lengths of the move history, clock history, captured pieces and hash ring.
+GAME_STATE_HEADER = struct.Struct('<HHBHHBB')
+# encode flag set when a ChessClock state follows the game state
+GAME_STATE_HAS_CLOCK = 4
+# encode flag of a game that ended in a draw
+GAME_STATE_DRAWN = 8
 
 
 @dataclass
@@ -196,6 +229,55 @@ class Board(object):
         """
         self.squares = [[Square(i, j) for j in range(8)] for i in range(8)]
         self.reset_board()
+        self.rehash()
+        # set by the ChessGame that owns the board and keeps position_hash up to date on every move
+        self.incremental_hash = False
+
+    @staticmethod
+    def zobrist_key(piece: Piece, x: int, y: int) -> int:
+        """
+        Gets the Zobrist key for a piece standing on a Square
+
+        :param piece: (Piece) the Piece on the Square
+        :param x: Row
+        :param y: Column
+        :return: 64-bit key, XOR it into position_hash to add or remove the piece
+        """
+        color = 6 if piece.is_white else 0
+        return ZOBRIST_TABLE[PIECE_INDEX[piece.piece_name] + color][x * 8 + y]
+
+    def compute_hash(self) -> int:
+        """
+        Computes the Zobrist hash of the position from scratch
+
+        :return: 64-bit hash of the pieces on the board
+        """
+        position_hash = 0
+        for i in range(8):
+            for j in range(8):
+                if self.squares[i][j].is_occupied():
+                    position_hash ^= self.zobrist_key(self.squares[i][j].piece, i, j)
+        return position_hash
+
+    def rehash(self):
+        """
+        Recomputes position_hash and the occupied and white_occupied bitboards
+        (bit x * 8 + y set for Square [x][y]). Must be called after editing the
+        squares of a ChessGame's board directly, moves made through ChessGame keep
+        them up to date incrementally.  Other boards are rehashed on every cache lookup.
+
+        :return: None
+        """
+        self.position_hash = self.compute_hash()
+        self.occupied = 0
+        self.white_occupied = 0
+        for i in range(8):
+            for j in range(8):
+                piece = self.squares[i][j].piece
+                if piece is not None:
+                    self.occupied |= 1 << (i * 8 + j)
+                    if piece.is_white:
+                        self.white_occupied |= 1 << (i * 8 + j)
 
     def print_board(self):
         """
@@ -289,6 +371,149 @@ class Board(object):
                     self.display_board[i][j] = '. '
 
 
+class LegalMoveCache(object):
+    """
+    Bounded LRU cache from a position hash to the legal moves and move validation
+    results for that position. Shared by every game so common positions
+    (openings especially) are only validated once.
+    """
+
+    def __init__(self, maxsize: int = 4096):
+        """
+        Initializes an empty cache
+
+        :param maxsize: maximum number of positions kept before the least recently used is evicted
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()
+
+    def _entry(self, position_hash: int) -> Dict:
+        """
+        Gets the entry for a position, creating it and evicting the oldest entry if needed
+
+        :param position_hash: Zobrist hash of the position
+        :return: dict holding the 'results' and 'moves' of the position
+        """
+        entry = self._entries.get(position_hash)
+        if entry is None:
+            entry = {'results': {}, 'moves': {}}
+            self._entries[position_hash] = entry
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        else:
+            self._entries.move_to_end(position_hash)
+        return entry
+
+    def get_result(self, position_hash: int, move: Tuple) -> Optional[bool]:
+        """
+        Looks up a cached validation result
+
+        :param position_hash: Zobrist hash of the position
+        :param move: (Tuple: int) start_x, start_y, end_x, end_y
+        :return: cached result or None on a miss
+        """
+        entry = self._entries.get(position_hash)
+        if entry is not None and move in entry['results']:
+            self._entries.move_to_end(position_hash)
+            self.hits += 1
+            return entry['results'][move]
+        self.misses += 1
+        return None
+
+    def set_result(self, position_hash: int, move: Tuple, result: bool):
+        """
+        Stores a validation result
+
+        :return: None
+        """
+        self._entry(position_hash)['results'][move] = result
+
+    def get_moves(self, position_hash: int, is_white: bool) -> Optional[List[Tuple]]:
+        """
+        Looks up the cached legal move list of one side
+
+        :param position_hash: Zobrist hash of the position
+        :param is_white: side to generate moves for
+        :return: cached list of moves or None on a miss
+        """
+        entry = self._entries.get(position_hash)
+        if entry is not None and is_white in entry['moves']:
+            self._entries.move_to_end(position_hash)
+            self.hits += 1
+            return entry['moves'][is_white]
+        self.misses += 1
+        return None
+
+    def set_moves(self, position_hash: int, is_white: bool, moves: List[Tuple]):
+        """
+        Stores the legal move list of one side
+
+        :return: None
+        """
+        self._entry(position_hash)['moves'][is_white] = moves
+
+    def clear(self):
+        """
+        Empties the cache and resets the counters
+
+        :return: None
+        """
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Gets the cache counters
+
+        :return: dict of size, maxsize, hits and misses
+        """
+        return {'size': len(self._entries), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses}
+
+
+LEGAL_MOVE_CACHE = LegalMoveCache()
+
+
+def _between_table() -> np.ndarray:
+    """
+    :return: (64, 64) uint64 array, [start, end] is the bitboard of the squares strictly
+        between two squares on one row, column or diagonal, 0 for squares not in line
+    """
+    table = np.zeros((64, 64), dtype=np.uint64)
+    for start in range(64):
+        for end in range(64):
+            dx = end // 8 - start // 8
+            dy = end % 8 - start % 8
+            if (dx or dy) and (dx == 0 or dy == 0 or abs(dx) == abs(dy)):
+                step_x = (dx > 0) - (dx < 0)
+                step_y = (dy > 0) - (dy < 0)
+                bits = 0
+                for k in range(1, max(abs(dx), abs(dy))):
+                    bits |= 1 << ((start // 8 + k * step_x) * 8 + start % 8 + k * step_y)
+                table[start, end] = bits
+    return table
+
+
+BETWEEN = _between_table()
+
+# Vectorized form of the valid_move rule of each piece type, indexed like PIECE_INDEX.
+# Each takes arrays of the row and column distances (end - start), whether the
+# squares between are empty, whether the end square is occupied (by the other side,
+# own pieces are rejected before) and whether the moving piece is white.
+PIECE_RULES = [
+    lambda dx, dy, clear, capture, white: (np.abs(dx) <= 1) & (np.abs(dy) <= 1),
+    lambda dx, dy, clear, capture, white: ((dx == 0) | (dy == 0) | (np.abs(dx) == np.abs(dy))) & clear,
+    lambda dx, dy, clear, capture, white: ((dx == 0) | (dy == 0)) & clear,
+    lambda dx, dy, clear, capture, white: (np.abs(dx) == np.abs(dy)) & clear,
+    lambda dx, dy, clear, capture, white: np.abs(dx * dy) == 2,
+    # one step forward onto an empty square, or one step diagonally forward to capture
+    lambda dx, dy, clear, capture, white: (dx == np.where(white, -1, 1)) &
+    (((dy == 0) & ~capture) | ((np.abs(dy) == 1) & capture)),
+]
+
+
 class Move(object):
     """
     Move Object
@@ -315,7 +540,7 @@ class Move(object):
         :param move: (List: str)A list of the characters of the user input string
         :return: True if move is valid, False if invalid
         """
-        if not move:
+        if len(move) != 4:
             return False
         columns = ['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h']
         rows = ['8', '7', '6', '5', '4', '3', '2', '1']
@@ -345,6 +570,20 @@ class Move(object):
         start_end_squares = [start_x, start_y, end_x, end_y]
         return start_end_squares
 
+    @staticmethod
+    def position_hash(board: Board) -> int:
+        """
+        Gets the hash LEGAL_MOVE_CACHE is keyed by.  Only a ChessGame keeps the
+        hash of its board current, any other board may have been edited directly
+        since it was hashed, so its hash is recomputed.
+
+        :param board: (Board) 2d List of Squares
+        :return: Zobrist hash of the position
+        """
+        if not board.incremental_hash:
+            board.rehash()
+        return board.position_hash
+
     def valid_piece_move(self, board: Board, move: List) -> bool:
         """
         Checks to see if the move is valid for the set piece and that their is a piece on the Square
@@ -352,6 +591,23 @@ class Move(object):
         :param move: (List: int) List of the integers to be inputted
         :return: True if the move is valid, False if the mve is invalid
         """
+        key = (move[0], move[1], move[2], move[3])
+        position_hash = self.position_hash(board)
+        cached = LEGAL_MOVE_CACHE.get_result(position_hash, key)
+        if cached is not None:
+            return cached
+        result = self._check_piece_move(board, key)
+        LEGAL_MOVE_CACHE.set_result(position_hash, key, result)
+        return result
+
+    def _check_piece_move(self, board: Board, move: Tuple) -> bool:
+        """
+        Uncached part of valid_piece_move
+
+        :param board: (Board) 2d List of Squares
+        :param move: (Tuple: int) start_x, start_y, end_x, end_y
+        :return: True if the move is valid, False if the mve is invalid
+        """
         if board.squares[move[0]][move[1]].is_occupied() is False:
             return False
         piece = board.squares[move[0]][move[1]].get_piece()
@@ -361,6 +617,123 @@ class Move(object):
             return False
         return True
 
+    def valid_piece_moves(self, requests: List[Tuple[Board, List]]) -> List[bool]:
+        """
+        Batch version of valid_piece_move for many (board, move) pairs, for example
+        the pending moves of many games. Cached results are answered directly and
+        duplicate requests are only checked once.  The rest are grouped by the type
+        of the moving piece and each group is checked at once with NumPy, using the
+        occupancy bitboards of the boards.
+
+        :param requests: List of (Board, [start_x, start_y, end_x, end_y]) pairs
+        :return: List of results in the same order as requests
+        """
+        results: List[Optional[bool]] = [None] * len(requests)
+        pending: Dict[Tuple, List[int]] = {}
+        # one entry per distinct cache miss
+        keys = []
+        kinds = []
+        fields = []
+        for idx, (board, move) in enumerate(requests):
+            key = (move[0], move[1], move[2], move[3])
+            position_hash = self.position_hash(board)
+            cache_key = (position_hash, key)
+            if cache_key in pending:
+                pending[cache_key].append(idx)
+                continue
+            cached = LEGAL_MOVE_CACHE.get_result(position_hash, key)
+            if cached is not None:
+                results[idx] = cached
+                continue
+            pending[cache_key] = [idx]
+            piece = board.squares[key[0]][key[1]].get_piece()
+            kind = PIECE_INDEX.get(piece.piece_name, None) if piece is not None else None
+            if kind is None:
+                # an empty square, or a piece without a vectorized rule
+                results[idx] = piece is not None and piece.valid_move(
+                    board, board.squares[key[0]][key[1]], board.squares[key[2]][key[3]]) is not False
+                LEGAL_MOVE_CACHE.set_result(position_hash, key, results[idx])
+                continue
+            keys.append(cache_key)
+            kinds.append(kind)
+            fields.append((key[0] * 8 + key[1], key[2] * 8 + key[3], board.occupied, board.white_occupied,
+                           piece.is_white))
+        if keys:
+            starts, ends, occupied, white_occupied, white = zip(*fields)
+            checked = self._check_piece_moves(np.array(kinds), np.array(starts), np.array(ends),
+                                              np.array(occupied, dtype=np.uint64),
+                                              np.array(white_occupied, dtype=np.uint64), np.array(white, dtype=bool))
+            for cache_key, result in zip(keys, checked.tolist()):
+                results[pending[cache_key][0]] = result
+                LEGAL_MOVE_CACHE.set_result(cache_key[0], cache_key[1], result)
+        for (position_hash, key), indexes in pending.items():
+            for idx in indexes[1:]:
+                results[idx] = results[indexes[0]]
+        return results
+
+    @staticmethod
+    def _check_piece_moves(kinds: np.ndarray, starts: np.ndarray, ends: np.ndarray, occupied: np.ndarray,
+                           white_occupied: np.ndarray, white: np.ndarray) -> np.ndarray:
+        """
+        Uncached part of valid_piece_moves, the rules of every piece type run over all its moves at once
+
+        :param kinds: PIECE_INDEX of the moving piece of each move
+        :param starts: start square of each move, x * 8 + y
+        :param ends: end square of each move
+        :param occupied: uint64 Board.occupied of each move's board
+        :param white_occupied: uint64 Board.white_occupied of each move's board
+        :param white: True where the moving piece is white
+        :return: bool array of the results
+        """
+        end_bits = np.left_shift(np.uint64(1), ends.astype(np.uint64))
+        capture = (occupied & end_bits) != 0
+        # a piece never lands on a piece of its own color, nor stays on its own square
+        allowed = ~capture | (((white_occupied & end_bits) != 0) != white)
+        clear = (BETWEEN[starts, ends] & occupied) == 0
+        dx = ends // 8 - starts // 8
+        dy = ends % 8 - starts % 8
+        results = np.zeros(len(kinds), dtype=bool)
+        for kind in np.unique(kinds):
+            group = np.flatnonzero(kinds == kind)
+            results[group] = allowed[group] & PIECE_RULES[kind](dx[group], dy[group], clear[group], capture[group],
+                                                                white[group])
+        return results
+
+    def legal_moves(self, board: Board, is_white: bool) -> List[List[int]]:
+        """
+        Lists every move the given side can make on the board
+
+        :param board: (Board) 2d List of Squares
+        :param is_white: True for the white pieces, False for black
+        :return: List of [start_x, start_y, end_x, end_y] moves
+        """
+        position_hash = self.position_hash(board)
+        moves = LEGAL_MOVE_CACHE.get_moves(position_hash, is_white)
+        if moves is None:
+            moves = []
+            for i in range(8):
+                for j in range(8):
+                    piece = board.squares[i][j].get_piece()
+                    if piece is None or piece.is_white != is_white:
+                        continue
+                    for k in range(8):
+                        for n in range(8):
+                            if self._check_piece_move(board, (i, j, k, n)):
+                                moves.append((i, j, k, n))
+            LEGAL_MOVE_CACHE.set_moves(position_hash, is_white, moves)
+        return [list(move) for move in moves]
+
+    def format_move(self, move: List[int]) -> str:
+        """
+        Converts a move of square indexes back into simple chess notation
+
+        :param move: (List: int) start_x, start_y, end_x, end_y
+        :return: String such as 'e2e4'
+        """
+        columns = ['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h']
+        rows = ['8', '7', '6', '5', '4', '3', '2', '1']
+        return columns[move[1]] + rows[move[0]] + columns[move[3]] + rows[move[2]]
+
 
 class King(Piece):
     castled: bool = False
@@ -504,7 +877,7 @@ class Knight(Piece):  # Completed
 
     def valid_move(self,board: Board, start_square: Square, end_square: Square):
         """
-        Checks if the movement given is a valid Rook movement
+        Checks if the movement given is a valid Knight movement
 
         :param start_square: (Square)the starting Square object of the piece
         :param end_square: (Square)the ending Square object of the piece
@@ -515,7 +888,8 @@ class Knight(Piece):  # Completed
                 return False
         x_dist = start_square.x - end_square.x
         y_dist = start_square.y - end_square.y
-        if (abs(x_dist) == 2 and abs(y_dist) != 1) or (abs(x_dist) == 1 and abs(y_dist) != 2):
+        # two squares one way and one square the other
+        if sorted((abs(x_dist), abs(y_dist))) != [1, 2]:
             return False
         return True
 
@@ -597,7 +971,8 @@ class Pawn(Piece):
         # Prevents piece from moving more than 1 space at a time
         if abs_dist > 1.5:
             return False
-        if y_dist == 1 and x_dist ==0:
+        # Pawns never move sideways
+        if x_dist == 0:
             return False
         # Prevents White pieces from moving backwards
         elif self.is_white and x_dist < 0:
@@ -640,21 +1015,312 @@ class Pawn(Piece):
         return False
 
 
+class ChessClock(object):
+    """
+    Chess clock with a base time and a Fischer increment, in seconds.  White's
+    clock only starts once white has played the first move.  Times are wall
+    clock (time.time()) timestamps so a clock keeps running across
+    ChessGame.encode and decode.
+    """
+    # base, increment, white remaining, black remaining, running since, running side (2 for stopped), flagged side
+    STATE = struct.Struct('<ddddBdb')
+    base: float
+    increment: float
+    remaining: List[float]
+    running: Optional[int]
+    running_since: float
+    flagged: Optional[int]
+
+    def __init__(self, base: float, increment: float = 0.0):
+        """
+        :param base: seconds each side starts with
+        :param increment: seconds added to a side's clock after each of its moves
+        """
+        self.base = base
+        self.increment = increment
+        self.remaining = [base, base]
+        # side (0 white, 1 black) whose time is running, None while stopped
+        self.running = None
+        self.running_since = 0.0
+        self.flagged = None
+
+    def remaining_time(self, side: int, now: Optional[float] = None) -> float:
+        """
+        :param side: 0 for white, 1 for black
+        :param now: current time.time(), defaults to now
+        :return: seconds left on the clock of the side, negative once its flag fell
+        """
+        if self.running != side:
+            return self.remaining[side]
+        return self.remaining[side] - ((time.time() if now is None else now) - self.running_since)
+
+    def deadline(self) -> Optional[float]:
+        """
+        :return: time.time() at which the running side's flag falls, None while stopped
+        """
+        if self.running is None:
+            return None
+        return self.running_since + self.remaining[self.running]
+
+    def press(self, side: int, now: Optional[float] = None):
+        """
+        Ends the turn of a side after its move: its time is charged, the increment
+        is added and the other side's clock starts.
+
+        :param side: 0 for white, 1 for black
+        :param now: current time.time(), defaults to now
+        :return: None
+        """
+        now = time.time() if now is None else now
+        if self.running == side:
+            self.remaining[side] -= now - self.running_since
+        if self.running is not None or side == 0:
+            self.remaining[side] += self.increment
+        self.running = 1 - side
+        self.running_since = now
+
+    def stop(self, now: Optional[float] = None):
+        """
+        Stops the clock when the game ends.
+
+        :return: None
+        """
+        if self.running is not None:
+            self.remaining[self.running] = self.remaining_time(self.running, now)
+            self.running = None
+
+    def flag_fallen(self, now: Optional[float] = None) -> Optional[int]:
+        """
+        :param now: current time.time(), defaults to now
+        :return: the running side if it ran out of time, otherwise None
+        """
+        if self.running is not None and self.remaining_time(self.running, now) <= 0:
+            return self.running
+        return None
+
+    def pack(self) -> bytes:
+        return self.STATE.pack(self.base, self.increment, self.remaining[0], self.remaining[1],
+                               2 if self.running is None else self.running, self.running_since,
+                               -1 if self.flagged is None else self.flagged)
+
+    @classmethod
+    def unpack(cls, data: bytes, offset: int = 0) -> 'ChessClock':
+        base, increment, white, black, running, running_since, flagged = cls.STATE.unpack_from(data, offset)
+        clock = cls(base, increment)
+        clock.remaining = [white, black]
+        clock.running = None if running == 2 else running
+        clock.running_since = running_since
+        clock.flagged = None if flagged < 0 else flagged
+        return clock
+
+
 class ChessGame(object):
-    board = Board()
+    board: Board
     current_turn: int
-    white_side = Player(True)
-    black_side = Player(False)
-    players = [white_side, black_side]
-    move = Move()
+    white_side: Player
+    black_side: Player
+    players: List[Player]
+    move: Move
     white_won: bool = False
     black_won: bool = False
-    captured_pieces = []
+    drawn: bool = False
+    captured_pieces: List[Piece]
+    halfmove_clock: int
+    clock: Optional[ChessClock]
 
     def __init__(self):
+        self.board = Board()
+        # every move goes through execute_move or takeback, which update the hash
+        self.board.incremental_hash = True
         self.current_turn = 0
+        self.white_side = Player(True)
+        self.black_side = Player(False)
+        self.players = [self.white_side, self.black_side]
+        self.move = Move()
+        self.captured_pieces = []
+        # halfmoves since the last pawn move or capture
+        self.halfmove_clock = 0
+        self._hash_ring = array('Q', [0] * HISTORY_RING_SIZE)
+        self._record_position()
+        self._move_history = array('H')
+        # halfmove clock values from before each pawn move or capture, used by takeback
+        self._clock_history = array('H')
+        # chess clock of timed games, see set_time_control
+        self.clock = None
+
+    @property
+    def move_history(self) -> array:
+        """
+        Gets a copy of the packed move history
+
+        :return: array('H') of 16-bit move codes, see encode_move
+        """
+        return array('H', self._move_history)
+
+    @staticmethod
+    def piece_code(piece: Piece) -> int:
+        """
+        Gets the 4-bit code of a piece used by encode, 0 is reserved for an empty square
+
+        :param piece: (Piece) the piece to encode
+        :return: code from 1 to 12
+        """
+        return PIECE_INDEX[piece.piece_name] + (6 if piece.is_white else 0) + 1
+
+    @staticmethod
+    def piece_from_code(code: int, x: int, y: int) -> Piece:
+        """
+        Creates a piece from its 4-bit code
+
+        :param code: code from 1 to 12, see piece_code
+        :param x: Row of the piece
+        :param y: Column of the piece
+        :return: the new Piece
+        """
+        piece_classes = [King, Queen, Rook, Bishop, Knight, Pawn]
+        return piece_classes[(code - 1) % 6](code > 6, x, y)
+
+    def encode_board(self) -> bytes:
+        """
+        Packs the board into 32 bytes, one 4-bit piece code per square (0 for empty),
+        square x * 8 + y in the low nibble when y is even and the high nibble when odd
+
+        :return: 32 bytes
+        """
+        cells = bytearray(32)
+        for i in range(8):
+            for j in range(8):
+                piece = self.board.squares[i][j].get_piece()
+                if piece is not None:
+                    cells[(i * 8 + j) // 2] |= self.piece_code(piece) << (4 * (j % 2))
+        return bytes(cells)
+
+    def encode(self) -> bytes:
+        """
+        Packs the game state into a compact byte string: the board as 32 bytes of
+        4-bit square codes followed by the histories needed for takebacks and draw detection.
+
+        :return: bytes that decode turns back into an equal game
+        """
+        cells = self.encode_board()
+        captured = bytearray()
+        captured_squares = [self.decode_move(code)[2:] for code in self._move_history if code & MOVE_CAPTURE_FLAG]
+        for piece, (x, y) in zip(self.captured_pieces, captured_squares):
+            captured += bytes((self.piece_code(piece), x * 8 + y))
+        ring_length = min(self.halfmove_clock, HISTORY_RING_SIZE - 1) + 1
+        ring = array('Q', [self._hash_ring[(self.current_turn - back) % HISTORY_RING_SIZE]
+                           for back in range(ring_length - 1, -1, -1)])
+        flags = (1 if self.white_won else 0) | (2 if self.black_won else 0) | \
+            (GAME_STATE_HAS_CLOCK if self.clock is not None else 0) | (GAME_STATE_DRAWN if self.drawn else 0)
+        header = GAME_STATE_HEADER.pack(self.current_turn, self.halfmove_clock, flags, len(self._move_history),
+                                        len(self._clock_history), len(self.captured_pieces), ring_length)
+        return header + cells + bytes(captured) + self._move_history.tobytes() + \
+            self._clock_history.tobytes() + ring.tobytes() + (self.clock.pack() if self.clock is not None else b'')
+
+    @classmethod
+    def decode(cls, data: bytes) -> 'ChessGame':
+        """
+        Rebuilds a game from the output of encode without replaying its moves
+
+        :param data: bytes produced by encode
+        :return: the restored ChessGame
+        """
+        game = cls()
+        current_turn, halfmove_clock, flags, n_moves, n_clocks, n_captured, ring_length = \
+            GAME_STATE_HEADER.unpack_from(data)
+        offset = GAME_STATE_HEADER.size
+        for i in range(8):
+            for j in range(8):
+                code = (data[offset + (i * 8 + j) // 2] >> (4 * (j % 2))) & 0xF
+                game.board.squares[i][j].set_piece(cls.piece_from_code(code, i, j) if code else None)
+        game.board.rehash()
+        offset += 32
+        for n in range(n_captured):
+            piece = cls.piece_from_code(data[offset], data[offset + 1] // 8, data[offset + 1] % 8)
+            piece.set_captured()
+            game.captured_pieces.append(piece)
+            offset += 2
+        game._move_history.frombytes(data[offset:offset + 2 * n_moves])
+        offset += 2 * n_moves
+        game._clock_history.frombytes(data[offset:offset + 2 * n_clocks])
+        offset += 2 * n_clocks
+        ring = array('Q')
+        ring.frombytes(data[offset:offset + 8 * ring_length])
+        for back in range(ring_length):
+            game._hash_ring[(current_turn - back) % HISTORY_RING_SIZE] = ring[ring_length - 1 - back]
+        offset += 8 * ring_length
+        if flags & GAME_STATE_HAS_CLOCK:
+            game.clock = ChessClock.unpack(data, offset)
+        game.current_turn = current_turn
+        game.halfmove_clock = halfmove_clock
+        game.white_won = bool(flags & 1)
+        game.black_won = bool(flags & 2)
+        game.drawn = bool(flags & GAME_STATE_DRAWN)
+        return game
+
+    def encode_moves(self) -> bytes:
+        """
+        Packs the moves played so far as 16-bit codes, see encode_move
+
+        :return: two bytes per move, oldest first
+        """
+        return self._move_history.tobytes()
+
+    def last_move_code(self) -> int:
+        """
+        Gets the packed code of the last move played
+
+        :return: 16-bit move code, see encode_move
+        """
+        return self._move_history[-1]
+
+    @staticmethod
+    def encode_move(move: List[int], capture: bool = False, promotion: int = 0) -> int:
+        """
+        Packs a move into 16 bits
+
+        :param move: (List: int) start_x, start_y, end_x, end_y
+        :param capture: True if the move captured a piece
+        :param promotion: promotion piece code, 0 for none
+        :return: 16-bit move code
+        """
+        code = (move[0] * 8 + move[1]) | ((move[2] * 8 + move[3]) << MOVE_TO_SHIFT) | \
+            (promotion << MOVE_PROMOTION_SHIFT)
+        if capture:
+            code |= MOVE_CAPTURE_FLAG
+        return code
+
+    @staticmethod
+    def decode_move(code: int) -> List[int]:
+        """
+        Unpacks the squares of a 16-bit move code
+
+        :param code: 16-bit move code
+        :return: (List: int) start_x, start_y, end_x, end_y
+        """
+        start = code & 0x3F
+        end = (code >> MOVE_TO_SHIFT) & 0x3F
+        return [start // 8, start % 8, end // 8, end % 8]
+
+    def position_key(self) -> int:
+        """
+        Gets the hash of the current position including the side to move
+
+        :return: 64-bit hash used for repetition detection
+        """
+        if self.current_turn % 2:
+            return self.board.position_hash ^ ZOBRIST_BLACK_TO_MOVE
+        return self.board.position_hash
+
+    def _record_position(self):
+        """
+        Stores the current position hash in the history ring
 
-    def get_move(self, player_idx: int) -> bool:
+        :return: None
+        """
+        self._hash_ring[self.current_turn % HISTORY_RING_SIZE] = self.position_key()
+
+    def input_move(self, player_idx: int) -> bool:
         valid_move: bool = False
         if self.current_turn % 2 != self.players[player_idx].turn:
             return False
@@ -679,6 +1345,12 @@ class ChessGame(object):
         valid_move: bool = False
         if self.current_turn % 2 != self.players[player_idx].turn:
             return False
+        # the result stands once decided
+        if self.is_over():
+            return False
+        # a move arriving after the flag fell loses on time instead
+        if self.check_clock():
+            return False
         raw_move = self.move.get_move(player_move)
         if self.move.is_move_valid(raw_move):
             self.move.current_move = self.move.interpret_move(raw_move)
@@ -688,17 +1360,35 @@ class ChessGame(object):
         return valid_move
 
     def execute_move(self, player_idx: int):
-        if self.get_move(player_idx):
+        """
+        Plays the move last validated by get_move or input_move
+
+        :param player_idx: index of the player making the move
+        :return: None
+        """
+        if self.current_turn % 2 == self.players[player_idx].turn and self.move.current_move:
             start_x = self.move.current_move[0]
             start_y = self.move.current_move[1]
             end_x = self.move.current_move[2]
             end_y = self.move.current_move[3]
 
             temp_piece = self.board.squares[start_x][start_y].release_square()
+            capture = self.board.squares[end_x][end_y].is_occupied()
+            irreversible = temp_piece.piece_name == "P " or capture
+            self._move_history.append(self.encode_move(self.move.current_move, capture))
+            self.board.position_hash ^= Board.zobrist_key(temp_piece, start_x, start_y) ^ \
+                Board.zobrist_key(temp_piece, end_x, end_y)
+            start_bit = 1 << (start_x * 8 + start_y)
+            end_bit = 1 << (end_x * 8 + end_y)
+            self.board.occupied = (self.board.occupied & ~start_bit) | end_bit
+            self.board.white_occupied &= ~(start_bit | end_bit)
+            if temp_piece.is_white:
+                self.board.white_occupied |= end_bit
             if self.board.squares[end_x][end_y].is_occupied():
                 self.board.squares[end_x][end_y].piece.set_captured()
                 captured_piece = self.board.squares[end_x][end_y].get_piece()
                 self.captured_pieces.append(captured_piece)
+                self.board.position_hash ^= Board.zobrist_key(captured_piece, end_x, end_y)
                 if captured_piece.piece_name == "K ":
                     if captured_piece.is_white:
                         self.black_won = True
@@ -708,9 +1398,159 @@ class ChessGame(object):
             self.board.squares[end_x][end_y].set_piece(temp_piece)
             self.board.squares[end_x][end_y].piece.set_coords(end_x, end_y)
             self.current_turn += 1
+            if irreversible:
+                self._clock_history.append(self.halfmove_clock)
+                self.halfmove_clock = 0
+            else:
+                self.halfmove_clock += 1
+            self._record_position()
+            if not self.is_over() and self.is_draw():
+                self.drawn = True
+            if self.clock is not None:
+                if self.is_over():
+                    self.clock.stop()
+                else:
+                    self.clock.press(player_idx)
         else:
             print(f"Incorrect player trying to make move. Current player turn:{player_idx}")
 
+    def play_move_code(self, code: int):
+        """
+        Plays a move from the packed move history, used to rebuild a stored game
+
+        :param code: 16-bit move code, see encode_move
+        :return: None
+        """
+        self.move.current_move = self.decode_move(code)
+        self.execute_move(self.current_turn % 2)
+
+    def takeback(self) -> bool:
+        """
+        Undoes the last move using the move history
+
+        :return: True if a move was taken back, False if no moves have been played
+        """
+        if not self._move_history:
+            return False
+        code = self._move_history.pop()
+        start_x, start_y, end_x, end_y = self.decode_move(code)
+        moved_piece = self.board.squares[end_x][end_y].release_square()
+        irreversible = moved_piece.piece_name == "P " or code & MOVE_CAPTURE_FLAG
+        self.board.squares[start_x][start_y].set_piece(moved_piece)
+        moved_piece.set_coords(start_x, start_y)
+        self.board.position_hash ^= Board.zobrist_key(moved_piece, start_x, start_y) ^ \
+            Board.zobrist_key(moved_piece, end_x, end_y)
+        start_bit = 1 << (start_x * 8 + start_y)
+        end_bit = 1 << (end_x * 8 + end_y)
+        self.board.occupied = (self.board.occupied & ~end_bit) | start_bit
+        self.board.white_occupied &= ~(start_bit | end_bit)
+        if moved_piece.is_white:
+            self.board.white_occupied |= start_bit
+        if code & MOVE_CAPTURE_FLAG:
+            captured_piece = self.captured_pieces.pop()
+            captured_piece.captured = False
+            self.board.squares[end_x][end_y].set_piece(captured_piece)
+            self.board.position_hash ^= Board.zobrist_key(captured_piece, end_x, end_y)
+            self.board.occupied |= end_bit
+            if captured_piece.is_white:
+                self.board.white_occupied |= end_bit
+            if captured_piece.piece_name == "K ":
+                self.white_won = False
+                self.black_won = False
+        if irreversible:
+            self.halfmove_clock = self._clock_history.pop()
+        else:
+            self.halfmove_clock -= 1
+        self.current_turn -= 1
+        self.drawn = False
+        self.move.current_move = []
+        return True
+
+    def is_threefold_repetition(self) -> bool:
+        """
+        Checks whether the current position has occurred three times.
+        Only positions since the last pawn move or capture are scanned.
+
+        :return: True if the position has been repeated three times
+        """
+        current = self.position_key()
+        occurrences = 1
+        window = min(self.halfmove_clock, HISTORY_RING_SIZE - 1)
+        # same side to move only occurs every other halfmove
+        for back in range(2, window + 1, 2):
+            if self._hash_ring[(self.current_turn - back) % HISTORY_RING_SIZE] == current:
+                occurrences += 1
+                if occurrences >= 3:
+                    return True
+        return False
+
+    def is_fifty_move_draw(self) -> bool:
+        """
+        Checks the fifty-move rule
+
+        :return: True if fifty moves by each player passed without a pawn move or capture
+        """
+        return self.halfmove_clock >= FIFTY_MOVE_HALFMOVES
+
+    def set_time_control(self, base: float, increment: float = 0.0):
+        """
+        Makes the game timed, see ChessClock
+
+        :param base: seconds each side starts with
+        :param increment: seconds added after each move
+        :return: None
+        """
+        self.clock = ChessClock(base, increment)
+
+    def check_clock(self, now: Optional[float] = None) -> bool:
+        """
+        Adjudicates a loss on time if the side to move ran out of time, games
+        that already ended otherwise are left alone
+
+        :param now: current time.time(), defaults to now
+        :return: True if the game was lost on time
+        """
+        if self.clock is None:
+            return False
+        if self.clock.flagged is None:
+            if self.is_over() or self.clock.flag_fallen(now) is None:
+                return False
+            self.flag_fall()
+        return True
+
+    def flag_fall(self):
+        """
+        Ends the game as a loss on time for the side to move, unless it already ended
+
+        :return: None
+        """
+        if self.is_over():
+            return
+        side = self.current_turn % 2
+        self.clock.stop()
+        self.clock.remaining[side] = 0.0
+        self.clock.flagged = side
+        if side == 0:
+            self.black_won = True
+        else:
+            self.white_won = True
+
+    def is_draw(self) -> bool:
+        """
+        Checks whether the current position is drawn by repetition or by the fifty-move rule
+
+        :return: True if the position is drawn
+        """
+        return self.is_fifty_move_draw() or self.is_threefold_repetition()
+
+    def is_over(self) -> bool:
+        """
+        Checks whether the game has a result, which no later move can change
+
+        :return: True if the game was won, lost or drawn
+        """
+        return self.white_won or self.black_won or self.drawn
+
     def game_won(self) -> bool:
         if self.white_won:
             print("White Won")
@@ -718,19 +1558,26 @@ class ChessGame(object):
         if self.black_won:
             print("Black Won")
             return False
+        if self.drawn:
+            print("Draw")
+            return False
         return True
+
     def who_won(self) -> str:
         if self.white_won:
             return "White Won"
         if self.black_won:
             return "Black Won"
+        if self.drawn:
+            return "Draw"
         return ""
 
     def run(self):
         self.board.print_board()
         game_continue = True
         while game_continue:
-            self.execute_move(self.current_turn % 2)
+            if self.input_move(self.current_turn % 2):
+                self.execute_move(self.current_turn % 2)
             self.board.update_board()
             self.board.print_board()
             game_continue = self.game_won()
@@ -315,7 +315,7 @@ class Move(object):
         :param move: (List: str)A list of the characters of the user input string
         :return: True if move is valid, False if invalid
         """
-        if not move:
+        if len(move) != 4:
             return False
         columns = ['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h']
         rows = ['8', '7', '6', '5', '4', '3', '2', '1']
@@ -504,7 +504,7 @@ class Knight(Piece):  # Completed
 
     def valid_move(self,board: Board, start_square: Square, end_square: Square):
         """
-        Checks if the movement given is a valid Rook movement
+        Checks if the movement given is a valid Knight movement
 
         :param start_square: (Square)the starting Square object of the piece
         :param end_square: (Square)the ending Square object of the piece
@@ -515,7 +515,8 @@ class Knight(Piece):  # Completed
                 return False
         x_dist = start_square.x - end_square.x
         y_dist = start_square.y - end_square.y
-        if (abs(x_dist) == 2 and abs(y_dist) != 1) or (abs(x_dist) == 1 and abs(y_dist) != 2):
+        # two squares one way and one square the other
+        if sorted((abs(x_dist), abs(y_dist))) != [1, 2]:
             return False
         return True
 
@@ -597,7 +598,8 @@ class Pawn(Piece):
         # Prevents piece from moving more than 1 space at a time
         if abs_dist > 1.5:
             return False
-        if y_dist == 1 and x_dist ==0:
+        # Pawns never move sideways
+        if x_dist == 0:
             return False
         # Prevents White pieces from moving backwards
         elif self.is_white and x_dist < 0:
@@ -1,6 +1,10 @@
 from unittest import TestCase, mock
-from chess_objects import Board, Move, Piece, Square, King, Queen, Rook, Bishop, Knight, Pawn
-from chess import ChessGame
+import random
+from chess.chess_objects import Board, Move, Piece, Square, King, Queen, Rook, Bishop, Knight, Pawn
+from chess.chess import ChessGame, LegalMoveCache, LEGAL_MOVE_CACHE
+from chess import chess as engine
+from chess.bitboards import BoardBatch
+import numpy as np
 
 
 class TestChess(TestCase):
@@ -42,6 +46,9 @@ class TestChess(TestCase):
         self.setUp()
         self.board.squares[4][4].piece = Knight(True, 4, 4)
         self.assertEqual(self.board.squares[4][4].piece.valid_move(self.board, self.board.squares[4][4], self.board.squares[3][6]), True)
+        self.assertEqual(self.board.squares[4][4].piece.valid_move(self.board, self.board.squares[4][4], self.board.squares[2][4]), False)
+        self.assertEqual(self.board.squares[4][4].piece.valid_move(self.board, self.board.squares[4][4], self.board.squares[3][5]), False)
+        self.assertEqual(self.board.squares[4][4].piece.valid_move(self.board, self.board.squares[4][4], self.board.squares[4][7]), False)
 
     def test__Pawn(self):
         self.setUp()
@@ -51,8 +58,188 @@ class TestChess(TestCase):
         self.assertEqual(self.board.squares[4][4].piece.valid_move(self.board, self.board.squares[4][4], self.board.squares[3][3]), True)
         self.assertEqual(self.board.squares[4][4].piece.valid_move(self.board, self.board.squares[4][4], self.board.squares[3][5]), False)
         self.assertEqual(self.board.squares[4][4].piece.valid_move(self.board, self.board.squares[4][4], self.board.squares[4][3]), False)
+        self.assertEqual(self.board.squares[4][4].piece.valid_move(self.board, self.board.squares[4][4], self.board.squares[4][5]), False)
 
     def test_interpret_move(self):
         self.setUp()
         self.assertEqual(self.move.interpret_move(['e', '2', 'e', '3']), [6, 4, 5, 4])
         self.assertEqual(self.move.valid_piece_move(self.board, [6, 4, 5, 4]), True)
+
+    def test_legal_move_cache(self):
+        cache = LegalMoveCache(maxsize=2)
+        cache.set_result(1, (6, 4, 5, 4), True)
+        cache.set_result(2, (6, 4, 5, 4), False)
+        self.assertEqual(cache.get_result(1, (6, 4, 5, 4)), True)
+        cache.set_result(3, (6, 4, 5, 4), True)
+        self.assertEqual(cache.get_result(2, (6, 4, 5, 4)), None)
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+        self.assertEqual(cache.stats()['size'], 2)
+
+    def test_legal_moves(self):
+        LEGAL_MOVE_CACHE.clear()
+        game = ChessGame()
+        game.board.rehash()
+        moves = game.move.legal_moves(game.board, True)
+        self.assertIn([6, 4, 5, 4], moves)
+        self.assertNotIn([7, 4, 6, 4], moves)
+        self.assertEqual(len(moves), 12)
+        self.assertEqual(game.move.legal_moves(game.board, True), moves)
+        self.assertEqual(LEGAL_MOVE_CACHE.stats()['hits'], 1)
+        self.assertEqual(game.move.format_move([6, 4, 5, 4]), 'e2e3')
+        self.play(game, 'e2e3', 'e7e6')
+        moves = [game.move.format_move(move) for move in game.move.legal_moves(game.board, True)]
+        self.assertNotIn('b1a8', moves)
+        self.assertNotIn('b1b8', moves)
+        self.assertNotIn('d2e2', moves)
+        self.assertIn('b1c3', moves)
+
+    def test_cache_edited_board(self):
+        # a board edited directly, outside of a ChessGame, is never answered from the old position's entry
+        board = engine.Board()
+        move = engine.Move()
+        self.assertNotIn([7, 4, 6, 4], move.legal_moves(board, True))
+        self.assertEqual(move.valid_piece_move(board, [7, 4, 6, 4]), False)
+        board.squares[6][4].piece = None
+        self.assertIn([7, 4, 6, 4], move.legal_moves(board, True))
+        self.assertEqual(move.valid_piece_move(board, [7, 4, 6, 4]), True)
+
+    def play(self, game, *moves):
+        for move in moves:
+            idx = game.current_turn % 2
+            self.assertEqual(game.get_move(idx, move), True)
+            game.execute_move(idx)
+
+    def test_threefold_repetition(self):
+        game = ChessGame()
+        self.play(game, 'g1f3', 'g8f6', 'f3g1', 'f6g8')
+        self.assertEqual(game.is_threefold_repetition(), False)
+        self.play(game, 'g1f3', 'g8f6', 'f3g1', 'f6g8')
+        self.assertEqual(game.is_threefold_repetition(), True)
+        self.assertEqual(game.who_won(), "Draw")
+        self.assertEqual(game.get_move(0, 'e2e3'), False)
+        self.assertEqual(game.who_won(), "Draw")
+        restored = ChessGame.decode(game.encode())
+        self.assertEqual(restored.who_won(), "Draw")
+        self.assertEqual(game.takeback(), True)
+        self.assertEqual(game.who_won(), "")
+
+    def test_finished_game(self):
+        game = ChessGame()
+        self.play(game, 'e2e3', 'f7f6', 'd1h5', 'a7a6', 'h5e8')
+        self.assertEqual(game.who_won(), "White Won")
+        self.assertEqual(game.get_move(1, 'a6a5'), False)
+        self.assertEqual(game.current_turn, 5)
+        game.set_time_control(1)
+        game.clock.remaining = [0.0, 0.0]
+        game.clock.running = 1
+        self.assertEqual(game.check_clock(), False)
+        game.flag_fall()
+        self.assertEqual(game.who_won(), "White Won")
+        self.assertEqual(game.clock.flagged, None)
+
+    def test_fifty_move_rule(self):
+        game = ChessGame()
+        self.play(game, 'e2e3')
+        self.assertEqual(game.halfmove_clock, 0)
+        self.play(game, 'g8f6')
+        self.assertEqual(game.halfmove_clock, 1)
+        game.halfmove_clock = 99
+        self.play(game, 'g1f3')
+        self.assertEqual(game.is_fifty_move_draw(), True)
+
+    def test_takeback(self):
+        game = ChessGame()
+        start_hash = game.board.position_hash
+        self.play(game, 'e2e3', 'g8f6', 'g1f3', 'f6e4', 'f3e5', 'e4f2', 'e1f2')
+        self.assertEqual(len(game.move_history), 7)
+        self.assertEqual(game.decode_move(game.move_history[0]), [6, 4, 5, 4])
+        self.assertEqual(game.halfmove_clock, 0)
+        self.assertEqual(game.takeback(), True)
+        self.assertEqual(game.halfmove_clock, 0)
+        self.assertEqual(game.board.squares[6][5].get_piece().piece_name, "N ")
+        self.assertEqual(len(game.captured_pieces), 1)
+        while game.takeback():
+            pass
+        self.assertEqual(game.current_turn, 0)
+        self.assertEqual(game.captured_pieces, [])
+        self.assertEqual(game.board.position_hash, start_hash)
+        self.assertEqual(game.board.compute_hash(), start_hash)
+
+    def test_valid_piece_moves(self):
+        LEGAL_MOVE_CACHE.clear()
+        game = ChessGame()
+        other = ChessGame()
+        requests = [(game.board, [6, 4, 5, 4]), (other.board, [6, 4, 5, 4]), (game.board, [7, 4, 6, 4]),
+                    (game.board, [4, 4, 3, 4]), (game.board, [7, 6, 5, 5])]
+        self.assertEqual(game.move.valid_piece_moves(requests), [True, True, False, False, True])
+        self.assertEqual(LEGAL_MOVE_CACHE.stats()['misses'], 4)
+        self.assertEqual(game.move.valid_piece_moves(requests[:1]), [True])
+        self.assertEqual(LEGAL_MOVE_CACHE.stats()['hits'], 1)
+
+    def test_valid_piece_moves_match_engine(self):
+        rng = random.Random(3)
+        for _ in range(3):
+            game = ChessGame()
+            while not game.is_over() and game.current_turn < 40:
+                LEGAL_MOVE_CACHE.clear()
+                squares = [(x, y) for x in range(8) for y in range(8)]
+                requests = [(game.board, [sx, sy, ex, ey]) for sx, sy in squares for ex, ey in squares
+                            if game.board.squares[sx][sy].is_occupied()]
+                self.assertEqual(game.move.valid_piece_moves(requests),
+                                 [game.move._check_piece_move(board, tuple(move)) for board, move in requests])
+                moves = game.move.legal_moves(game.board, game.current_turn % 2 == 0)
+                game.move.current_move = rng.choice(moves)
+                game.execute_move(game.current_turn % 2)
+                if rng.random() < 0.2:
+                    game.takeback()
+                # the occupancy bitboards are kept up to date by moves and takebacks
+                occupied, white_occupied = game.board.occupied, game.board.white_occupied
+                game.board.rehash()
+                self.assertEqual((game.board.occupied, game.board.white_occupied), (occupied, white_occupied))
+
+    def test_board_batch(self):
+        game = ChessGame()
+        batch = BoardBatch.from_boards([game.board, game.board], [True, False])
+        self.assertEqual(list(batch.count_moves()), [12, 12])
+        self.assertIn([6, 4, 5, 4], batch.moves(0))
+        self.assertIn([1, 4, 2, 4], batch.moves(1))
+        # precomputed targets list every board without generating the moves again
+        expected = [batch.moves(0), batch.moves(1)]
+        targets = batch.move_targets()
+        with mock.patch.object(batch, 'move_targets') as move_targets:
+            self.assertEqual([batch.moves(idx, targets) for idx in range(2)], expected)
+        move_targets.assert_not_called()
+        self.assertEqual(list(BoardBatch.starting_position(2).perft(2)), [144, 144])
+        attacks = int(batch.attacks(np.array([True, True]))[0])
+        self.assertEqual(attacks, 0x7effff0000000000)
+
+    def test_board_batch_matches_engine(self):
+        rng = random.Random(7)
+        for _ in range(4):
+            game = ChessGame()
+            while not game.is_over() and game.current_turn < 60:
+                is_white = game.current_turn % 2 == 0
+                moves = sorted(game.move.legal_moves(game.board, is_white))
+                batch = BoardBatch.from_boards([game.board], [is_white])
+                self.assertEqual(sorted(batch.moves(0)), moves)
+                self.assertEqual(int(batch.count_moves()[0]), len(moves))
+                if not moves:
+                    break
+                game.move.current_move = rng.choice(moves)
+                game.execute_move(game.current_turn % 2)
+
+    def test_encode_decode(self):
+        game = ChessGame()
+        self.play(game, 'g1f3', 'g8f6', 'f3g1', 'f6g8', 'e2e3', 'b8c6', 'd1h5', 'c6d4', 'h5h7')
+        restored = ChessGame.decode(game.encode())
+        self.assertEqual(restored.board.position_hash, game.board.position_hash)
+        self.assertEqual(restored.current_turn, game.current_turn)
+        self.assertEqual(list(restored.move_history), list(game.move_history))
+        self.assertEqual(restored.captured_pieces[0].piece_name, "P ")
+        self.play(restored, 'd4e2', 'f1e2')
+        self.play(game, 'd4e2', 'f1e2')
+        self.assertEqual(restored.encode(), game.encode())
+        while restored.takeback():
+            pass
+        self.assertEqual(restored.board.position_hash, ChessGame().board.position_hash)
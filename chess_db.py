@@ -1,10 +1,87 @@
-from uuid import uuid4
-from typing import List, Tuple, Dict, Union
-from chess.chess import ChessGame
+from uuid import uuid4, UUID
+from typing import List, Tuple, Dict, Set, Union, Optional, Callable, Any, AsyncIterator
+from chess.chess import ChessGame, ChessClock, Move
 from user_db import UserDB
+from shared_game_store import SharedGameStore
+from timer_wheel import TimerWheel
+from game_broadcast import GameBroadcaster, Subscription, state_document, state_etag
 from dataclasses import dataclass
+from collections import OrderedDict
 from fastapi import HTTPException, status
 import asyncio
+import bisect
+import fcntl
+import itertools
+import logging
+import os
+import sqlite3
+import struct
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def shard_for_game(game_id: str, num_shards: int) -> int:
+    """
+    Picks the shard that owns a game.  Uses the UUID value rather than hash()
+    so every process agrees on the owner.
+
+    :raises: ValueError if game_id is not a UUID
+    :param game_id: the UUID of the game
+    :param num_shards: number of shards
+    :return: index of the owning shard
+    """
+    return UUID(game_id).int % num_shards
+
+
+def game_result(game: ChessGame) -> str:
+    """
+    Gets the result of a game in PGN notation
+
+    :param game: the game
+    :return: '1-0', '0-1', '1/2-1/2', or '*' while the game goes on
+    """
+    winner = game.who_won()
+    if winner == "White Won":
+        return '1-0'
+    if winner == "Black Won":
+        return '0-1'
+    return '1/2-1/2' if winner else '*'
+
+
+def round_robin_pairings(players: List[str], round_idx: int) -> Tuple[List[List[str]], Optional[str]]:
+    """
+    Pairs the players for one round of a round-robin tournament (circle method).
+    Over len(players) - 1 rounds (len(players) when odd) everyone meets everyone
+    once; colors are spread so nobody plays white in every round.
+
+    :param players: usernames in seeding order
+    :param round_idx: zero-indexed round number
+    :return: (list of [white, black] pairings, player with a bye or None)
+    """
+    entrants: List[Optional[str]] = list(players)
+    if len(entrants) % 2:
+        entrants.append(None)
+    if len(entrants) < 2:
+        return [], entrants[0] if entrants else None
+    num_rounds = len(entrants) - 1
+    rotation = round_idx % num_rounds
+    # the first entrant stays in place, the others rotate one position per round
+    others = entrants[1:]
+    others = others[-rotation:] + others[:-rotation] if rotation else others
+    order = [entrants[0]] + others
+    half = len(order) // 2
+    pairings = []
+    bye = None
+    for board in range(half):
+        white, black = order[board], order[-1 - board]
+        if (board == 0 and round_idx % 2) or (board > 0 and board % 2 == 1):
+            white, black = black, white
+        if white is None or black is None:
+            bye = black if white is None else white
+            continue
+        pairings.append([white, black])
+    return pairings, bye
 
 
 @dataclass
@@ -14,41 +91,674 @@ class ChessGameInfo:
     termination_password: str
 
 
+class GameIndex(object):
+    """
+    Ordered sets of game ids for listings: all games, the games of each owner
+    and the games of each player.  Every game gets an increasing sequence
+    number when indexed and each set is a sorted list of sequence numbers, so
+    the page before a cursor is found by bisection and a listing never looks
+    at games outside its page.
+    """
+
+    def __init__(self):
+        self._next_seq = 1
+        self._seqs: Dict[str, int] = {}
+        self._game_ids: Dict[int, str] = {}
+        self._all: List[int] = []
+        self._by_owner: Dict[str, List[int]] = {}
+        self._by_player: Dict[str, List[int]] = {}
+
+    @staticmethod
+    def _insert(seqs: List[int], seq: int):
+        idx = bisect.bisect_left(seqs, seq)
+        if idx == len(seqs) or seqs[idx] != seq:
+            seqs.insert(idx, seq)
+
+    @staticmethod
+    def _remove(index: Dict[str, List[int]], key: str, seq: int):
+        seqs = index.get(key, None)
+        if seqs is None:
+            return
+        idx = bisect.bisect_left(seqs, seq)
+        if idx < len(seqs) and seqs[idx] == seq:
+            del seqs[idx]
+        if not seqs:
+            del index[key]
+
+    @staticmethod
+    def _contains(seqs: List[int], seq: int) -> bool:
+        idx = bisect.bisect_left(seqs, seq)
+        return idx < len(seqs) and seqs[idx] == seq
+
+    def add_game(self, game_id: str, owner: str):
+        seq = self._next_seq
+        self._next_seq += 1
+        self._seqs[game_id] = seq
+        self._game_ids[seq] = game_id
+        self._all.append(seq)
+        self._by_owner.setdefault(owner, []).append(seq)
+
+    def add_player(self, game_id: str, username: str):
+        self._insert(self._by_player.setdefault(username, []), self._seqs[game_id])
+
+    def remove_game(self, game_id: str, owner: str, players: List[str]):
+        seq = self._seqs.pop(game_id)
+        del self._game_ids[seq]
+        del self._all[bisect.bisect_left(self._all, seq)]
+        self._remove(self._by_owner, owner, seq)
+        for username in set(players):
+            self._remove(self._by_player, username, seq)
+
+    def page(self, owner: Optional[str] = None, player: Optional[str] = None, before: Optional[int] = None,
+             limit: int = 50) -> Tuple[List[str], Optional[int]]:
+        """
+        Lists games, newest first.
+
+        :param owner: only list the games of this owner
+        :param player: only list the games this user plays in
+        :param before: cursor returned with the previous page, None for the first page
+        :param limit: largest number of games returned
+        :return: (game ids, cursor of the next page or None if this is the last page)
+        """
+        if owner is not None and player is not None:
+            owned, played = self._by_owner.get(owner, []), self._by_player.get(player, [])
+            # walk the shorter list and check membership in the other
+            seqs, other = (owned, played) if len(owned) <= len(played) else (played, owned)
+        else:
+            seqs = self._by_owner.get(owner, []) if owner is not None else \
+                self._by_player.get(player, []) if player is not None else self._all
+            other = None
+        end = bisect.bisect_left(seqs, before) if before is not None else len(seqs)
+        # one game past the page tells whether there is a next page
+        page = []
+        while end > 0 and len(page) <= limit:
+            end -= 1
+            if other is None or self._contains(other, seqs[end]):
+                page.append(seqs[end])
+        more = len(page) > limit
+        page = page[:limit]
+        return [self._game_ids[seq] for seq in page], page[-1] if more else None
+
+
+class GameActor(object):
+    """
+    Owns one ChessGame and runs the commands sent to it strictly one at a time,
+    in the order they were submitted.  Different games have different actors,
+    so they never wait on each other.  The worker task only exists while
+    commands are queued, idle games cost nothing but the empty queue.
+    Once the game is deleted the actor is closed, and the commands still
+    queued behind the deletion fail with KeyError like unknown games do.
+    """
+
+    def __init__(self, game_id: str, game: ChessGame):
+        self.game_id = game_id
+        self.game = game
+        self.closed = False
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+
+    async def submit(self, command: Callable[[ChessGame], Any]) -> Any:
+        """
+        Queues a command and waits for its result.
+
+        :raises: KeyError if the game was deleted
+        :param command: function (or coroutine function) called with the game
+        :return: what the command returned, exceptions are re-raised to the caller
+        """
+        if self.closed:
+            raise KeyError(self.game_id)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._queue.put_nowait((command, future))
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._run())
+        return await future
+
+    def idle(self) -> bool:
+        """
+        :return: True if no command is queued or running
+        """
+        return self._queue.empty() and (self._task is None or self._task.done())
+
+    async def _run(self):
+        while not self._queue.empty():
+            command, future = self._queue.get_nowait()
+            try:
+                if self.closed:
+                    raise KeyError(self.game_id)
+                result = command(self.game)
+                if asyncio.iscoroutine(result):
+                    result = await result
+            except Exception as e:
+                if not future.cancelled():
+                    future.set_exception(e)
+            else:
+                if not future.cancelled():
+                    future.set_result(result)
+
+
 class AsyncChessGameDB(object):
-    def __init__(self, user_db: UserDB):
-        self._current_games: Dict[str, ChessGame] = {}
+    """
+    Game database.  Games are served from the in-memory _current_games cache;
+    when max_resident_games or idle_timeout is set, games that were not used
+    recently are hibernated into their compact ChessGame.encode form and
+    decoded again on their next access.
+    Game metadata (owner, players) lives in SQLite; accepted moves are appended
+    as fixed-size binary records to a segmented move log, and periodic snapshots
+    of every live game bound how much of the log is replayed on startup.
+    Writes are queued and committed in batches by a background flush.
+    Timed games are tracked by one TimerWheel keyed by game id, advanced by a
+    single task (see start_clocks), so flag-fall costs nothing per idle game.
+    """
+    _SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS games (game_id TEXT PRIMARY KEY, owner TEXT NOT NULL, "
+        "termination_password TEXT NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS players (game_id TEXT NOT NULL, idx INTEGER NOT NULL, "
+        "username TEXT NOT NULL, PRIMARY KEY (game_id, idx))",
+        "CREATE TABLE IF NOT EXISTS clocks (game_id TEXT PRIMARY KEY, base REAL NOT NULL, "
+        "increment REAL NOT NULL)",
+        # time left on each side after the latest move of a timed game, so a restart does not give back
+        # the time used since the last snapshot
+        "CREATE TABLE IF NOT EXISTS clock_times (game_id TEXT PRIMARY KEY, ply INTEGER NOT NULL, "
+        "white REAL NOT NULL, black REAL NOT NULL)",
+        # finished games, kept after they are terminated; seq orders them for consumers such as ratings
+        "CREATE TABLE IF NOT EXISTS results (seq INTEGER PRIMARY KEY AUTOINCREMENT, game_id TEXT NOT NULL, "
+        "white TEXT, black TEXT, result TEXT NOT NULL, finished REAL NOT NULL, moves BLOB NOT NULL)",
+        # exports filtered by player or date, see export_results
+        "CREATE INDEX IF NOT EXISTS results_white ON results (white, seq)",
+        "CREATE INDEX IF NOT EXISTS results_black ON results (black, seq)",
+        "CREATE INDEX IF NOT EXISTS results_finished ON results (finished)",
+    )
+    # move log record: game UUID bytes, ply, 16-bit move code
+    _LOG_RECORD = struct.Struct('<16sHH')
+    # snapshot entry header: game UUID bytes, length of the encoded game
+    _SNAPSHOT_ENTRY = struct.Struct('<16sI')
+    # move code of the log record written when the side to move loses on time
+    _TIMEOUT_CODE = 0xFFFF
+
+    def __init__(self, user_db: UserDB, db_path: str = 'chess_games.sqlite3', log_dir: str = 'chess_log',
+                 flush_interval: float = 0.05, snapshot_interval: int = 100000,
+                 segment_size: int = 64 * 1024 * 1024, shard_index: int = 0, num_shards: int = 1,
+                 shared_store: Optional[SharedGameStore] = None, max_resident_games: Optional[int] = None,
+                 idle_timeout: Optional[float] = None, clock_tick: float = 0.1):
+        """
+        Opens (or creates) the game database and loads the stored games.
+
+        :raises: RuntimeError if another process already has log_dir open
+        :param user_db: the Web API's UserDB
+        :param db_path: path of the SQLite database file
+        :param log_dir: directory holding the move log segments and snapshots
+        :param flush_interval: seconds queued writes wait so they can be committed together
+        :param snapshot_interval: number of logged moves after which a snapshot is taken
+        :param segment_size: size in bytes after which a new log segment is started
+        :param shard_index: index of the shard this database serves when games are sharded across processes
+        :param num_shards: total number of shards, new game ids are picked so they belong to this shard
+        :param shared_store: shared memory store the state of every game is published to, if any
+        :param max_resident_games: games kept decoded in memory, the least recently used are hibernated beyond that
+        :param idle_timeout: seconds after which an unused game is hibernated
+        :param clock_tick: resolution in seconds of the timeout scheduler, flags are adjudicated at most a tick late
+        """
+        # decoded games, least recently used first
+        self._current_games: OrderedDict = OrderedDict()
+        # game_id -> time of last use of the decoded games, only tracked with an idle_timeout
+        self._last_used: Dict[str, float] = {}
+        # game_id -> ChessGame.encode bytes of the hibernated games
+        self._hibernated: Dict[str, bytes] = {}
+        self._max_resident_games = max_resident_games
+        self._idle_timeout = idle_timeout
+        self._hibernation_counters = {'hibernations': 0, 'rehydrations': 0}
         self._current_games_info: Dict[str, ChessGameInfo] = {}
-        self._QUERY_TIME: float = 0.05
+        self._actors: Dict[str, GameActor] = {}
+        # broadcasters of the games someone is following, see subscribe
+        self._broadcasters: Dict[str, GameBroadcaster] = {}
+        self._index = GameIndex()
+        # games whose result was recorded in the results table
+        self._finished: Set[str] = set()
+        # game_id -> player_idx -> conditional move tree queued by the player, see set_premoves
+        self._premoves: Dict[str, Dict[int, Dict[str, Any]]] = {}
+        # game_id -> (turn, position hash, ETag, document) of the last state served, see game_state
+        self._state_cache: Dict[str, Tuple[int, int, str, bytes]] = {}
+        # flag-fall deadlines of the running clocks, see start_clocks
+        self._clock_wheel = TimerWheel(clock_tick, now=time.time())
+        self._clock_task: Optional[asyncio.Task] = None
         self._user_db = user_db  # pointer to the Web API's UserDB
+        self._FLUSH_INTERVAL = flush_interval
+        self._SNAPSHOT_INTERVAL = snapshot_interval
+        self._SEGMENT_SIZE = segment_size
+        self._shard_index = shard_index
+        self._num_shards = num_shards
+        self._shared_store = shared_store
+        self._pending_writes: List[Tuple[str, Union[tuple, List[tuple]]]] = []
+        self._pending_log = bytearray()
+        self._logged_since_snapshot = 0
+        self._flush_task: Optional[asyncio.Task] = None
+        # longest wait between retries of a failing background flush
+        self._MAX_FLUSH_RETRY_DELAY = 5.0
+        self._flush_lock = asyncio.Lock()
+        os.makedirs(log_dir, exist_ok=True)
+        # games live in the memory of one process, several processes on the same files would overwrite each
+        # other's moves: run them as shards with sharded_chess.py, each with its own database and log
+        self._lock_file = open(os.path.join(log_dir, 'lock'), 'a')
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._lock_file.close()
+            raise RuntimeError(f"{log_dir} is used by another process, run several processes with sharded_chess.py")
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # in WAL mode NORMAL only syncs at checkpoints, not on every commit
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        for statement in self._SCHEMA:
+            self._conn.execute(statement)
+        self._conn.commit()
+        self._log_dir = log_dir
+        self._load_games()
+        for game_id, game in self._current_games.items():
+            self._schedule_clock(game_id, game)
+        if shared_store is not None:
+            for game_id, game in self._current_games.items():
+                shared_store.publish(game_id, game)
+            # encoded games are only decoded for as long as it takes to publish them
+            for game_id, game_bytes in self._hibernated.items():
+                shared_store.publish(game_id, ChessGame.decode(game_bytes))
+        now = time.monotonic()
+        if idle_timeout is not None:
+            self._last_used = {game_id: now for game_id in self._current_games}
+        self._hibernate_cold()
+        self._segment = max([self._segment_number(name) for name in os.listdir(log_dir)], default=0) + 1
+        self._log_file = open(self._segment_path(self._segment), 'ab')
 
-    async def add_game(self, owner: str) -> Tuple[str, str, str]:
+    @staticmethod
+    def _segment_number(name: str) -> int:
         """
-        Asks the database to create a new game.
+        :return: the sequence number in a log segment or snapshot file name, -1 for other files
+        """
+        stem, ext = os.path.splitext(name)
+        if ext not in ('.log', '.snapshot') or not stem.isdigit():
+            return -1
+        return int(stem)
 
-        :return: the UUID (universally-unique ID) of the game, termination password, and owner username
+    def _segment_path(self, number: int) -> str:
+        return os.path.join(self._log_dir, f'{number:08d}.log')
+
+    def _load_games(self):
+        """
+        Restores the stored games: metadata from SQLite, game state from the latest
+        snapshot, then the moves logged after that snapshot.  Games stay in their
+        encoded form, as if hibernated, and are decoded on first use; only the
+        games with logged moves to replay or a clock to restart are decoded here.
+
+        :return: None
+        """
+        # encoded state of the games not decoded yet, new games share the encoding of the starting position
+        encoded: Dict[str, bytes] = {}
+        new_game = ChessGame().encode()
+        # rowid order is creation order, which the listing index keeps
+        for game_id, owner, term_password in self._conn.execute(
+                "SELECT game_id, owner, termination_password FROM games ORDER BY rowid"):
+            encoded[game_id] = new_game
+            self._current_games_info[game_id] = ChessGameInfo(owner, list(), term_password)
+            self._index.add_game(game_id, owner)
+        for game_id, username in self._conn.execute("SELECT game_id, username FROM players ORDER BY game_id, idx"):
+            self._current_games_info[game_id].players.append(username)
+            self._index.add_player(game_id, username)
+        self._finished = {game_id for game_id, in self._conn.execute("SELECT game_id FROM results")
+                          if game_id in self._current_games_info}
+
+        files = sorted(os.listdir(self._log_dir))
+        snapshots = [self._segment_number(name) for name in files if name.endswith('.snapshot')]
+        first_segment = 0
+        if snapshots:
+            first_segment = max(snapshots)
+            with open(os.path.join(self._log_dir, f'{first_segment:08d}.snapshot'), 'rb') as snapshot_file:
+                data = snapshot_file.read()
+            offset = 0
+            while offset < len(data):
+                game_bytes, length = self._SNAPSHOT_ENTRY.unpack_from(data, offset)
+                offset += self._SNAPSHOT_ENTRY.size
+                game_id = str(UUID(bytes=game_bytes))
+                if game_id in encoded:
+                    encoded[game_id] = data[offset:offset + length]
+                offset += length
+
+        def decoded(game_id: str) -> ChessGame:
+            game = self._current_games.get(game_id, None)
+            if game is None:
+                game = ChessGame.decode(encoded.pop(game_id))
+                self._current_games[game_id] = game
+            return game
+
+        # clocks are detached while the log is replayed, the replayed moves happened in the past
+        clocks: Dict[str, ChessClock] = {}
+        for game_id, base, increment in self._conn.execute("SELECT game_id, base, increment FROM clocks"):
+            game = decoded(game_id)
+            clocks[game_id] = game.clock if game.clock is not None else ChessClock(base, increment)
+            game.clock = None
+        clock_times = {game_id: (ply, [white, black]) for game_id, ply, white, black in self._conn.execute(
+            "SELECT game_id, ply, white, black FROM clock_times")}
+        timed_out = set()
+        for name in files:
+            if not name.endswith('.log') or self._segment_number(name) < first_segment:
+                continue
+            with open(os.path.join(self._log_dir, name), 'rb') as segment_file:
+                data = segment_file.read()
+            # a torn record at the end of the last segment is ignored
+            usable = len(data) - len(data) % self._LOG_RECORD.size
+            for game_bytes, ply, code in self._LOG_RECORD.iter_unpack(data[:usable]):
+                game_id = str(UUID(bytes=game_bytes))
+                if game_id not in encoded and game_id not in self._current_games:
+                    continue
+                game = decoded(game_id)
+                # records already covered by the snapshot are skipped, and so are moves that older
+                # versions accepted after the end of a game, which are not part of its recorded result
+                if ply != game.current_turn or game.is_over():
+                    continue
+                if code == self._TIMEOUT_CODE:
+                    timed_out.add(str(UUID(bytes=game_bytes)))
+                else:
+                    game.play_move_code(code)
+        now = time.time()
+        for game_id, clock in clocks.items():
+            game = self._current_games[game_id]
+            game.clock = clock
+            ply, remaining = clock_times.get(game_id, (None, None))
+            # the stored times are those after the last replayed move, unless that move was never stored
+            if ply == game.current_turn and clock.flagged is None:
+                clock.remaining = remaining
+            if game_id in timed_out and clock.flagged is None:
+                game.flag_fall()
+            elif not game.who_won() and (clock.running is not None or game.current_turn):
+                # the side to move gets its time from the last snapshot back, counted from the restart
+                clock.running = game.current_turn % 2
+                clock.running_since = now
+        self._hibernated.update(encoded)
+
+    def _queue_write(self, sql: str, params: tuple):
+        """
+        Queues a metadata write for the next batched commit.
+
+        :param sql: SQL statement
+        :param params: statement parameters
+        :return: None
+        """
+        self._pending_writes.append((sql, params))
+        self._schedule_flush()
+
+    def _queue_writes(self, sql: str, rows: List[tuple]):
+        """
+        Queues one statement run for many rows in the next batched commit.
+
+        :param sql: SQL statement
+        :param rows: parameters of each row
+        :return: None
+        """
+        self._pending_writes.append((sql, rows))
+        self._schedule_flush()
+
+    def _queue_log(self, game_id: str, ply: int, code: int):
+        """
+        Queues a move record for the next batched append to the move log.
+
+        :return: None
+        """
+        self._pending_log += self._LOG_RECORD.pack(UUID(game_id).bytes, ply, code)
+        self._logged_since_snapshot += 1
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_later())
+            self._flush_task.add_done_callback(self._flush_done)
+
+    async def _flush_later(self):
+        delay = self._FLUSH_INTERVAL
+        while self._pending_writes or self._pending_log:
+            await asyncio.sleep(delay)
+            try:
+                await self.flush()
+                delay = self._FLUSH_INTERVAL
+            except Exception:
+                # the failed writes are queued again, retried less often until the database recovers
+                logger.exception("Committing queued chess game writes failed, retrying")
+                delay = min(delay * 2, self._MAX_FLUSH_RETRY_DELAY)
+
+    @staticmethod
+    def _flush_done(task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Background flush of the chess game database stopped", exc_info=task.exception())
+
+    def _write_batch(self, batch: List[Tuple[str, tuple]], log_records: bytearray):
+        """
+        Commits metadata writes, then appends move records to the log.  Each part
+        is emptied once it is durable, so after an error only what is left in
+        batch and log_records has to be written again.
+
+        :return: None
+        """
+        # metadata first so replayed moves always find their game
+        if batch:
+            with self._conn:
+                for sql, params in batch:
+                    # a list holds the rows of one executemany, see _queue_writes
+                    if isinstance(params, list):
+                        self._conn.executemany(sql, params)
+                    else:
+                        self._conn.execute(sql, params)
+            batch.clear()
+        if log_records:
+            start = self._log_file.tell()
+            try:
+                self._log_file.write(log_records)
+                self._log_file.flush()
+                os.fsync(self._log_file.fileno())
+            except OSError:
+                # cut off a partial append so the segment stays a whole number of records
+                try:
+                    self._log_file.close()
+                except OSError:
+                    pass
+                os.truncate(self._segment_path(self._segment), start)
+                self._log_file = open(self._segment_path(self._segment), 'ab')
+                raise
+            log_records.clear()
+
+    def _write_snapshot(self, segment: int, entries: List[Tuple[str, bytes]]):
+        """
+        Writes a snapshot covering every log segment before segment, then removes
+        the segments and snapshots it replaces.
+
+        :return: None
+        """
+        path = os.path.join(self._log_dir, f'{segment:08d}.snapshot')
+        with open(path + '.tmp', 'wb') as snapshot_file:
+            for game_id, encoded in entries:
+                snapshot_file.write(self._SNAPSHOT_ENTRY.pack(UUID(game_id).bytes, len(encoded)))
+                snapshot_file.write(encoded)
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(path + '.tmp', path)
+        for name in os.listdir(self._log_dir):
+            if 0 <= self._segment_number(name) < segment:
+                os.remove(os.path.join(self._log_dir, name))
+
+    async def _flush_pending(self):
+        batch, self._pending_writes = self._pending_writes, []
+        log_records, self._pending_log = self._pending_log, bytearray()
+        if batch or log_records:
+            try:
+                await asyncio.to_thread(self._write_batch, batch, log_records)
+            except Exception:
+                # ahead of anything queued meanwhile, so the next flush keeps the original order
+                self._pending_writes[:0] = batch
+                self._pending_log[:0] = log_records
+                raise
+        if self._log_file.tell() >= self._SEGMENT_SIZE:
+            self._start_segment()
+
+    def _start_segment(self):
+        self._log_file.close()
+        self._segment += 1
+        self._log_file = open(self._segment_path(self._segment), 'ab')
+
+    async def _take_snapshot(self):
+        # every move played so far is in the encoded games, so the new segment
+        # is the only one that has to be replayed on top of this snapshot
+        self._start_segment()
+        entries = [(game_id, game.encode()) for game_id, game in self._current_games.items()]
+        entries.extend(self._hibernated.items())
+        self._logged_since_snapshot = 0
+        await asyncio.to_thread(self._write_snapshot, self._segment, entries)
+
+    async def flush(self):
+        """
+        Commits all queued writes: metadata in a single SQLite transaction and
+        moves in a single append to the move log.  Takes a snapshot once enough
+        moves have been logged.
+
+        :return: None
+        """
+        async with self._flush_lock:
+            await self._flush_pending()
+            if self._logged_since_snapshot >= self._SNAPSHOT_INTERVAL:
+                await self._take_snapshot()
+
+    async def snapshot(self):
+        """
+        Commits the queued writes and snapshots every live game.
+
+        :return: None
+        """
+        async with self._flush_lock:
+            await self._flush_pending()
+            await self._take_snapshot()
+
+    async def close(self):
+        """
+        Commits the queued writes and closes the database.
+
+        :return: None
+        """
+        if self._clock_task is not None:
+            self._clock_task.cancel()
+        await self.flush()
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+        self._log_file.close()
+        self._conn.close()
+        self._lock_file.close()
+
+    def _new_game(self, owner: str, time_control: Optional[Tuple[float, float]] = None) -> Tuple[str, str]:
+        """
+        Creates a game in memory, with an id that belongs to this shard.
+
+        :param owner: username of the owner
+        :param time_control: (base, increment) in seconds for a timed game, None for no clock
+        :return: the UUID of the game and its termination password
         """
-        await asyncio.sleep(self._QUERY_TIME)  # simulate query time
         game_uuid = str(uuid4())
+        while shard_for_game(game_uuid, self._num_shards) != self._shard_index:
+            game_uuid = str(uuid4())
         game_term_password = str(uuid4())
         self._current_games[game_uuid] = ChessGame()
+        if time_control is not None:
+            self._current_games[game_uuid].set_time_control(*time_control)
+        self._touch(game_uuid)
         self._current_games_info[game_uuid] = ChessGameInfo(
             owner,
             list(),
             game_term_password)
+        self._index.add_game(game_uuid, owner)
+        if self._shared_store is not None:
+            self._shared_store.publish(game_uuid, self._current_games[game_uuid])
+        self._hibernate_cold()
+        return game_uuid, game_term_password
+
+    async def add_game(self, owner: str, time_control: Optional[Tuple[float, float]] = None) -> Tuple[str, str, str]:
+        """
+        Asks the database to create a new game.
+
+        :param owner: username of the owner
+        :param time_control: (base, increment) in seconds for a timed game, None for no clock
+        :return: the UUID (universally-unique ID) of the game, termination password, and owner username
+        """
+        game_uuid, game_term_password = self._new_game(owner, time_control)
+        self._queue_write("INSERT INTO games VALUES (?, ?, ?)", (game_uuid, owner, game_term_password))
+        if time_control is not None:
+            self._queue_write("INSERT INTO clocks VALUES (?, ?, ?)", (game_uuid, *time_control))
         return game_uuid, game_term_password, owner
 
-    async def add_player(self, game_id: str, username: str):
-        self._current_games_info[game_id].players.append(username)
-        return 1
+    async def add_games(self, owner: str, pairings: List[List[str]],
+                        time_control: Optional[Tuple[float, float]] = None) -> List[Tuple[str, str]]:
+        """
+        Asks the database to create many games with their players at once, such
+        as a tournament round.  All the games and players are stored by two
+        statements in the next batched commit.
 
-    async def list_games(self) -> List[Tuple[str, int]]:
+        :param owner: username of the owner of every game
+        :param pairings: players of each game in player index order, the first plays white
+        :param time_control: (base, increment) in seconds of every game, None for no clock
+        :return: list of (game UUID, termination password) in the order of pairings
         """
-        Asks the database for a list of all active games.
+        games = []
+        game_rows = []
+        player_rows = []
+        for players in pairings:
+            game_uuid, game_term_password = self._new_game(owner, time_control)
+            self._current_games_info[game_uuid].players.extend(players)
+            for username in players:
+                self._index.add_player(game_uuid, username)
+            games.append((game_uuid, game_term_password))
+            game_rows.append((game_uuid, owner, game_term_password))
+            player_rows.extend((game_uuid, idx, username) for idx, username in enumerate(players))
+        self._queue_writes("INSERT INTO games VALUES (?, ?, ?)", game_rows)
+        self._queue_writes("INSERT INTO players VALUES (?, ?, ?)", player_rows)
+        if time_control is not None:
+            self._queue_writes("INSERT INTO clocks VALUES (?, ?, ?)",
+                               [(game_uuid, *time_control) for game_uuid, game_term_password in games])
+        return games
 
+    async def add_player(self, game_id: str, username: str) -> int:
+        """
+        Asks the database to add a player to a game.
+
+        :return: the index of the new player
+        """
+        players = self._current_games_info[game_id].players
+        players.append(username)
+        self._index.add_player(game_id, username)
+        self._queue_write("INSERT INTO players VALUES (?, ?, ?)", (game_id, len(players) - 1, username))
+        return len(players) - 1
+
+    async def list_games(self, owner: Optional[str] = None, player: Optional[str] = None,
+                         before: Optional[int] = None, limit: Optional[int] = None) -> List[Tuple[str, int]]:
+        """
+        Asks the database for a list of active games, newest first.
+
+        :param owner: only list the games of this owner
+        :param player: only list the games this user plays in
+        :param before: cursor from page_games, only list games created before it
+        :param limit: largest number of games returned, None for all of them
         :return: list of (game_id, number of players in game)
         """
-        await asyncio.sleep(self._QUERY_TIME)  # simulate query time
-        return [(game_id, game.num_players) for game_id, game in self._current_games.items()]
+        if limit is None:
+            limit = len(self._current_games_info)
+        game_ids, cursor = self._index.page(owner, player, before, limit)
+        return [(game_id, len(self._current_games_info[game_id].players)) for game_id in game_ids]
+
+    async def page_games(self, owner: Optional[str] = None, player: Optional[str] = None,
+                         before: Optional[int] = None,
+                         limit: int = 50) -> Tuple[List[Tuple[str, ChessGameInfo]], Optional[int]]:
+        """
+        Asks the database for one page of active games, newest first, using the owner and player indexes.
+
+        :param owner: only list the games of this owner
+        :param player: only list the games this user plays in
+        :param before: cursor returned with the previous page, None for the first page
+        :param limit: largest number of games returned
+        :return: (list of (game_id, game info), cursor of the next page or None after the last page)
+        """
+        game_ids, cursor = self._index.page(owner, player, before, limit)
+        return [(game_id, self._current_games_info[game_id]) for game_id in game_ids], cursor
 
     async def game_info(self, game_id: str):
         """
@@ -56,7 +766,6 @@ class AsyncChessGameDB(object):
 
         :return: list of (player owner, players in game)
         """
-        await asyncio.sleep(self._QUERY_TIME)  # simulate query time
         return self._current_games_info[game_id].owner, self._current_games_info[game_id].players
 
     async def get_game(self, game_id: str) -> Union[ChessGame, None]:
@@ -66,25 +775,590 @@ class AsyncChessGameDB(object):
         :param game_id: the UUID of the specific game
         :return: None if the game was not found, otherwise pointer to the Blackjack object
         """
-        await asyncio.sleep(self._QUERY_TIME)  # simulate query time
-        return self._current_games.get(game_id, None)
+        try:
+            return self._resident(game_id)
+        except KeyError:
+            return None
+
+    def _touch(self, game_id: str):
+        self._current_games.move_to_end(game_id)
+        if self._idle_timeout is not None:
+            self._last_used[game_id] = time.monotonic()
+
+    def _resident(self, game_id: str) -> ChessGame:
+        """
+        Gets a decoded game, rehydrating it if it was hibernated, and marks it as recently used.
+
+        :raises: KeyError if the game does not exist
+        :param game_id: the UUID of the specific game
+        :return: the ChessGame
+        """
+        game = self._current_games.get(game_id, None)
+        if game is None:
+            game = ChessGame.decode(self._hibernated.pop(game_id))
+            self._current_games[game_id] = game
+            self._hibernation_counters['rehydrations'] += 1
+        self._touch(game_id)
+        self._hibernate_cold()
+        return game
+
+    def _hibernate_cold(self):
+        """
+        Hibernates the least recently used games beyond max_resident_games and
+        the games unused for idle_timeout.  Games with queued commands or
+        subscribers stay decoded.
+
+        :return: None
+        """
+        if (self._max_resident_games is None and self._idle_timeout is None) or not self._current_games:
+            return
+        excess = len(self._current_games) - self._max_resident_games if self._max_resident_games is not None else 0
+        expired_before = time.monotonic() - self._idle_timeout if self._idle_timeout is not None else None
+        cold = []
+        # the most recently used game is never hibernated, its caller is about to use it
+        for game_id in itertools.islice(self._current_games, len(self._current_games) - 1):
+            if len(cold) >= excess and (expired_before is None or self._last_used[game_id] >= expired_before):
+                break
+            actor = self._actors.get(game_id, None)
+            if (actor is None or actor.idle()) and game_id not in self._broadcasters:
+                cold.append(game_id)
+        for game_id in cold:
+            self._hibernated[game_id] = self._current_games.pop(game_id).encode()
+            self._last_used.pop(game_id, None)
+            self._actors.pop(game_id, None)
+            self._state_cache.pop(game_id, None)
+        self._hibernation_counters['hibernations'] += len(cold)
+
+    def hibernation_stats(self) -> Dict[str, int]:
+        """
+        Gets the hibernation counters
+
+        :return: dict of resident and hibernated game counts, and the number of hibernations and
+            rehydrations so far
+        """
+        return {'resident': len(self._current_games), 'hibernated': len(self._hibernated),
+                **self._hibernation_counters}
+
+    async def game_state(self, game_id: str) -> Tuple[str, bytes]:
+        """
+        Asks the database for the serialized state of a game (see
+        game_broadcast.state_document).  The document is only rebuilt after
+        the position changed, repeated requests reuse the cached bytes.
+
+        :raises: KeyError if the game does not exist
+        :param game_id: the UUID of the specific game
+        :return: (ETag, JSON document)
+        """
+        game = self._resident(game_id)
+        cached = self._state_cache.get(game_id, None)
+        if cached is not None and cached[0] == game.current_turn and cached[1] == game.board.position_hash:
+            return cached[2], cached[3]
+        board = game.encode_board()
+        winner = game.who_won()
+        etag = state_etag(game.current_turn, board, winner)
+        document = state_document(game_id, game.current_turn, board,
+                                  game.last_move_code() if game.current_turn else None, winner)
+        self._state_cache[game_id] = (game.current_turn, game.board.position_hash, etag, document)
+        return etag, document
+
+    def _actor(self, game_id: str) -> GameActor:
+        """
+        Gets the actor that serializes the commands of a game, creating it on first use.
+
+        :raises: KeyError if the game does not exist
+        :param game_id: the UUID of the specific game
+        :return: the game's GameActor
+        """
+        actor = self._actors.get(game_id, None)
+        if actor is None:
+            actor = GameActor(game_id, self._resident(game_id))
+            self._actors[game_id] = actor
+        else:
+            # games with an actor are always decoded
+            self._touch(game_id)
+        return actor
+
+    async def run_in_game(self, game_id: str, command: Callable[[ChessGame], Any]) -> Any:
+        """
+        Runs a command on a game after every command submitted to it before.
+
+        :param game_id: the UUID of the specific game
+        :param command: function (or coroutine function) called with the ChessGame
+        :return: what the command returned
+        """
+        return await self._actor(game_id).submit(command)
+
+    def subscribe(self, game_id: str) -> Subscription:
+        """
+        Follows a game: a snapshot of the position, then every accepted move
+        and the end of the game are delivered to the returned Subscription as
+        serialized events, in the order they happened.
+
+        :raises: KeyError if the game does not exist
+        :param game_id: the UUID of the specific game
+        :return: the Subscription receiving the game's events
+        """
+        broadcaster = self._broadcasters.get(game_id, None)
+        if broadcaster is None:
+            broadcaster = GameBroadcaster(game_id, self._resident(game_id))
+            self._broadcasters[game_id] = broadcaster
+        return broadcaster.subscribe()
+
+    def unsubscribe(self, game_id: str, subscription: Subscription):
+        """
+        Stops following a game.
+
+        :param game_id: the UUID of the specific game
+        :param subscription: the Subscription returned by subscribe
+        :return: None
+        """
+        broadcaster = self._broadcasters.get(game_id, None)
+        if broadcaster is not None:
+            broadcaster.unsubscribe(subscription)
+            if not len(broadcaster):
+                del self._broadcasters[game_id]
+
+    def _play_move(self, game_id: str, game: ChessGame, player_idx: int, player_move: str) -> bool:
+        # finished games take no more moves, so their stored moves match the recorded result
+        if game.is_over():
+            return False
+        # a move arriving after the flag fell is rejected and the game adjudicated now
+        if self._adjudicate_clock(game_id, game) or not game.get_move(player_idx, player_move):
+            return False
+        game.execute_move(player_idx)
+        self._queue_log(game_id, game.current_turn - 1, game.last_move_code())
+        if game.clock is not None:
+            self._queue_write("INSERT OR REPLACE INTO clock_times VALUES (?, ?, ?, ?)",
+                              (game_id, game.current_turn, *game.clock.remaining))
+        self._schedule_clock(game_id, game)
+        if game.who_won():
+            self._record_result(game_id, game)
+        if self._shared_store is not None:
+            self._shared_store.publish(game_id, game)
+        played_move = game.move.format_move(game.move.current_move)
+        broadcaster = self._broadcasters.get(game_id, None)
+        if broadcaster is not None:
+            broadcaster.publish_move(game, player_idx, played_move)
+        if game_id in self._premoves:
+            self._play_premove(game_id, game, 1 - player_idx, played_move)
+        return True
+
+    def _play_premove(self, game_id: str, game: ChessGame, player_idx: int, opponent_move: str):
+        """
+        Plays the reply a player queued for the move the opponent just made, in
+        the same actor command as that move.  The rest of the matching line
+        stays queued; any other opponent move abandons the player's tree.
+
+        :return: None
+        """
+        premoves = self._premoves[game_id]
+        tree = premoves.pop(player_idx, None)
+        if game.who_won():
+            del self._premoves[game_id]
+            return
+        if not premoves:
+            del self._premoves[game_id]
+        if tree is None:
+            return
+        branch = tree.get(opponent_move, tree.get('*', None))
+        if branch is None:
+            return
+        # queued before the reply is played, the opponent's own premove may answer it right away
+        if branch.get('then'):
+            self._premoves.setdefault(game_id, {})[player_idx] = branch['then']
+        if not self._play_move(game_id, game, player_idx, branch['reply']):
+            remaining = self._premoves.get(game_id, {})
+            remaining.pop(player_idx, None)
+            if not remaining:
+                self._premoves.pop(game_id, None)
+
+    async def set_premoves(self, game_id: str, player_idx: int, premoves: Dict[str, Any]) -> bool:
+        """
+        Queues a player's replies to the opponent's next moves, replacing what the
+        player queued before.  When the opponent moves, the matching reply is
+        played immediately, without waiting for another request.
+
+        :param game_id: the UUID of the specific game
+        :param player_idx: index of the player queueing the moves
+        :param premoves: conditional move tree: the opponent's move (or '*' for any move) ->
+            {'reply': the player's answer, 'then': tree for the opponent's following move}; empty to clear
+        :return: False if the game is over or it is already the player's turn
+        """
+        return await self.run_in_game(
+            game_id, lambda game: self._queue_premoves(game_id, game, player_idx, premoves))
+
+    @staticmethod
+    def _waiting_seat(game: ChessGame, seats: List[int]) -> int:
+        """
+        :param seats: indexes of the players held by one user
+        :return: the seat that user queues replies for, the side waiting for its opponent when the user
+            holds both, the counterpart of _seat
+        """
+        return next((idx for idx in seats if game.players[idx].turn != game.current_turn % 2), seats[0])
+
+    async def set_user_premoves(self, username: str, game_id: str, premoves: Dict[str, Any]) -> str:
+        """
+        Same as set_premoves for the seat of a user, chosen when the command runs
+        like make_moves does.
+
+        :param username: the player queueing the moves
+        :return: 'queued', 'invalid' (game over or already the user's turn), 'not_player' or 'not_found'
+        """
+        info = self._current_games_info.get(game_id, None)
+        if info is None:
+            return 'not_found'
+        seats = [seat for seat, player in enumerate(info.players) if player == username]
+        if not seats:
+            return 'not_player'
+        try:
+            queued = await self.run_in_game(game_id, lambda game: self._queue_premoves(
+                game_id, game, self._waiting_seat(game, seats), premoves))
+        except KeyError:
+            # deleted while the command was queued
+            return 'not_found'
+        return 'queued' if queued else 'invalid'
+
+    def _queue_premoves(self, game_id: str, game: ChessGame, player_idx: int, premoves: Dict[str, Any]) -> bool:
+        if game.who_won() or game.current_turn % 2 == game.players[player_idx].turn:
+            return False
+        if premoves:
+            self._premoves.setdefault(game_id, {})[player_idx] = premoves
+        elif game_id in self._premoves:
+            self._premoves[game_id].pop(player_idx, None)
+            if not self._premoves[game_id]:
+                del self._premoves[game_id]
+        return True
+
+    async def get_premoves(self, game_id: str, player_idx: int) -> Dict[str, Any]:
+        """
+        Asks the database for the moves a player has queued.
+
+        :return: the player's conditional move tree, see set_premoves
+        """
+        return self._premoves.get(game_id, {}).get(player_idx, {})
+
+    async def get_user_premoves(self, username: str, game_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Same as get_premoves for the seat set_user_premoves queues for.
+
+        :raises: KeyError if the game does not exist
+        :param username: the player who queued the moves
+        :return: the conditional move tree, None if the user is not a player of the game
+        """
+        seats = [seat for seat, player in enumerate(self._current_games_info[game_id].players) if player == username]
+        if not seats:
+            return None
+        return await self.get_premoves(game_id, self._waiting_seat(self._resident(game_id), seats))
+
+    def _record_result(self, game_id: str, game: ChessGame):
+        """
+        Stores the result of a game that just ended, once per game.  Finished
+        games take no more moves, so the result covers every stored move.
+
+        :return: None
+        """
+        if game_id in self._finished:
+            return
+        self._finished.add(game_id)
+        players = self._current_games_info[game_id].players
+        self._queue_write("INSERT INTO results (game_id, white, black, result, finished, moves) "
+                          "VALUES (?, ?, ?, ?, ?, ?)",
+                          (game_id, players[0] if players else None, players[1] if len(players) > 1 else None,
+                           game_result(game), time.time(), game.encode_moves()))
+
+    async def results_after(self, after: int, limit: int = 1000) -> List[Tuple[int, str, str, str]]:
+        """
+        Asks the database for the results of the games that finished after a
+        point, oldest first, such as to update ratings.  Only committed results
+        are returned, so a consumer that stores the last seq sees each one once.
+
+        :param after: seq of the last result already seen, 0 for the first
+        :param limit: largest number of results returned
+        :return: list of (seq, white player, black player, result as returned by game_result)
+        """
+        return await self._query("SELECT seq, white, black, result FROM results WHERE seq > ? ORDER BY seq LIMIT ?",
+                                 (after, limit))
+
+    async def _query(self, sql: str, params: tuple) -> List[tuple]:
+        # reads share the connection with the batched writes, so they wait for a running flush
+        async with self._flush_lock:
+            return await asyncio.to_thread(lambda: self._conn.execute(sql, params).fetchall())
+
+    async def export_results(self, player: Optional[str] = None, since: Optional[float] = None,
+                             until: Optional[float] = None, batch_size: int = 500) -> AsyncIterator[tuple]:
+        """
+        Streams the finished games from the results table, oldest first.  Rows
+        are read batch_size at a time, resuming after the last seq read, so an
+        export of any size holds one batch in memory.
+
+        :param player: only games this user played, with either color
+        :param since: only games finished at or after this time.time() timestamp
+        :param until: only games finished before this time.time() timestamp
+        :param batch_size: rows read from SQLite at once
+        :return: async iterator of (seq, game_id, white, black, result, finished, moves), see game_export
+        """
+        conditions = []
+        params = []
+        if player is not None:
+            conditions.append("(white = ? OR black = ?)")
+            params += [player, player]
+        if since is not None:
+            conditions.append("finished >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("finished < ?")
+            params.append(until)
+        sql = "SELECT seq, game_id, white, black, result, finished, moves FROM results WHERE seq > ? " + \
+            ''.join(f"AND {condition} " for condition in conditions) + "ORDER BY seq LIMIT ?"
+        after = 0
+        while True:
+            rows = await self._query(sql, (after, *params, batch_size))
+            for row in rows:
+                yield row
+            if len(rows) < batch_size:
+                return
+            after = rows[-1][0]
+
+    def _schedule_clock(self, game_id: str, game: ChessGame):
+        deadline = game.clock.deadline() if game.clock is not None else None
+        if deadline is None:
+            self._clock_wheel.cancel(game_id)
+        else:
+            self._clock_wheel.schedule(game_id, deadline)
+
+    def _adjudicate_clock(self, game_id: str, game: ChessGame) -> bool:
+        """
+        Ends the game as a loss on time if the side to move ran out of time,
+        storing and publishing the result.
+
+        :return: True if the game is lost on time, now or before
+        """
+        if game.clock is None:
+            return False
+        if game.clock.flagged is not None:
+            return True
+        if game.who_won() or game.clock.flag_fallen() is None:
+            return False
+        game.flag_fall()
+        self._clock_wheel.cancel(game_id)
+        self._queue_log(game_id, game.current_turn, self._TIMEOUT_CODE)
+        self._record_result(game_id, game)
+        # the position did not change, only the winner did
+        self._state_cache.pop(game_id, None)
+        if self._shared_store is not None:
+            self._shared_store.publish(game_id, game)
+        broadcaster = self._broadcasters.get(game_id, None)
+        if broadcaster is not None:
+            broadcaster.publish_game_over(game, 'time')
+        return True
+
+    def start_clocks(self):
+        """
+        Starts the task that adjudicates timeouts, call it once the event loop runs.
+
+        :return: None
+        """
+        if self._clock_task is None or self._clock_task.done():
+            self._clock_task = asyncio.get_running_loop().create_task(self._run_clocks())
+
+    async def _run_clocks(self):
+        while True:
+            await asyncio.sleep(self._clock_wheel.tick)
+            try:
+                expired = self._clock_wheel.advance(time.time())
+                results = await asyncio.gather(*[self.check_clock(game_id) for game_id in expired],
+                                               return_exceptions=True)
+            except Exception:
+                logger.exception("Advancing the chess clocks failed")
+                continue
+            # a game that fails to be adjudicated must not stop the clocks of the others
+            for game_id, result in zip(expired, results):
+                if isinstance(result, Exception):
+                    logger.error("Adjudicating the clock of game %s failed", game_id, exc_info=result)
+
+    async def check_clock(self, game_id: str) -> bool:
+        """
+        Adjudicates a loss on time after every command already submitted to the game.
+
+        :param game_id: the UUID of the specific game
+        :return: True if the game is lost on time, False if it is not or the game does not exist
+        """
+        if game_id not in self._current_games_info:
+            return False
+
+        def adjudicate(game: ChessGame) -> bool:
+            if self._adjudicate_clock(game_id, game):
+                return True
+            # the deadline may have moved since it was scheduled, such as after a takeback
+            self._schedule_clock(game_id, game)
+            return False
+
+        try:
+            return await self.run_in_game(game_id, adjudicate)
+        except KeyError:
+            # deleted while the check was queued
+            return False
+
+    async def clock_state(self, game_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Asks the database for the clock of a game.
+
+        :raises: KeyError if the game does not exist
+        :param game_id: the UUID of the specific game
+        :return: None for untimed games, otherwise dict of the time control, the seconds left of
+            each side and the side whose clock is running
+        """
+        game = self._resident(game_id)
+        clock = game.clock
+        if clock is None:
+            return None
+        now = time.time()
+        return {'base': clock.base, 'increment': clock.increment,
+                'white': max(clock.remaining_time(0, now), 0.0), 'black': max(clock.remaining_time(1, now), 0.0),
+                'running': None if clock.running is None else ('white', 'black')[clock.running],
+                'flagged': None if clock.flagged is None else ('white', 'black')[clock.flagged]}
+
+    async def make_move(self, game_id: str, player_idx: int, player_move: str) -> bool:
+        """
+        Asks the database to play a move in a game and store it.  Moves on the
+        same game are applied in the order they were requested.
+
+        :param game_id: the UUID of the specific game
+        :param player_idx: index of the player making the move
+        :param player_move: the move in simple chess notation, such as 'e2e4'
+        :return: True if the move was played, False if it was not valid
+        """
+        return await self.run_in_game(
+            game_id, lambda game: self._play_move(game_id, game, player_idx, player_move))
+
+    @staticmethod
+    def _seat(game: ChessGame, seats: List[int]) -> int:
+        """
+        :param seats: indexes of the players held by one user
+        :return: the seat that user moves with, the side to move when the user holds both,
+            such as when playing against themselves
+        """
+        return next((idx for idx in seats if game.players[idx].turn == game.current_turn % 2), seats[0])
+
+    async def make_moves(self, username: str, moves: List[Tuple[str, str]]) -> List[str]:
+        """
+        Asks the database to play moves of one user on many games at once.
+        Different games are played concurrently, moves on the same game in
+        the order they are listed.  The first move of every game with no
+        command queued is checked against the current position up front, in one
+        validate_moves batch: rejected moves are answered without going through
+        the game actor, accepted ones find their result in the move cache there.
+
+        :param username: the player making the moves
+        :param moves: list of (game_id, move) where move is in simple chess notation
+        :return: list of results in the same order as moves: 'played', 'invalid'
+            (illegal or out of turn), 'not_player' or 'not_found'
+        """
+        results: List[Optional[str]] = [None] * len(moves)
+        checked = []
+        pending = []
+        first_moves = set()
+        for idx, (game_id, player_move) in enumerate(moves):
+            info = self._current_games_info.get(game_id, None)
+            actor = self._actors.get(game_id, None)
+            if game_id in first_moves or info is None or username not in info.players or \
+                    (actor is not None and not actor.idle()):
+                continue
+            first_moves.add(game_id)
+            seats = [seat for seat, player in enumerate(info.players) if player == username]
+            checked.append(idx)
+            pending.append((game_id, self._seat(self._resident(game_id), seats), player_move))
+        for idx, valid in zip(checked, await self.validate_moves(pending)):
+            if not valid:
+                results[idx] = 'invalid'
+
+        async def play(idx: int, game_id: str, player_move: str) -> str:
+            if results[idx] is not None:
+                return results[idx]
+            info = self._current_games_info.get(game_id, None)
+            if info is None:
+                return 'not_found'
+            seats = [seat for seat, player in enumerate(info.players) if player == username]
+            if not seats:
+                return 'not_player'
+            try:
+                played = await self.run_in_game(
+                    game_id, lambda game: self._play_move(game_id, game, self._seat(game, seats), player_move))
+            except KeyError:
+                # deleted while the move was queued
+                return 'not_found'
+            return 'played' if played else 'invalid'
+
+        return list(await asyncio.gather(*[play(idx, game_id, player_move)
+                                           for idx, (game_id, player_move) in enumerate(moves)]))
+
+    async def validate_moves(self, pending: List[Tuple[str, int, str]]) -> List[bool]:
+        """
+        Asks the database to validate the pending moves of many games in one batch.
+
+        :param pending: list of (game_id, player_idx, move) where move is in simple chess notation
+        :return: list of results in the same order as pending, False for unknown games or players,
+            finished games or malformed moves
+        """
+        results = [False] * len(pending)
+        requests = []
+        request_idx = []
+        for idx, (game_id, player_idx, player_move) in enumerate(pending):
+            if player_idx not in (0, 1):
+                continue
+            game = await self.get_game(game_id)
+            if game is None or game.is_over() or game.current_turn % 2 != game.players[player_idx].turn:
+                continue
+            raw_move = game.move.get_move(player_move)
+            if not game.move.is_move_valid(raw_move):
+                continue
+            move = game.move.interpret_move(raw_move)
+            piece = game.board.squares[move[0]][move[1]].get_piece()
+            if piece is None or piece.is_white != game.players[player_idx].is_white:
+                continue
+            requests.append((game.board, move))
+            request_idx.append(idx)
+        if requests:
+            batch_results = Move().valid_piece_moves(requests)
+            for idx, result in zip(request_idx, batch_results):
+                results[idx] = result
+        return results
 
     async def del_game(self, game_id: str, term_pass: str, attempter: str) -> bool:
         """
-        Asks the database to terminate a specific game.
+        Asks the database to terminate a specific game.  The game is removed by
+        its actor, after the commands already submitted to it; the ones
+        submitted later fail as for an unknown game.
 
         :param game_id: the UUID of the specific game
         :param term_pass: the termination password for the game
         :param attempter: the username of the person attempting the delete
         :return: False or exception if not found, True if success
         """
-        try:
-            await asyncio.sleep(self._QUERY_TIME)  # simulate query time
-            if self._current_games_info[game_id].termination_password == term_pass \
-                    and self._current_games_info[game_id].owner == attempter:
-                del self._current_games[game_id]
-                return True
-            else:
+        def remove(game: ChessGame) -> bool:
+            if self._current_games_info[game_id].termination_password != term_pass \
+                    or self._current_games_info[game_id].owner != attempter:
                 raise HTTPException(status.HTTP_401_UNAUTHORIZED, "user not authorized")
+            info = self._current_games_info.pop(game_id)
+            self._current_games.pop(game_id, None)
+            self._hibernated.pop(game_id, None)
+            self._last_used.pop(game_id, None)
+            self._index.remove_game(game_id, info.owner, info.players)
+            self._actors.pop(game_id).closed = True
+            self._state_cache.pop(game_id, None)
+            self._clock_wheel.cancel(game_id)
+            self._premoves.pop(game_id, None)
+            self._finished.discard(game_id)
+            broadcaster = self._broadcasters.pop(game_id, None)
+            if broadcaster is not None:
+                broadcaster.close()
+            if self._shared_store is not None:
+                self._shared_store.remove(game_id)
+            for table in ('players', 'clocks', 'clock_times', 'games'):
+                self._queue_write(f"DELETE FROM {table} WHERE game_id = ?", (game_id,))
+            return True
+
+        try:
+            return await self.run_in_game(game_id, remove)
         except KeyError:
             raise HTTPException(status.HTTP_404_NOT_FOUND, "game_id not found")
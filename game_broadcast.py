@@ -0,0 +1,259 @@
+from typing import List, Optional, Set, Deque
+from collections import deque
+from chess.chess import ChessGame, MOVE_TO_SHIFT
+import asyncio
+import json
+import zlib
+
+# FEN letter of each 4-bit piece code of ChessGame.encode_board, code 0 is an empty square
+PIECE_LETTERS = ' kqrbnpKQRBNP'
+# name of square x * 8 + y, row 0 is rank 8
+SQUARE_NAMES = [column + row for row in '87654321' for column in 'abcdefgh']
+
+
+def board_diff(before: bytes, after: bytes) -> List[List[str]]:
+    """
+    Lists the squares whose piece changed between two ChessGame.encode_board results
+
+    :param before: the board before the move
+    :param after: the board after the move
+    :return: list of [square name, FEN letter of the new piece or '' if it is now empty]
+    """
+    changes = []
+    for idx, (old, new) in enumerate(zip(before, after)):
+        if old == new:
+            continue
+        for half in range(2):
+            code = (new >> (4 * half)) & 0xF
+            if (old >> (4 * half)) & 0xF != code:
+                changes.append([SQUARE_NAMES[idx * 2 + half], PIECE_LETTERS[code].strip()])
+    return changes
+
+
+def board_fen(board: bytes) -> str:
+    """
+    Converts a ChessGame.encode_board result into the piece placement field of a FEN string
+
+    :param board: 32 bytes of 4-bit square codes
+    :return: such as 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR'
+    """
+    rows = []
+    for x in range(8):
+        row = ''
+        empty = 0
+        for y in range(8):
+            code = (board[(x * 8 + y) // 2] >> (4 * (y % 2))) & 0xF
+            if code == 0:
+                empty += 1
+                continue
+            if empty:
+                row += str(empty)
+                empty = 0
+            row += PIECE_LETTERS[code]
+        rows.append(row + (str(empty) if empty else ''))
+    return '/'.join(rows)
+
+
+def move_name(code: int) -> str:
+    """
+    Converts a 16-bit move code (see ChessGame.encode_move) to simple chess notation
+
+    :param code: 16-bit move code
+    :return: String such as 'e2e4'
+    """
+    return SQUARE_NAMES[code & 0x3F] + SQUARE_NAMES[(code >> MOVE_TO_SHIFT) & 0x3F]
+
+
+def state_etag(turn: int, board: bytes, winner: str = '') -> str:
+    """
+    Gets the ETag of a game state document, it changes whenever a move is played
+    or taken back, and when a game ends without a move, such as on time
+
+    :param turn: number of moves played
+    :param board: ChessGame.encode_board result
+    :param winner: ChessGame.who_won result
+    :return: quoted ETag
+    """
+    return f'"{turn}-{zlib.crc32(winner.encode(), zlib.crc32(board)):08x}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    :param if_none_match: the If-None-Match request header
+    :param etag: the current ETag
+    :return: True if the client already has the current version
+    """
+    if if_none_match is None:
+        return False
+    tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+    return etag in tags or '*' in tags
+
+
+def state_document(game_id: str, turn: int, board: bytes, last_move: Optional[int], winner: str) -> bytes:
+    """
+    Serializes the state of a game as returned by GET /game/{game_id}/state
+
+    :param game_id: the UUID of the game
+    :param turn: number of moves played
+    :param board: ChessGame.encode_board result
+    :param last_move: 16-bit code of the last move, None before the first move
+    :param winner: ChessGame.who_won result
+    :return: the JSON document
+    """
+    return json.dumps({'game_id': game_id, 'turn': turn, 'side_to_move': 'black' if turn % 2 else 'white',
+                       'board': board_fen(board), 'last_move': move_name(last_move) if last_move is not None else None,
+                       'winner': winner}).encode()
+
+
+class Subscription(object):
+    """
+    One client following a GameBroadcaster.  At most max_pending serialized
+    events wait for the client; when a slow client falls further behind, its
+    backlog is replaced by one snapshot of the current position, so lagging
+    clients cost bounded memory and never hold up the game.
+    """
+
+    def __init__(self, broadcaster: 'GameBroadcaster', max_pending: int):
+        self._broadcaster = broadcaster
+        self._pending: Deque[str] = deque()
+        self._max_pending = max_pending
+        self._ready = asyncio.Event()
+        self._closed = False
+        # events replaced by snapshots because the client was too slow
+        self.dropped = 0
+
+    def _push(self, message: str):
+        if len(self._pending) >= self._max_pending:
+            # the snapshot already includes the effect of this message and of the dropped backlog
+            self.dropped += len(self._pending) + 1
+            self._pending.clear()
+            message = self._broadcaster.snapshot()
+        self._pending.append(message)
+        self._ready.set()
+
+    def send(self, event: dict):
+        """
+        Queues an event for this client only, such as an error reply.
+
+        :param event: the event, serialized as JSON
+        :return: None
+        """
+        self._push(json.dumps(event))
+
+    def _close(self, message: str):
+        # the final message is never coalesced away
+        self._pending.append(message)
+        self._closed = True
+        self._ready.set()
+
+    async def get(self) -> Optional[str]:
+        """
+        Waits for the next event.
+
+        :return: the event serialized as JSON, or None once the game was terminated and every event was read
+        """
+        while not self._pending:
+            if self._closed:
+                return None
+            self._ready.clear()
+            await self._ready.wait()
+        return self._pending.popleft()
+
+
+class GameBroadcaster(object):
+    """
+    Fans the events of one game out to its players and spectators.  Each move
+    is serialized once, as the list of squares it changed, and the same string
+    is handed to every subscriber, so the cost of a move does not grow with
+    the number of spectators.  New subscribers first receive a snapshot of the
+    position, which is cached until the next move.
+    """
+
+    def __init__(self, game_id: str, game: ChessGame, max_pending: int = 64):
+        """
+        :param game_id: the UUID of the game
+        :param game: the game, only read to take the initial position
+        :param max_pending: events each subscriber may have waiting before it is coalesced
+        """
+        self.game_id = game_id
+        self._board = game.encode_board()
+        self._turn = game.current_turn
+        self._winner = game.who_won()
+        self._max_pending = max_pending
+        self._subscribers: Set[Subscription] = set()
+        self._snapshot: Optional[str] = None
+
+    def __len__(self) -> int:
+        return len(self._subscribers)
+
+    def snapshot(self) -> str:
+        """
+        :return: the current position as a serialized snapshot event
+        """
+        if self._snapshot is None:
+            self._snapshot = json.dumps({'type': 'snapshot', 'game_id': self.game_id, 'turn': self._turn,
+                                         'board': board_fen(self._board), 'winner': self._winner})
+        return self._snapshot
+
+    def subscribe(self) -> Subscription:
+        """
+        Adds a subscriber, whose first event is a snapshot of the position.
+
+        :return: the new Subscription
+        """
+        subscription = Subscription(self, self._max_pending)
+        subscription._push(self.snapshot())
+        self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        self._subscribers.discard(subscription)
+
+    def _publish(self, message: str):
+        for subscription in self._subscribers:
+            subscription._push(message)
+
+    def publish_move(self, game: ChessGame, player_idx: int, player_move: str):
+        """
+        Sends a move that was just played on the game to every subscriber.
+
+        :param game: the game after the move
+        :param player_idx: index of the player who moved
+        :param player_move: the move in simple chess notation
+        :return: None
+        """
+        board = game.encode_board()
+        changes = board_diff(self._board, board)
+        self._board = board
+        self._turn = game.current_turn
+        self._winner = game.who_won()
+        self._snapshot = None
+        self._publish(json.dumps({'type': 'move', 'game_id': self.game_id, 'player': player_idx,
+                                  'move': player_move, 'turn': self._turn, 'changes': changes,
+                                  'winner': self._winner}))
+        if self._winner:
+            self._publish(json.dumps({'type': 'game_over', 'game_id': self.game_id, 'winner': self._winner}))
+
+    def publish_game_over(self, game: ChessGame, reason: str):
+        """
+        Sends the end of a game that ended without a move, such as a loss on time, to every subscriber.
+
+        :param game: the game after it ended
+        :param reason: why the game ended, such as 'time'
+        :return: None
+        """
+        self._winner = game.who_won()
+        self._snapshot = None
+        self._publish(json.dumps({'type': 'game_over', 'game_id': self.game_id, 'winner': self._winner,
+                                  'reason': reason}))
+
+    def close(self):
+        """
+        Tells every subscriber the game was terminated and ends their subscriptions.
+
+        :return: None
+        """
+        message = json.dumps({'type': 'terminated', 'game_id': self.game_id})
+        for subscription in self._subscribers:
+            subscription._close(message)
+        self._subscribers.clear()
@@ -0,0 +1,109 @@
+from typing import AsyncIterator, List, Optional, Tuple
+from array import array
+from datetime import date, datetime, timedelta, timezone
+from game_broadcast import move_name
+import json
+
+# a finished game as stored in the results table: seq, game_id, white, black, result, finished, moves
+FinishedGame = Tuple[int, str, str, str, str, float, bytes]
+
+EXPORT_MEDIA_TYPES = {'pgn': 'application/x-chess-pgn', 'ndjson': 'application/x-ndjson'}
+# PGN export format keeps movetext lines under 80 characters
+PGN_LINE_LENGTH = 79
+
+
+def export_range(since: Optional[date], until: Optional[date]) -> Tuple[Optional[float], Optional[float]]:
+    """
+    Converts an inclusive range of UTC days into timestamps
+
+    :param since: first day, None for no lower bound
+    :param until: last day, None for no upper bound
+    :return: (first timestamp included, first timestamp excluded) as used by AsyncChessGameDB.export_results
+    """
+    def midnight(day: date) -> float:
+        return datetime(day.year, day.month, day.day, tzinfo=timezone.utc).timestamp()
+
+    return (midnight(since) if since is not None else None,
+            midnight(until + timedelta(days=1)) if until is not None else None)
+
+
+def game_moves(moves: bytes) -> List[str]:
+    """
+    :param moves: ChessGame.encode_moves result
+    :return: the moves in simple chess notation, such as ['e2e3', 'e7e6']
+    """
+    codes = array('H')
+    codes.frombytes(moves)
+    return [move_name(code) for code in codes]
+
+
+def _pgn_tag(name: str, value: str) -> str:
+    value = (value if value is not None else '?').replace('\\', '\\\\').replace('"', '\\"')
+    return f'[{name} "{value}"]\n'
+
+
+def pgn_game(game: FinishedGame) -> str:
+    """
+    Formats a finished game as PGN.  The server has no SAN generator, so the
+    movetext uses the long coordinate form of the moves, such as 1. e2e3 e7e6.
+
+    :param game: row of the results table
+    :return: the tag pairs, the movetext and a blank line separating it from the next game
+    """
+    seq, game_id, white, black, result, finished, moves = game
+    tags = _pgn_tag('Event', 'Chess Server game') + _pgn_tag('Site', '?') + \
+        _pgn_tag('Date', datetime.fromtimestamp(finished, timezone.utc).strftime('%Y.%m.%d')) + \
+        _pgn_tag('Round', '-') + _pgn_tag('White', white) + _pgn_tag('Black', black) + \
+        _pgn_tag('Result', result) + _pgn_tag('GameId', game_id)
+    tokens = []
+    for idx, move in enumerate(game_moves(moves)):
+        tokens.append(f'{idx // 2 + 1}. {move}' if idx % 2 == 0 else move)
+    tokens.append(result)
+    lines = []
+    line = ''
+    for token in tokens:
+        if line and len(line) + 1 + len(token) > PGN_LINE_LENGTH:
+            lines.append(line)
+            line = token
+        else:
+            line = f'{line} {token}' if line else token
+    lines.append(line)
+    return tags + '\n' + '\n'.join(lines) + '\n\n'
+
+
+def ndjson_game(game: FinishedGame) -> str:
+    """
+    Formats a finished game as one line of newline-delimited JSON.
+
+    :param game: row of the results table
+    :return: the JSON object followed by a newline
+    """
+    seq, game_id, white, black, result, finished, moves = game
+    return json.dumps({'game_id': game_id, 'white': white, 'black': black, 'result': result,
+                       'finished': datetime.fromtimestamp(finished, timezone.utc).isoformat(),
+                       'moves': game_moves(moves)}) + '\n'
+
+
+async def export_chunks(games: AsyncIterator[FinishedGame], export_format: str,
+                        chunk_size: int = 64 * 1024) -> AsyncIterator[bytes]:
+    """
+    Formats a stream of finished games, grouped into chunks of about chunk_size bytes.
+
+    :param games: the finished games, such as from AsyncChessGameDB.export_results
+    :param export_format: 'pgn' or 'ndjson'
+    :param chunk_size: bytes collected before a chunk is sent
+    :return: async iterator of encoded chunks
+    """
+    formatter = pgn_game if export_format == 'pgn' else ndjson_game
+    chunk = []
+    size = 0
+    async for game in games:
+        text = formatter(game)
+        chunk.append(text)
+        size += len(text)
+        if size >= chunk_size:
+            yield ''.join(chunk).encode()
+            chunk = []
+            size = 0
+    if chunk:
+        yield ''.join(chunk).encode()
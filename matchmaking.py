@@ -0,0 +1,240 @@
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pydantic import BaseModel, Field
+from fastapi import HTTPException, status
+from fastapi.responses import JSONResponse
+import asyncio
+import logging
+import math
+import time
+
+logger = logging.getLogger(__name__)
+
+TimeControl = Optional[Tuple[float, float]]
+
+
+class MatchRequest(BaseModel):
+    # players are paired by the rating the server keeps for them, a rating sent by the client is ignored
+    # time control in seconds, untimed without a base; only players asking for the same one are paired
+    base: Optional[float] = Field(None, gt=0)
+    increment: float = Field(0.0, ge=0)
+
+    def time_control(self) -> TimeControl:
+        return (self.base, self.increment) if self.base is not None else None
+
+
+@dataclass
+class MatchTicket:
+    """
+    A player waiting in the matchmaking queue.  match resolves to the
+    player's view of the paired game, see MatchmakingQueue.join.
+    """
+    username: str
+    rating: float
+    time_control: TimeControl
+    joined: float
+    match: asyncio.Future = field(repr=False)
+
+
+class MatchmakingQueue(object):
+    """
+    Pairs players who asked for the same time control and have close ratings.
+    Waiting players are kept in rating buckets of bucket_width points, each
+    bucket in arrival order, so a new player only looks at the oldest ticket
+    of the few buckets around its rating: finding an opponent costs the same
+    with a hundred or a hundred thousand players waiting.  The rating
+    difference a ticket accepts widens the longer it waits, up to max_window.
+    """
+
+    def __init__(self, create_game: Callable[[str, str, TimeControl], Awaitable[Tuple[str, str]]],
+                 bucket_width: float = 50.0, base_window: float = 100.0, widen_rate: float = 10.0,
+                 max_window: float = 400.0, max_unclaimed: int = 10000):
+        """
+        :param create_game: coroutine function called with the white player, the black player and the
+            time control, creates the game with both players and returns its UUID and termination password
+        :param bucket_width: rating points covered by one bucket
+        :param base_window: largest rating difference a new ticket accepts
+        :param widen_rate: rating points the accepted difference grows by per second of waiting
+        :param max_window: largest rating difference any ticket accepts
+        :param max_unclaimed: paired tickets kept until their player claims them, the oldest are dropped beyond that
+        """
+        self._create_game = create_game
+        self._bucket_width = bucket_width
+        self._base_window = base_window
+        self._widen_rate = widen_rate
+        self._max_window = max_window
+        # time control -> bucket -> username -> ticket, oldest first
+        self._pools: Dict[TimeControl, Dict[int, Dict[str, MatchTicket]]] = {}
+        self._tickets: Dict[str, MatchTicket] = {}
+        # paired tickets whose player has not seen the match yet, oldest first
+        self._unclaimed: OrderedDict = OrderedDict()
+        self._max_unclaimed = max_unclaimed
+        self._counters = {'matched': 0, 'wait_seconds': 0.0}
+
+    def __len__(self) -> int:
+        return len(self._tickets)
+
+    def _bucket(self, rating: float) -> int:
+        return math.floor(rating / self._bucket_width)
+
+    def _window(self, ticket: MatchTicket, now: float) -> float:
+        return min(self._base_window + self._widen_rate * (now - ticket.joined), self._max_window)
+
+    def _add(self, ticket: MatchTicket):
+        bucket = self._bucket(ticket.rating)
+        self._pools.setdefault(ticket.time_control, {}).setdefault(bucket, {})[ticket.username] = ticket
+        self._tickets[ticket.username] = ticket
+
+    def _remove(self, ticket: MatchTicket):
+        del self._tickets[ticket.username]
+        pool = self._pools[ticket.time_control]
+        bucket = self._bucket(ticket.rating)
+        del pool[bucket][ticket.username]
+        if not pool[bucket]:
+            del pool[bucket]
+            if not pool:
+                del self._pools[ticket.time_control]
+
+    def _find_opponent(self, ticket: MatchTicket, now: float) -> Optional[MatchTicket]:
+        """
+        Looks for the closest rated opponent among the oldest ticket of each
+        bucket within max_window, nearest buckets first.
+
+        :return: the opponent's ticket or None if no waiting player accepts the match
+        """
+        pool = self._pools.get(ticket.time_control, None)
+        if pool is None:
+            return None
+        center = self._bucket(ticket.rating)
+        window = self._window(ticket, now)
+        best = None
+        best_difference = 0.0
+        for distance in range(math.ceil(self._max_window / self._bucket_width) + 1):
+            for bucket in {center - distance, center + distance}:
+                entries = pool.get(bucket, None)
+                if not entries:
+                    continue
+                candidate = next(iter(entries.values()))
+                difference = abs(candidate.rating - ticket.rating)
+                if difference <= max(window, self._window(candidate, now)) and \
+                        (best is None or difference < best_difference):
+                    best, best_difference = candidate, difference
+            # every bucket further away differs by more than distance buckets
+            if best is not None and best_difference <= distance * self._bucket_width:
+                break
+        return best
+
+    async def join(self, username: str, rating: float, time_control: TimeControl = None) -> MatchTicket:
+        """
+        Queues a player, or pairs them right away with a waiting player.  Joining
+        again replaces the player's previous ticket.  Once paired, the match of
+        both tickets resolves to a dict of the game_id, the player's color, the
+        opponent and their rating; the white player owns the game and also gets
+        its termination_password.  If the game cannot be created, both players
+        are queued again.
+
+        :param username: the player
+        :param rating: the player's rating
+        :param time_control: (base, increment) in seconds, None for an untimed game
+        :return: the player's ticket
+        """
+        self.leave(username)
+        self._unclaimed.pop(username, None)
+        now = time.monotonic()
+        ticket = MatchTicket(username, rating, time_control, now, asyncio.get_running_loop().create_future())
+        opponent = self._find_opponent(ticket, now)
+        if opponent is None:
+            self._add(ticket)
+            return ticket
+        # taken off the queue before the game is created so nobody else can be paired with it
+        self._remove(opponent)
+        # the player who waited plays white
+        white, black = opponent, ticket
+        try:
+            game_id, term_pass = await self._create_game(white.username, black.username, time_control)
+        except Exception:
+            logger.exception("could not create the game of %s and %s", white.username, black.username)
+            # both players wait for another opponent, unless they left or joined again meanwhile
+            for player in (opponent, ticket):
+                if not player.match.done() and player.username not in self._tickets:
+                    self._add(player)
+            return ticket
+        self._counters['matched'] += 1
+        self._counters['wait_seconds'] += now - opponent.joined
+        for player, color, other in ((white, 'white', black), (black, 'black', white)):
+            result = {'game_id': game_id, 'color': color, 'opponent': other.username,
+                      'opponent_rating': other.rating, 'time_control': time_control}
+            if player is white:
+                result['termination_password'] = term_pass
+            player.match.set_result(result)
+        self._unclaimed[opponent.username] = opponent
+        self._unclaimed[ticket.username] = ticket
+        while len(self._unclaimed) > self._max_unclaimed:
+            self._unclaimed.popitem(last=False)
+        return ticket
+
+    def leave(self, username: str) -> bool:
+        """
+        Takes a waiting player off the queue.
+
+        :return: False if the player was not waiting
+        """
+        ticket = self._tickets.get(username, None)
+        if ticket is None:
+            return False
+        self._remove(ticket)
+        ticket.match.cancel()
+        return True
+
+    def ticket(self, username: str) -> Optional[MatchTicket]:
+        """
+        :return: the ticket of a waiting player or of a match the player has not claimed, otherwise None
+        """
+        return self._tickets.get(username, self._unclaimed.get(username, None))
+
+    async def wait(self, ticket: MatchTicket, timeout: float) -> Optional[dict]:
+        """
+        Waits for a ticket to be paired and claims the match.
+
+        :raises: LookupError if the player left the queue or joined again
+        :param ticket: ticket returned by join or ticket
+        :param timeout: seconds to wait
+        :return: the player's view of the paired game, None if still waiting after timeout
+        """
+        await asyncio.wait({ticket.match}, timeout=timeout)
+        if not ticket.match.done():
+            return None
+        if ticket.match.cancelled():
+            raise LookupError(f"{ticket.username} left the matchmaking queue")
+        if self._unclaimed.get(ticket.username, None) is ticket:
+            del self._unclaimed[ticket.username]
+        return ticket.match.result()
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Gets the matchmaking counters
+
+        :return: dict of the number of waiting players, matches made and their average wait in seconds
+        """
+        matched = self._counters['matched']
+        return {'waiting': len(self._tickets), 'matched': matched,
+                'average_wait': self._counters['wait_seconds'] / matched if matched else 0.0}
+
+
+async def match_response(queue: MatchmakingQueue, ticket: MatchTicket, wait: float):
+    """
+    Waits for a matchmaking ticket on behalf of a request.
+
+    :param queue: the queue the ticket is in
+    :param ticket: the ticket returned by join or ticket
+    :param wait: seconds to wait
+    :return: the match once paired, otherwise a 202 response telling the client to poll again
+    """
+    try:
+        match = await queue.wait(ticket, wait)
+    except LookupError as e:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, detail=str(e))
+    if match is None:
+        return JSONResponse({'status': 'waiting', 'rating': ticket.rating}, status_code=status.HTTP_202_ACCEPTED)
+    return {'status': 'matched', **match}
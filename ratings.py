@@ -0,0 +1,265 @@
+from typing import Dict, List, Optional, Tuple
+import math
+import random
+import sqlite3
+
+# PGN results and the score they give white
+RESULT_SCORES = {'1-0': 1.0, '0-1': 0.0, '1/2-1/2': 0.5}
+
+
+class _Node(object):
+    __slots__ = ('key', 'next', 'width')
+
+    def __init__(self, key: tuple, level: int):
+        self.key = key
+        self.next: List[Optional[_Node]] = [None] * level
+        # number of level 0 steps each link skips
+        self.width = [1] * level
+
+
+class Leaderboard(object):
+    """
+    Players ordered by rating, highest first, in an indexable skip list: every
+    link also stores how many players it skips, so the rank of a player and
+    the player at a given rank are found in O(log n) without walking the list,
+    and a top-N page costs O(log n + N).
+    """
+    _MAX_LEVEL = 32
+    # sorts after every (-rating, username) key
+    _END = (math.inf, '')
+
+    def __init__(self):
+        self._tail = _Node(self._END, 0)
+        self._head = _Node((-math.inf, ''), self._MAX_LEVEL)
+        self._head.next = [self._tail] * self._MAX_LEVEL
+        self._ratings: Dict[str, float] = {}
+        self._rng = random.Random()
+
+    def __len__(self) -> int:
+        return len(self._ratings)
+
+    def __contains__(self, username: str) -> bool:
+        return username in self._ratings
+
+    def _path(self, key: tuple) -> Tuple[List[_Node], List[int]]:
+        """
+        :return: the last node before key on each level and the number of level 0 steps taken on each level
+        """
+        path = [self._head] * self._MAX_LEVEL
+        steps = [0] * self._MAX_LEVEL
+        node = self._head
+        for level in reversed(range(self._MAX_LEVEL)):
+            while node.next[level].key < key:
+                steps[level] += node.width[level]
+                node = node.next[level]
+            path[level] = node
+        return path, steps
+
+    def set(self, username: str, rating: float):
+        """
+        Adds a player or moves them to their new rating.
+
+        :return: None
+        """
+        if username in self._ratings:
+            self.remove(username)
+        self._ratings[username] = rating
+        key = (-rating, username)
+        path, steps = self._path(key)
+        level = 1
+        while level < self._MAX_LEVEL and self._rng.random() < 0.5:
+            level += 1
+        node = _Node(key, level)
+        skipped = 0
+        for idx in range(level):
+            before = path[idx]
+            node.next[idx] = before.next[idx]
+            before.next[idx] = node
+            node.width[idx] = before.width[idx] - skipped
+            before.width[idx] = skipped + 1
+            skipped += steps[idx]
+        for idx in range(level, self._MAX_LEVEL):
+            path[idx].width[idx] += 1
+
+    def remove(self, username: str):
+        """
+        :raises: KeyError if the player is not on the leaderboard
+        :return: None
+        """
+        key = (-self._ratings.pop(username), username)
+        path, steps = self._path(key)
+        node = path[0].next[0]
+        for idx in range(self._MAX_LEVEL):
+            before = path[idx]
+            if idx < len(node.next):
+                before.width[idx] += node.width[idx] - 1
+                before.next[idx] = node.next[idx]
+            else:
+                before.width[idx] -= 1
+
+    def rating(self, username: str) -> Optional[float]:
+        return self._ratings.get(username, None)
+
+    def rank(self, username: str) -> Optional[int]:
+        """
+        :return: 1 for the highest rated player, None if the player is not on the leaderboard
+        """
+        rating = self._ratings.get(username, None)
+        if rating is None:
+            return None
+        path, steps = self._path((-rating, username))
+        return sum(steps) + 1
+
+    def top(self, limit: int, offset: int = 0) -> List[Tuple[str, float]]:
+        """
+        Gets one page of the leaderboard.
+
+        :param limit: largest number of players returned
+        :param offset: number of higher rated players skipped
+        :return: list of (username, rating), highest rating first
+        """
+        node = self._head
+        # position of node, the head is before the first player
+        position = 0
+        for level in reversed(range(self._MAX_LEVEL)):
+            while node.next[level] is not self._tail and position + node.width[level] <= offset:
+                position += node.width[level]
+                node = node.next[level]
+        page = []
+        node = node.next[0]
+        while node is not self._tail and len(page) < limit:
+            page.append((node.key[1], -node.key[0]))
+            node = node.next[0]
+        return page
+
+
+class RatingService(object):
+    """
+    Elo ratings updated incrementally, one finished game at a time, and kept
+    in a Leaderboard.  Ratings are stored in SQLite together with how far each
+    source of results (see apply_results) was read, in the same transaction,
+    so every result is counted exactly once across restarts.
+    """
+    _SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS ratings (username TEXT PRIMARY KEY, rating REAL NOT NULL, "
+        "games INTEGER NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS cursors (source TEXT PRIMARY KEY, seq INTEGER NOT NULL)",
+    )
+
+    def __init__(self, db_path: str = ':memory:', initial_rating: float = 1500.0,
+                 provisional_games: int = 30, provisional_k: float = 40.0, k_factor: float = 20.0):
+        """
+        :param db_path: path of the SQLite database file
+        :param initial_rating: rating of players without rated games
+        :param provisional_games: number of games during which provisional_k is used
+        :param provisional_k: K-factor of new players, whose ratings move faster
+        :param k_factor: K-factor of established players
+        """
+        self.initial_rating = initial_rating
+        self._provisional_games = provisional_games
+        self._provisional_k = provisional_k
+        self._k_factor = k_factor
+        self.leaderboard = Leaderboard()
+        self._games: Dict[str, int] = {}
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        for statement in self._SCHEMA:
+            self._conn.execute(statement)
+        self._conn.commit()
+        for username, rating, games in self._conn.execute("SELECT username, rating, games FROM ratings"):
+            self.leaderboard.set(username, rating)
+            self._games[username] = games
+
+    def rating(self, username: str) -> float:
+        """
+        :return: the player's rating, initial_rating for players without rated games
+        """
+        rating = self.leaderboard.rating(username)
+        return self.initial_rating if rating is None else rating
+
+    def games(self, username: str) -> int:
+        """
+        :return: the number of rated games of the player
+        """
+        return self._games.get(username, 0)
+
+    def _k(self, username: str) -> float:
+        return self._provisional_k if self.games(username) < self._provisional_games else self._k_factor
+
+    def _rate(self, white: str, black: str, result: str) -> List[Tuple[str, float, int]]:
+        """
+        Applies one game to the leaderboard.
+
+        :return: the (username, rating, games) rows to store, empty for games that are not rated
+        """
+        score = RESULT_SCORES.get(result, None)
+        if score is None or white is None or black is None or white == black:
+            return []
+        white_rating = self.rating(white)
+        black_rating = self.rating(black)
+        expected = 1 / (1 + 10 ** ((black_rating - white_rating) / 400))
+        white_rating += self._k(white) * (score - expected)
+        black_rating -= self._k(black) * (score - expected)
+        rows = []
+        for username, rating in ((white, white_rating), (black, black_rating)):
+            self.leaderboard.set(username, rating)
+            self._games[username] = self._games.get(username, 0) + 1
+            rows.append((username, rating, self._games[username]))
+        return rows
+
+    def record(self, white: str, black: str, result: str):
+        """
+        Rates one finished game.
+
+        :param white: username of the white player
+        :param black: username of the black player
+        :param result: '1-0', '0-1' or '1/2-1/2', other results are not rated
+        :return: None
+        """
+        rows = self._rate(white, black, result)
+        if rows:
+            with self._conn:
+                self._conn.executemany("INSERT OR REPLACE INTO ratings VALUES (?, ?, ?)", rows)
+
+    def cursor(self, source: str) -> int:
+        """
+        :param source: name of a source of results, such as a game database
+        :return: seq of the last result applied from the source, 0 if none
+        """
+        row = self._conn.execute("SELECT seq FROM cursors WHERE source = ?", (source,)).fetchone()
+        return row[0] if row is not None else 0
+
+    def apply_results(self, source: str, results: List[Tuple[int, str, str, str]]):
+        """
+        Rates a batch of finished games read from a source, in order, and
+        stores the ratings and the new cursor of the source in one transaction.
+
+        :param source: name of the source, see cursor
+        :param results: list of (seq, white, black, result) as returned by AsyncChessGameDB.results_after
+        :return: None
+        """
+        if not results:
+            return
+        rows = {}
+        for seq, white, black, result in results:
+            for row in self._rate(white, black, result):
+                rows[row[0]] = row
+        with self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO ratings VALUES (?, ?, ?)", list(rows.values()))
+            self._conn.execute("INSERT OR REPLACE INTO cursors VALUES (?, ?)", (source, results[-1][0]))
+
+    def standing(self, username: str) -> Dict[str, object]:
+        """
+        :return: dict of the player's rating, number of rated games and rank, None for unrated players
+        """
+        return {'username': username, 'rating': self.rating(username), 'games': self.games(username),
+                'rank': self.leaderboard.rank(username)}
+
+    def page(self, limit: int, offset: int = 0) -> List[Dict[str, object]]:
+        """
+        :return: one page of the leaderboard as dicts of rank, username and rating, see Leaderboard.top
+        """
+        return [{'rank': offset + idx + 1, 'username': username, 'rating': rating}
+                for idx, (username, rating) in enumerate(self.leaderboard.top(limit, offset))]
+
+    def close(self):
+        self._conn.close()
@@ -0,0 +1,549 @@
+import argparse
+import asyncio
+import itertools
+import multiprocessing
+import os
+import secrets
+import signal
+import sys
+import time
+from contextlib import asynccontextmanager
+from datetime import date
+import uvicorn
+import httpx
+import websockets
+from websockets.asyncio.client import unix_connect
+from typing import Dict, List, Optional
+from fastapi import FastAPI, HTTPException, Request, Response, status, Depends, Header, Query, WebSocket, \
+    WebSocketDisconnect
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.security import HTTPBasic, HTTPBasicCredentials, HTTPBearer, HTTPAuthorizationCredentials
+from chess_db import shard_for_game, round_robin_pairings
+from user_db import UserDB, HashQueueFull
+from shared_game_store import SharedGameStore
+from game_broadcast import etag_matches, state_document, state_etag
+from matchmaking import MatchmakingQueue, MatchRequest, match_response
+from ratings import RatingService
+from game_export import EXPORT_MEDIA_TYPES
+
+# Sharded deployment: N worker processes each run web_chess:app on a local
+# unix socket and own the games whose UUID maps to their shard
+# (chess_db.shard_for_game).  This router is the public server; it forwards
+# every /game/{game_id}/... request to the owning worker, so a game's state
+# only ever lives in one process.  Workers also publish every game to a shared
+# memory store, so read-only requests such as /winners are answered by the
+# router without forwarding.
+# The databases are opened by the lifespan handler, after main has put the
+# deployment settings in the environment.
+
+SOCKET_DIR = os.environ.get('CHESS_SOCKET_DIR', '/tmp')
+NUM_SHARDS = int(os.environ.get('CHESS_SHARD_COUNT', os.cpu_count() or 1))
+USER_DB: Optional[UserDB] = None
+SHARED_STORE: Optional[SharedGameStore] = None
+# ratings of every shard's players, fed from each shard's finished games
+RATINGS: Optional[RatingService] = None
+RATING_INTERVAL = 1.0
+# seconds between two attempts to copy accounts to the shards that missed them
+REPLICATION_INTERVAL = 1.0
+_clients: List[httpx.AsyncClient] = []
+# accounts not copied to a shard yet, by shard index: username -> password hash
+_pending_users: Dict[int, Dict[str, str]] = {}
+_next_shard = itertools.count()
+_background_tasks: List[asyncio.Task] = []
+# headers httpx or the ASGI server manage themselves
+_SKIPPED_HEADERS = {'host', 'content-length', 'transfer-encoding', 'connection', 'content-encoding'}
+
+
+def shard_socket(shard_index: int) -> str:
+    """
+    :return: path of the unix socket a shard worker listens on
+    """
+    return os.path.join(SOCKET_DIR, f'chess-shard-{shard_index}.sock')
+
+
+def run_shard(shard_index: int, num_shards: int):
+    """
+    Entry point of a shard worker process.
+
+    :param shard_index: index of the shard served by this process
+    :param num_shards: total number of shards
+    """
+    os.environ['CHESS_SHARD_INDEX'] = str(shard_index)
+    os.environ['CHESS_SHARD_COUNT'] = str(num_shards)
+    uvicorn.run('web_chess:app', uds=shard_socket(shard_index), log_level='warning')
+
+
+async def sync_ratings():
+    """
+    Rates the games that finished on each shard since the last pass.  Every
+    shard is a separate source, with its own cursor stored with the ratings.
+    """
+    while True:
+        caught_up = True
+        for shard_index, client in enumerate(_clients):
+            source = f'shard-{shard_index}'
+            try:
+                response = await client.get('/internal/results', params={'after': RATINGS.cursor(source)})
+                response.raise_for_status()
+            except httpx.HTTPError:
+                # the shard is restarting, its results are picked up on a later pass
+                continue
+            results = response.json()['results']
+            RATINGS.apply_results(source, results)
+            caught_up = caught_up and len(results) < 1000
+        if caught_up:
+            await asyncio.sleep(RATING_INTERVAL)
+
+
+async def replicate_user(shard_index: int, username: str, password_hash: str) -> bool:
+    """
+    Copies an account to one shard, or leaves it to replicate_pending_users if the shard is unavailable.
+
+    :return: True if the shard has the account
+    """
+    try:
+        response = await _clients[shard_index].put(f'/internal/user/{username}',
+                                                   json={'password_hash': password_hash})
+        response.raise_for_status()
+    except httpx.HTTPError:
+        _pending_users.setdefault(shard_index, {})[username] = password_hash
+        return False
+    return True
+
+
+async def replicate_pending_users():
+    """
+    Retries the accounts that could not be copied to a shard when they were created,
+    until every shard has every account.
+    """
+    while True:
+        await asyncio.sleep(REPLICATION_INTERVAL)
+        for shard_index in list(_pending_users):
+            pending = _pending_users.pop(shard_index)
+            for username, password_hash in pending.items():
+                await replicate_user(shard_index, username, password_hash)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global USER_DB, SHARED_STORE, RATINGS, NUM_SHARDS
+    NUM_SHARDS = int(os.environ.get('CHESS_SHARD_COUNT', os.cpu_count() or 1))
+    USER_DB = UserDB(bytes.fromhex(os.environ['CHESS_SESSION_KEY']) if 'CHESS_SESSION_KEY' in os.environ else None,
+                     db_path='chess_users.sqlite3')
+    SHARED_STORE = SharedGameStore(os.environ['CHESS_SHARED_STORE']) if 'CHESS_SHARED_STORE' in os.environ else None
+    RATINGS = RatingService('chess_ratings.sqlite3')
+    # one connection pool per shard worker, opened on the router's event loop
+    for shard_index in range(NUM_SHARDS):
+        transport = httpx.AsyncHTTPTransport(uds=shard_socket(shard_index))
+        _clients.append(httpx.AsyncClient(transport=transport, base_url='http://shard'))
+    _background_tasks.append(asyncio.create_task(sync_ratings()))
+    _background_tasks.append(asyncio.create_task(replicate_pending_users()))
+    yield
+    for task in _background_tasks:
+        task.cancel()
+    await asyncio.gather(*[client.aclose() for client in _clients])
+    USER_DB.close()
+    RATINGS.close()
+    if SHARED_STORE is not None:
+        SHARED_STORE.close()
+
+
+router = FastAPI(
+    title="Chess Server",
+    description="Router of a sharded multi-process deployment of the Chess server.",
+    lifespan=lifespan
+)
+
+
+@router.exception_handler(HashQueueFull)
+async def hash_queue_full(request: Request, exc: HashQueueFull):
+    return JSONResponse({'detail': str(exc)}, status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                        headers={'Retry-After': '1'})
+
+
+async def forward(request: Request, shard_index: int) -> Response:
+    """
+    Sends a request to a shard worker and relays its response.
+
+    :param request: the incoming request
+    :param shard_index: index of the shard to forward to
+    :return: the worker's response
+    """
+    headers = [(key, value) for key, value in request.headers.items() if key.lower() not in _SKIPPED_HEADERS]
+    upstream = await _clients[shard_index].request(request.method, request.url.path,
+                                                   params=request.query_params, headers=headers,
+                                                   content=await request.body())
+    response_headers = {key: value for key, value in upstream.headers.items()
+                        if key.lower() not in _SKIPPED_HEADERS}
+    return Response(upstream.content, upstream.status_code, headers=response_headers)
+
+
+async def authenticate(credentials: Optional[HTTPBasicCredentials] = Depends(HTTPBasic(auto_error=False)),
+                       token: Optional[HTTPAuthorizationCredentials] = Depends(HTTPBearer(auto_error=False))) -> str:
+    """
+    Same as web_chess.authenticate, for requests the router splits across shards.
+
+    :return: the username of the authenticated user
+    """
+    if token is not None:
+        username = USER_DB.check_session(token.credentials)
+        if username is not None:
+            return username
+    elif credentials is not None and await USER_DB.is_valid_async(credentials.username, credentials.password):
+        return credentials.username
+    raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid credentials",
+                        headers={'WWW-Authenticate': 'Basic'})
+
+
+@router.get('/')
+async def home(request: Request):
+    return await forward(request, 0)
+
+
+@router.post('/user/create', status_code=status.HTTP_201_CREATED)
+async def create_user(username: str):
+    # the router hashes the password once and copies the account to every shard
+    the_username, the_password = await USER_DB.create_user_async(username)
+    password_hash = USER_DB.password_hash(the_username).decode()
+    # a shard that is down gets the account once it is back, the router already accepts it for logins
+    await asyncio.gather(*[replicate_user(shard_index, the_username, password_hash)
+                           for shard_index in range(NUM_SHARDS)])
+    return {'success': True, 'username': the_username, 'password': the_password}
+
+
+@router.post('/user/login')
+async def login(credentials: HTTPBasicCredentials = Depends(HTTPBasic())):
+    # workers share the session key, so they accept the token without asking the router
+    session = await USER_DB.create_session_async(credentials.username, credentials.password)
+    if session is None:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid credentials")
+    token, expiry = session
+    return {'success': True, 'username': credentials.username, 'token': token, 'expires': expiry}
+
+
+@router.get('/metrics/auth')
+async def auth_metrics():
+    # only the router hashes passwords for logins and signups, Basic auth hashes on the workers
+    return USER_DB.hash_stats()
+
+
+@router.post('/user/logout')
+async def logout(token: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
+    if not USER_DB.revoke_session(token.credentials):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid session token")
+    await asyncio.gather(*[client.post('/internal/revoke', json={'token': token.credentials})
+                           for client in _clients])
+    return {'success': True}
+
+
+@router.get('/leaderboard')
+async def leaderboard(limit: int = Query(50, ge=1, le=200), offset: int = Query(0, ge=0)):
+    return {'players': RATINGS.page(limit, offset), 'total': len(RATINGS.leaderboard)}
+
+
+@router.get('/user/{username}/rating')
+async def user_rating(username: str):
+    return RATINGS.standing(username)
+
+
+@router.get('/games')
+async def list_games(owner: Optional[str] = None, player: Optional[str] = None, cursor: Optional[str] = None,
+                     limit: int = Query(50, ge=1, le=200)):
+    # shards are listed one after the other, the cursor is 'shard index.shard cursor'
+    shard_index, shard_cursor = 0, None
+    if cursor is not None:
+        try:
+            shard_index, shard_cursor = [int(part) if part else None for part in cursor.split('.')]
+        except ValueError:
+            raise HTTPException(status_code=422, detail="Invalid cursor")
+    games = []
+    next_cursor = None
+    while shard_index < NUM_SHARDS and len(games) < limit:
+        params = {key: value for key, value in [('owner', owner), ('player', player), ('cursor', shard_cursor),
+                                                ('limit', limit - len(games))] if value is not None}
+        response = await _clients[shard_index].get('/games', params=params)
+        response.raise_for_status()
+        page = response.json()
+        games.extend(page['games'])
+        if page['next_cursor'] is not None:
+            next_cursor = f"{shard_index}.{page['next_cursor']}"
+            break
+        shard_index, shard_cursor = shard_index + 1, None
+        next_cursor = f"{shard_index}." if shard_index < NUM_SHARDS else None
+    return {'games': games, 'next_cursor': next_cursor}
+
+
+async def create_matched_game(white: str, black: str, time_control: Optional[tuple]) -> tuple:
+    # the matched game is created with both players by one shard's /game/create_games
+    token, expiry = USER_DB.issue_session(white)
+    body = {'games': [[white, black]]}
+    if time_control is not None:
+        body['base'], body['increment'] = time_control
+    response = await _clients[next(_next_shard) % NUM_SHARDS].post(
+        '/game/create_games', headers={'Authorization': f'Bearer {token}'}, json=body)
+    response.raise_for_status()
+    game = response.json()['games'][0]
+    return game['game_id'], game['termination_password']
+
+
+# one queue for the whole deployment, so players on every shard can be paired
+MATCHMAKING = MatchmakingQueue(create_matched_game)
+
+
+@router.post('/matchmaking/join')
+async def join_matchmaking(match_request: MatchRequest, wait: float = Query(30.0, ge=0, le=60),
+                           username: str = Depends(authenticate)):
+    ticket = await MATCHMAKING.join(username, RATINGS.rating(username), match_request.time_control())
+    return await match_response(MATCHMAKING, ticket, wait)
+
+
+@router.get('/matchmaking')
+async def poll_matchmaking(wait: float = Query(30.0, ge=0, le=60), username: str = Depends(authenticate)):
+    ticket = MATCHMAKING.ticket(username)
+    if ticket is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, detail=f"{username} is not in the matchmaking queue")
+    return await match_response(MATCHMAKING, ticket, wait)
+
+
+@router.delete('/matchmaking')
+async def leave_matchmaking(username: str = Depends(authenticate)):
+    if not MATCHMAKING.leave(username):
+        raise HTTPException(status.HTTP_404_NOT_FOUND, detail=f"{username} is not in the matchmaking queue")
+    return {'success': True}
+
+
+@router.get('/metrics/matchmaking')
+async def matchmaking_metrics():
+    return MATCHMAKING.stats()
+
+
+@router.get('/games/export')
+async def export_games(request: Request, export_format: str = Query('pgn', alias='format', pattern='^(pgn|ndjson)$'),
+                       player: Optional[str] = None, since: Optional[date] = None, until: Optional[date] = None):
+    # validated here, so every shard accepts the request; their exports are relayed one after the other
+    async def relay():
+        for client in _clients:
+            async with client.stream('GET', '/games/export', params=request.query_params) as upstream:
+                async for chunk in upstream.aiter_raw():
+                    yield chunk
+
+    return StreamingResponse(relay(), media_type=EXPORT_MEDIA_TYPES[export_format],
+                             headers={'Content-Disposition': f'attachment; filename="games.{export_format}"'})
+
+
+@router.get('/game/create_game')
+async def create_game(request: Request):
+    # new games are spread round-robin; the worker picks an id that maps back to itself
+    return await forward(request, next(_next_shard) % NUM_SHARDS)
+
+
+@router.post('/game/create_games', status_code=status.HTTP_201_CREATED)
+async def create_games(request: Request, username: str = Depends(authenticate)):
+    # the round is paired here and split evenly across the shards, each creates its part in one batch
+    batch = await request.json()
+    if not isinstance(batch, dict) or not isinstance(batch.get('players', []), list):
+        return await forward(request, 0)
+    bye = None
+    if batch.get('games') is None and batch.get('players') is not None:
+        pairings, bye = round_robin_pairings(batch['players'], int(batch.get('round', 0)))
+    else:
+        pairings = batch.get('games')
+    if not isinstance(pairings, list) or not pairings:
+        return await forward(request, 0)
+    time_control = {key: batch[key] for key in ('base', 'increment') if key in batch}
+    token, expiry = USER_DB.issue_session(username)
+    first_shard = next(_next_shard)
+    # pairing offset goes to shard first_shard + offset, every NUM_SHARDS-th pairing to the same shard
+    offsets = range(min(NUM_SHARDS, len(pairings)))
+    responses = await asyncio.gather(*[_clients[(first_shard + offset) % NUM_SHARDS].post(
+        '/game/create_games', headers={'Authorization': f'Bearer {token}'},
+        json={'games': pairings[offset::NUM_SHARDS], **time_control}) for offset in offsets])
+    games: List[Optional[dict]] = [None] * len(pairings)
+    for offset, upstream in zip(offsets, responses):
+        if upstream.status_code != status.HTTP_201_CREATED:
+            return Response(upstream.content, upstream.status_code, media_type=upstream.headers.get('content-type'))
+        games[offset::NUM_SHARDS] = upstream.json()['games']
+    return {'success': True, 'game_owner': username, 'bye': bye, 'games': games}
+
+
+@router.get('/game/{game_id}/winners')
+async def get_winners(game_id: str, request: Request):
+    if SHARED_STORE is not None:
+        try:
+            state = SHARED_STORE.read(game_id)
+        except ValueError:
+            raise HTTPException(status_code=404, detail=f"Game {game_id} not found.")
+        if state is not None:
+            return {'game_id': game_id, 'winner': state.who_won()}
+    return await game_request(game_id, 'winners', request)
+
+
+@router.post('/moves/batch')
+async def batch_moves(request: Request, username: str = Depends(authenticate)):
+    # split the batch by owning shard, keep the order of the moves within each shard
+    moves = await request.json()
+    if not isinstance(moves, list):
+        return await forward(request, 0)
+    batches: Dict[int, List[int]] = {}
+    results: List[Optional[dict]] = [None] * len(moves)
+    for idx, move in enumerate(moves):
+        try:
+            batches.setdefault(shard_for_game(move['game_id'], NUM_SHARDS), []).append(idx)
+        except (ValueError, TypeError, KeyError, AttributeError):
+            # not a game id, the shard would only report it as not found
+            if isinstance(move, dict) and isinstance(move.get('game_id'), str) and isinstance(move.get('move'), str):
+                results[idx] = {'game_id': move['game_id'], 'move': move['move'], 'success': False,
+                                'result': 'not_found'}
+            else:
+                # malformed entries are rejected by a shard with the usual validation error
+                return await forward(request, 0)
+    # the shards trust a session token issued here instead of checking a password each
+    token, expiry = USER_DB.issue_session(username)
+    headers = {'Authorization': f'Bearer {token}'}
+    shard_indexes = list(batches)
+    responses = await asyncio.gather(*[_clients[shard_index].post(
+        '/moves/batch', headers=headers, json=[moves[idx] for idx in batches[shard_index]])
+        for shard_index in shard_indexes])
+    for shard_index, response in zip(shard_indexes, responses):
+        if response.status_code != status.HTTP_200_OK:
+            return Response(response.content, response.status_code, media_type=response.headers.get('content-type'))
+        for idx, result in zip(batches[shard_index], response.json()['results']):
+            results[idx] = result
+    return {'results': results}
+
+
+@router.get('/game/{game_id}/state')
+async def get_state(game_id: str, request: Request, if_none_match: Optional[str] = Header(None)):
+    # answered from shared memory, the document is only built when the client's copy is stale
+    if SHARED_STORE is not None:
+        try:
+            state = SHARED_STORE.read(game_id)
+        except ValueError:
+            raise HTTPException(status_code=404, detail=f"Game {game_id} not found.")
+        if state is not None:
+            winner = state.who_won()
+            etag = state_etag(state.current_turn, state.board, winner)
+            if etag_matches(if_none_match, etag):
+                return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+            document = state_document(game_id, state.current_turn, state.board,
+                                      state.last_move if state.current_turn else None, winner)
+            return Response(document, media_type='application/json',
+                            headers={'ETag': etag, 'Cache-Control': 'no-cache'})
+    return await game_request(game_id, 'state', request)
+
+
+@router.get('/game/{game_id}/events')
+async def game_events(game_id: str, request: Request):
+    # the event stream never ends on its own, relay it chunk by chunk instead of through forward
+    try:
+        shard_index = shard_for_game(game_id, NUM_SHARDS)
+    except ValueError:
+        raise HTTPException(status_code=404, detail=f"Game {game_id} not found.")
+    client = _clients[shard_index]
+    upstream = await client.send(client.build_request('GET', request.url.path), stream=True)
+    if upstream.status_code != status.HTTP_200_OK:
+        await upstream.aread()
+        await upstream.aclose()
+        return Response(upstream.content, upstream.status_code, media_type=upstream.headers.get('content-type'))
+
+    async def relay():
+        try:
+            async for chunk in upstream.aiter_raw():
+                yield chunk
+        finally:
+            await upstream.aclose()
+
+    return StreamingResponse(relay(), media_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+
+@router.websocket('/game/{game_id}/ws')
+async def game_channel(websocket: WebSocket, game_id: str):
+    # relays the game channel to the owning worker, which authenticates the handshake itself
+    try:
+        shard_index = shard_for_game(game_id, NUM_SHARDS)
+    except ValueError:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason=f"Game {game_id} not found.")
+        return
+    uri = f'ws://shard{websocket.url.path}' + (f'?{websocket.url.query}' if websocket.url.query else '')
+    headers = [(key, value) for key, value in websocket.headers.items() if key.lower() == 'authorization']
+    try:
+        upstream = await unix_connect(shard_socket(shard_index), uri, additional_headers=headers)
+    except websockets.exceptions.InvalidStatus:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    except OSError:
+        # the shard is down or restarting
+        await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+        return
+    await websocket.accept()
+
+    async def client_to_shard():
+        try:
+            while True:
+                await upstream.send(await websocket.receive_text())
+        except WebSocketDisconnect:
+            pass
+
+    async def shard_to_client():
+        try:
+            async for message in upstream:
+                await websocket.send_text(message)
+        except websockets.exceptions.ConnectionClosedError:
+            pass
+        await websocket.close()
+
+    async with upstream:
+        tasks = [asyncio.create_task(client_to_shard()), asyncio.create_task(shard_to_client())]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+@router.api_route('/game/{game_id}/{rest:path}', methods=['GET', 'POST', 'PUT', 'DELETE'])
+async def game_request(game_id: str, rest: str, request: Request):
+    try:
+        shard_index = shard_for_game(game_id, NUM_SHARDS)
+    except ValueError:
+        raise HTTPException(status_code=404, detail=f"Game {game_id} not found.")
+    return await forward(request, shard_index)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the Chess server as several shard processes behind a router.")
+    parser.add_argument('--shards', type=int, default=NUM_SHARDS, help='number of worker processes')
+    parser.add_argument('--port', type=int, default=8000, help='port the router listens on')
+    parser.add_argument('--store-slots', type=int, default=1 << 17, help='games the shared memory store can hold')
+    args = parser.parse_args()
+    # the router and the workers read the deployment settings from the environment
+    os.environ['CHESS_SHARD_COUNT'] = str(args.shards)
+    os.environ['CHESS_SHARED_STORE'] = f'chess_games_{os.getpid()}'
+    os.environ['CHESS_SESSION_KEY'] = secrets.token_hex(32)
+    store = SharedGameStore(os.environ['CHESS_SHARED_STORE'], args.store_slots, create=True)
+
+    context = multiprocessing.get_context('spawn')
+    workers = []
+    for shard_index in range(args.shards):
+        if os.path.exists(shard_socket(shard_index)):
+            os.remove(shard_socket(shard_index))
+        worker = context.Process(target=run_shard, args=(shard_index, args.shards), daemon=True)
+        worker.start()
+        workers.append(worker)
+    while not all(os.path.exists(shard_socket(shard_index)) for shard_index in range(args.shards)):
+        time.sleep(0.1)
+    # uvicorn re-raises SIGTERM after its own shutdown, exit through the cleanup below
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        # the app object rather than 'sharded_chess:router', which would import this module a second time
+        uvicorn.run(router, port=args.port, log_level='info')
+    finally:
+        for worker in workers:
+            worker.terminate()
+            worker.join()
+        store.close()
+        store.unlink()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+from uuid import UUID
+from typing import Dict, Optional
+from dataclasses import dataclass
+from multiprocessing import shared_memory, resource_tracker
+from chess.chess import ChessGame
+import fcntl
+import os
+import struct
+import tempfile
+import time
+
+# names of the blocks created by this process, see SharedGameStore.__init__
+_CREATED_BLOCKS = set()
+
+
+@dataclass
+class SharedGameState:
+    current_turn: int
+    white_won: bool
+    black_won: bool
+    draw: bool
+    last_move: int
+    board: bytes
+
+    def who_won(self) -> str:
+        """
+        Same result as ChessGame.who_won for the game this state was published from.
+        """
+        if self.white_won:
+            return "White Won"
+        if self.black_won:
+            return "Black Won"
+        if self.draw:
+            return "Draw"
+        return ""
+
+
+class SharedGameStore(object):
+    """
+    Game summaries (board, turn, result, last move) kept in a shared memory
+    arena so every process of the sharded deployment (sharded_chess.py) can
+    read every game without asking the shard that owns it.
+
+    The arena is an open-addressing table of fixed 64-byte slots keyed by the
+    game UUID.  Each slot starts with a sequence counter used as a seqlock: the
+    writer makes it odd while it updates the slot and even again when done, and
+    readers retry when the counter was odd or changed while they copied.  A
+    slot that stays odd, left by a writer that died, reads as missing.  Each
+    game must only be written by one process (the one that owns the game);
+    claiming and freeing slots is serialized between processes with a file lock.
+
+    The arena is created by sharded_chess.py and read by its router; it is
+    not a way to run web_chess under uvicorn --workers, where only the first
+    worker can open the game database.
+    """
+    # seq, game UUID bytes, slot state, current turn, result flags, last move code, board
+    _SLOT = struct.Struct('<I16sBHBH32s6x')
+    _SEQ = struct.Struct('<I')
+    _EMPTY, _USED, _DELETED = 0, 1, 2
+    _WHITE_WON, _BLACK_WON, _DRAW = 1, 2, 4
+    # a slot still being written after this many attempts (about 50 ms) was left by a writer that died mid-update
+    _READ_ATTEMPTS = 1000
+
+    def __init__(self, name: str = 'chess_games', capacity: int = 1 << 17, create: bool = False,
+                 lock_dir: Optional[str] = None):
+        """
+        Creates or attaches to the shared arena.
+
+        :param name: name of the shared memory block, the same in every process
+        :param capacity: number of slots when creating, keep it well above the number of live games
+        :param create: True in the process that creates the arena, False to attach to it
+        :param lock_dir: directory of the lock file claiming slots, the same in every process;
+            by default the temporary directory (TMPDIR)
+        """
+        self._shm = shared_memory.SharedMemory(name=name, create=create, size=capacity * self._SLOT.size)
+        self._buf = self._shm.buf
+        if create:
+            _CREATED_BLOCKS.add(name)
+        elif name not in _CREATED_BLOCKS:
+            # only the creator owns the block, otherwise the first attached process
+            # to exit would have the resource tracker destroy it for everyone;
+            # the tracker knows the block by its POSIX name, with a leading slash
+            resource_tracker.unregister('/' + self._shm.name, 'shared_memory')
+        # attaching processes take the capacity chosen by the creator
+        self._capacity = self._shm.size // self._SLOT.size
+        self._lock_path = os.path.join(lock_dir if lock_dir is not None else tempfile.gettempdir(),
+                                       f"{self._shm.name.lstrip('/')}.lock")
+        # slot of each game already looked up by this process
+        self._slot_cache: Dict[str, int] = {}
+        # slot -> odd counter of the abandoned slots seen by this process, read as missing without waiting again
+        self._abandoned: Dict[int, int] = {}
+
+    def _offset(self, slot: int) -> int:
+        return slot * self._SLOT.size
+
+    def _read_slot(self, slot: int) -> Optional[tuple]:
+        """
+        Copies a slot consistently using its seqlock.
+
+        :return: the unpacked slot fields without the sequence counter, None if the slot
+            never became consistent, such as when its writer died in the middle of an update
+        """
+        offset = self._offset(slot)
+        for attempt in range(self._READ_ATTEMPTS):
+            seq = self._SEQ.unpack_from(self._buf, offset)[0]
+            if seq % 2:
+                if self._abandoned.get(slot, None) == seq:
+                    return None
+                time.sleep(0)
+                continue
+            fields = self._SLOT.unpack_from(self._buf, offset)
+            if fields[0] == seq and self._SEQ.unpack_from(self._buf, offset)[0] == seq:
+                return fields[1:]
+        if seq % 2:
+            self._abandoned[slot] = seq
+        return None
+
+    def _write_slot(self, slot: int, game_bytes: bytes, state: int, current_turn: int, flags: int,
+                    last_move: int, board: bytes):
+        offset = self._offset(slot)
+        seq = self._SEQ.unpack_from(self._buf, offset)[0]
+        self._SEQ.pack_into(self._buf, offset, seq + 1)
+        self._SLOT.pack_into(self._buf, offset, seq + 1, game_bytes, state, current_turn, flags, last_move, board)
+        self._SEQ.pack_into(self._buf, offset, seq + 2)
+
+    def _find_slot(self, game_id: str) -> Optional[int]:
+        """
+        Finds the slot holding a game.
+
+        :return: slot index or None if the game is not in the store
+        """
+        game_bytes = UUID(game_id).bytes
+        slot = self._slot_cache.get(game_id, None)
+        if slot is not None:
+            fields = self._read_slot(slot)
+            if fields is not None and fields[0] == game_bytes and fields[1] == self._USED:
+                return slot
+            del self._slot_cache[game_id]
+        start = UUID(game_id).int % self._capacity
+        for probe in range(self._capacity):
+            slot = (start + probe) % self._capacity
+            fields = self._read_slot(slot)
+            if fields is None:
+                # an abandoned slot is treated as holding another game
+                continue
+            if fields[1] == self._EMPTY:
+                return None
+            if fields[1] == self._USED and fields[0] == game_bytes:
+                self._slot_cache[game_id] = slot
+                return slot
+        return None
+
+    def _claim_slot(self, game_id: str) -> int:
+        """
+        Claims a free slot for a game.
+
+        :raises: MemoryError if the arena is full
+        :return: slot index
+        """
+        game_bytes = UUID(game_id).bytes
+        start = UUID(game_id).int % self._capacity
+        with open(self._lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            slot = self._find_slot(game_id)
+            if slot is not None:
+                return slot
+            for probe in range(self._capacity):
+                slot = (start + probe) % self._capacity
+                fields = self._read_slot(slot)
+                # abandoned slots are never reused, writing one would leave its counter odd
+                if fields is not None and fields[1] != self._USED:
+                    self._write_slot(slot, game_bytes, self._USED, 0, 0, 0, bytes(32))
+                    self._slot_cache[game_id] = slot
+                    return slot
+        raise MemoryError("shared game store is full")
+
+    def publish(self, game_id: str, game: ChessGame):
+        """
+        Writes the current state of a game, claiming a slot on first use.
+
+        :param game_id: the UUID of the game
+        :param game: the game owned by this process
+        :return: None
+        """
+        slot = self._find_slot(game_id)
+        if slot is None:
+            slot = self._claim_slot(game_id)
+        flags = (self._WHITE_WON if game.white_won else 0) | (self._BLACK_WON if game.black_won else 0) | \
+            (self._DRAW if game.drawn else 0)
+        last_move = game.last_move_code() if game.current_turn else 0
+        self._write_slot(slot, UUID(game_id).bytes, self._USED, game.current_turn, flags, last_move,
+                         game.encode_board())
+
+    def read(self, game_id: str) -> Optional[SharedGameState]:
+        """
+        Reads the latest published state of a game from any process.
+
+        :param game_id: the UUID of the game
+        :return: the game state or None if the game is not in the store
+        """
+        slot = self._find_slot(game_id)
+        if slot is None:
+            return None
+        fields = self._read_slot(slot)
+        if fields is None:
+            return None
+        game_bytes, state, current_turn, flags, last_move, board = fields
+        if state != self._USED or game_bytes != UUID(game_id).bytes:
+            return None
+        return SharedGameState(current_turn, bool(flags & self._WHITE_WON), bool(flags & self._BLACK_WON),
+                               bool(flags & self._DRAW), last_move, board)
+
+    def remove(self, game_id: str):
+        """
+        Frees the slot of a game.
+
+        :return: None
+        """
+        with open(self._lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            slot = self._find_slot(game_id)
+            if slot is not None:
+                # tombstone keeps the probe chains of other games intact
+                self._write_slot(slot, bytes(16), self._DELETED, 0, 0, 0, bytes(32))
+                self._slot_cache.pop(game_id, None)
+
+    def close(self):
+        """
+        Detaches this process from the arena.
+        """
+        self._buf = None
+        self._shm.close()
+
+    def unlink(self):
+        """
+        Destroys the arena, called once by the process that created it.
+        """
+        self._shm.unlink()
@@ -0,0 +1,429 @@
+from unittest import IsolatedAsyncioTestCase, mock
+import asyncio
+import json
+import os
+import tempfile
+from uuid import uuid4
+from chess.chess import ChessGame, Move
+from chess_db import AsyncChessGameDB, round_robin_pairings
+from shared_game_store import SharedGameStore
+
+
+class TestAsyncChessGameDB(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp_dir.name, 'games.sqlite3')
+        self.log_dir = os.path.join(self.tmp_dir.name, 'log')
+        self.db = AsyncChessGameDB(None, self.db_path, self.log_dir)
+
+    async def asyncTearDown(self) -> None:
+        await self.db.close()
+        self.tmp_dir.cleanup()
+
+    async def test_concurrent_moves(self):
+        # the last move draws by threefold repetition
+        moves = ['g1f3', 'g8f6', 'f3g1', 'f6g8'] * 2
+        game_ids = []
+        for _ in range(200):
+            game_id, term_pass, owner = await self.db.add_game('owner')
+            game_ids.append(game_id)
+        # every move of every game is requested at once, interleaved across games
+        requests = [self.db.make_move(game_id, idx % 2, move)
+                    for idx, move in enumerate(moves) for game_id in game_ids]
+        results = await asyncio.gather(*requests)
+        self.assertEqual(all(results), True)
+        for game_id in game_ids:
+            game = await self.db.get_game(game_id)
+            self.assertEqual(game.current_turn, len(moves))
+
+        await self.db.close()
+        self.db = AsyncChessGameDB(None, self.db_path, self.log_dir)
+        for game_id in game_ids:
+            game = await self.db.get_game(game_id)
+            self.assertEqual(game.current_turn, len(moves))
+
+    async def test_delete_with_queued_moves(self):
+        (game_id, term_pass), = await self.db.add_games('owner', [['host', 'guest']])
+        release = asyncio.Event()
+        held = asyncio.ensure_future(self.db.run_in_game(game_id, lambda game: release.wait()))
+        before = asyncio.ensure_future(self.db.make_move(game_id, 0, 'e2e3'))
+        deleted = asyncio.ensure_future(self.db.del_game(game_id, term_pass, 'owner'))
+        after = asyncio.ensure_future(self.db.make_move(game_id, 1, 'e7e6'))
+        clock = asyncio.ensure_future(self.db.check_clock(game_id))
+        await asyncio.sleep(0)
+        release.set()
+        await held
+        # commands queued before the deletion run first, the later ones fail as for an unknown game
+        self.assertTrue(await before)
+        self.assertTrue(await deleted)
+        with self.assertRaises(KeyError):
+            await after
+        self.assertFalse(await clock)
+        self.assertEqual(await self.db.make_moves('guest', [(game_id, 'e7e6')]), ['not_found'])
+
+    async def test_out_of_turn_move(self):
+        game_id, term_pass, owner = await self.db.add_game('owner')
+        results = await asyncio.gather(self.db.make_move(game_id, 1, 'e7e6'), self.db.make_move(game_id, 0, 'e2e3'),
+                                       self.db.make_move(game_id, 1, 'e7e6'))
+        self.assertEqual(results, [False, True, True])
+
+    async def test_failed_flush_is_retried(self):
+        write_batch = self.db._write_batch
+        calls = []
+
+        def fail_once(batch, log_records):
+            calls.append(len(log_records))
+            if len(calls) == 1:
+                raise OSError("disk full")
+            write_batch(batch, log_records)
+
+        with mock.patch.object(self.db, '_write_batch', side_effect=fail_once), \
+                self.assertLogs('chess_db', 'ERROR'):
+            game_id, term_pass, owner = await self.db.add_game('owner')
+            self.assertEqual(await self.db.make_move(game_id, 0, 'e2e3'), True)
+            # the background flush fails, then retries the same writes
+            while len(calls) < 2 or self.db._pending_writes or self.db._pending_log:
+                await asyncio.sleep(0.01)
+        await self.db.close()
+        self.db = AsyncChessGameDB(None, self.db_path, self.log_dir)
+        self.assertEqual((await self.db.get_game(game_id)).current_turn, 1)
+
+    async def test_validate_moves(self):
+        game_id, term_pass, owner = await self.db.add_game('owner')
+        pending = [(game_id, 0, 'e2e3'), (game_id, 1, 'e7e6'), (game_id, 0, 'b1a8'), (game_id, 2, 'e2e3'),
+                   (game_id, -1, 'e7e6'), ('missing', 0, 'e2e3'), (game_id, 0, 'e2')]
+        self.assertEqual(await self.db.validate_moves(pending), [True, False, False, False, False, False, False])
+
+    async def test_shared_game_store(self):
+        store = SharedGameStore(f'chess_test_{os.getpid()}', 64, create=True, lock_dir=self.tmp_dir.name)
+        reader = SharedGameStore(f'chess_test_{os.getpid()}', lock_dir=self.tmp_dir.name)
+        try:
+            await self.db.close()
+            self.db = AsyncChessGameDB(None, self.db_path, self.log_dir, shared_store=store)
+            game_id, term_pass, owner = await self.db.add_game('owner')
+            self.assertEqual(reader.read(game_id).current_turn, 0)
+            await self.db.make_move(game_id, 0, 'e2e3')
+            state = reader.read(game_id)
+            game = await self.db.get_game(game_id)
+            self.assertEqual(state.current_turn, 1)
+            self.assertEqual(state.board, game.encode_board())
+            self.assertEqual(game.decode_move(state.last_move), [6, 4, 5, 4])
+            self.assertEqual(state.who_won(), "")
+            # slots are claimed under a lock file in the given directory
+            self.assertTrue(os.path.exists(os.path.join(self.tmp_dir.name, f'chess_test_{os.getpid()}.lock')))
+            await self.db.del_game(game_id, term_pass, owner)
+            self.assertEqual(reader.read(game_id), None)
+        finally:
+            reader.close()
+            store.close()
+            store.unlink()
+
+    async def test_abandoned_shared_slot(self):
+        store = SharedGameStore(f'chess_test_{os.getpid()}', 64, create=True)
+        try:
+            game = await self.db.get_game((await self.db.add_game('owner'))[0])
+            game_id = str(uuid4())
+            store.publish(game_id, game)
+            slot = store._find_slot(game_id)
+            # a writer died between making the counter odd and making it even again
+            store._SEQ.pack_into(store._buf, store._offset(slot), 7)
+            self.assertEqual(store.read(game_id), None)
+            store.publish(game_id, game)
+            self.assertNotEqual(store._find_slot(game_id), slot)
+            self.assertEqual(store.read(game_id).current_turn, 0)
+        finally:
+            store.close()
+            store.unlink()
+
+    async def test_single_process(self):
+        with self.assertRaises(RuntimeError):
+            AsyncChessGameDB(None, self.db_path, self.log_dir)
+
+    async def test_subscribe(self):
+        game_id, term_pass, owner = await self.db.add_game('owner')
+        events = self.db.subscribe(game_id)
+        self.assertEqual(json.loads(await events.get())['type'], 'snapshot')
+        self.assertEqual(await self.db.make_move(game_id, 0, 'g1f3'), True)
+        self.assertEqual(await self.db.make_move(game_id, 0, 'f3g1'), False)
+        event = json.loads(await events.get())
+        self.assertEqual((event['type'], event['player'], event['move'], event['turn']), ('move', 0, 'g1f3', 1))
+        self.assertEqual(event['changes'], [['f3', 'N'], ['g1', '']])
+        await self.db.del_game(game_id, term_pass, 'owner')
+        self.assertEqual(json.loads(await events.get())['type'], 'terminated')
+        self.assertEqual(await events.get(), None)
+        with self.assertRaises(KeyError):
+            self.db.subscribe(game_id)
+
+    async def test_game_state(self):
+        game_id, term_pass, owner = await self.db.add_game('owner')
+        etag, document = await self.db.game_state(game_id)
+        self.assertEqual(json.loads(document)['last_move'], None)
+        self.assertIs((await self.db.game_state(game_id))[1], document)
+        await self.db.make_move(game_id, 0, 'e2e3')
+        new_etag, document = await self.db.game_state(game_id)
+        self.assertNotEqual(new_etag, etag)
+        state = json.loads(document)
+        self.assertEqual((state['turn'], state['side_to_move'], state['last_move']), (1, 'black', 'e2e3'))
+        self.assertEqual(state['board'], 'rnbqkbnr/pppppppp/8/8/8/4P3/PPPP1PPP/RNBQKBNR')
+        with self.assertRaises(KeyError):
+            await self.db.game_state(str(uuid4()))
+
+    async def test_make_moves(self):
+        game_ids = []
+        for _ in range(3):
+            game_id, term_pass, owner = await self.db.add_game('owner')
+            await self.db.add_player(game_id, 'host')
+            await self.db.add_player(game_id, 'guest')
+            game_ids.append(game_id)
+        other_game, term_pass, owner = await self.db.add_game('owner')
+        results = await self.db.make_moves('host', [(game_ids[0], 'e2e3'), (game_ids[1], 'e2e3'),
+                                                    (game_ids[0], 'd2d3'), (game_ids[2], 'e2e5'),
+                                                    (other_game, 'e2e3'), (str(uuid4()), 'e2e3')])
+        self.assertEqual(results, ['played', 'played', 'invalid', 'invalid', 'not_player', 'not_found'])
+        results = await self.db.make_moves('guest', [(game_ids[0], 'e7e6'), (game_ids[0], 'e6e5')])
+        self.assertEqual(results, ['played', 'invalid'])
+        # a user holding both seats moves for whichever side is to move
+        (own_game, term_pass), = await self.db.add_games('owner', [['host', 'host']])
+        results = await self.db.make_moves('host', [(own_game, 'e2e3'), (own_game, 'e7e6'), (own_game, 'd2d3')])
+        self.assertEqual(results, ['played', 'played', 'played'])
+
+    async def test_make_moves_validates_in_batch(self):
+        game_ids = []
+        for _ in range(2):
+            (game_id, term_pass), = await self.db.add_games('owner', [['host', 'guest']])
+            game_ids.append(game_id)
+        validate_moves = mock.AsyncMock(wraps=self.db.validate_moves)
+        run_in_game = mock.AsyncMock(wraps=self.db.run_in_game)
+        with mock.patch.object(self.db, 'validate_moves', validate_moves), \
+                mock.patch.object(self.db, 'run_in_game', run_in_game):
+            results = await self.db.make_moves('host', [(game_ids[0], 'e2e3'), (game_ids[1], 'e2e5'),
+                                                        (game_ids[0], 'd2d3')])
+        self.assertEqual(results, ['played', 'invalid', 'invalid'])
+        # only the first move of each game is checked up front, and the rejected one never reaches its game
+        validate_moves.assert_awaited_once_with([(game_ids[0], 0, 'e2e3'), (game_ids[1], 0, 'e2e5')])
+        self.assertEqual([call.args[0] for call in run_in_game.await_args_list], [game_ids[0], game_ids[0]])
+
+    async def test_add_games(self):
+        pairings, bye = round_robin_pairings(['a', 'b', 'c', 'd', 'e'], 0)
+        self.assertEqual((len(pairings), bye is not None), (2, True))
+        games = await self.db.add_games('owner', pairings)
+        self.assertEqual(len(games), 2)
+        for (game_id, term_pass), players in zip(games, pairings):
+            self.assertEqual(await self.db.game_info(game_id), ('owner', players))
+        self.assertEqual(await self.db.make_moves(pairings[0][0], [(games[0][0], 'e2e3')]), ['played'])
+        await self.db.close()
+        self.db = AsyncChessGameDB(None, self.db_path, self.log_dir)
+        for (game_id, term_pass), players in zip(games, pairings):
+            self.assertEqual(await self.db.game_info(game_id), ('owner', players))
+        self.assertEqual((await self.db.get_game(games[0][0])).current_turn, 1)
+
+    def test_round_robin_pairings(self):
+        players = [str(idx) for idx in range(6)]
+        meetings = set()
+        for round_idx in range(5):
+            pairings, bye = round_robin_pairings(players, round_idx)
+            self.assertEqual(bye, None)
+            self.assertEqual(sorted(sum(pairings, [])), players)
+            meetings.update(frozenset(pairing) for pairing in pairings)
+        self.assertEqual(len(meetings), 15)
+
+    async def test_page_games(self):
+        created = await self.db.add_games('owner', [['a', 'b'], ['b', 'c'], ['c', 'a'], ['a', 'c']])
+        game_ids = [game_id for game_id, term_pass in created]
+        other_id, other_pass, owner = await self.db.add_game('other')
+        await self.db.add_player(other_id, 'a')
+        self.assertEqual(await self.db.list_games(), [(other_id, 1)] + [(game_id, 2) for game_id in game_ids[::-1]])
+
+        pages = []
+        cursor = None
+        while True:
+            games, cursor = await self.db.page_games(player='a', before=cursor, limit=2)
+            pages.append([game_id for game_id, info in games])
+            if cursor is None:
+                break
+        self.assertEqual(pages, [[other_id, game_ids[3]], [game_ids[2], game_ids[0]]])
+        games, cursor = await self.db.page_games(owner='owner', player='b')
+        self.assertEqual(([game_id for game_id, info in games], cursor), ([game_ids[1], game_ids[0]], None))
+
+        await self.db.del_game(game_ids[3], created[3][1], 'owner')
+        games, cursor = await self.db.page_games(player='a')
+        self.assertEqual([game_id for game_id, info in games], [other_id, game_ids[2], game_ids[0]])
+        await self.db.close()
+        self.db = AsyncChessGameDB(None, self.db_path, self.log_dir)
+        games, cursor = await self.db.page_games(owner='owner', limit=1)
+        self.assertEqual(([game_id for game_id, info in games], cursor is not None), ([game_ids[2]], True))
+
+    async def test_hibernation(self):
+        await self.db.close()
+        self.db = AsyncChessGameDB(None, self.db_path, self.log_dir, max_resident_games=2)
+        game_ids = [(await self.db.add_game('owner'))[0] for _ in range(4)]
+        self.assertEqual(self.db.hibernation_stats()['resident'], 2)
+        self.assertEqual(self.db.hibernation_stats()['hibernated'], 2)
+        # the first game was hibernated, playing on it rehydrates it transparently
+        self.assertEqual(await self.db.make_move(game_ids[0], 0, 'e2e3'), True)
+        self.assertEqual(await self.db.make_move(game_ids[0], 1, 'e7e6'), True)
+        self.assertEqual(self.db.hibernation_stats()['rehydrations'], 1)
+        for game_id in game_ids[1:]:
+            await self.db.make_move(game_id, 0, 'g1f3')
+        self.assertEqual((await self.db.get_game(game_ids[0])).current_turn, 2)
+        self.assertEqual(self.db.hibernation_stats()['resident'], 2)
+        await self.db.snapshot()
+        new_id, term_pass, owner = await self.db.add_game('owner')
+        await self.db.make_move(game_ids[1], 1, 'e7e6')
+        await self.db.close()
+        self.db = AsyncChessGameDB(None, self.db_path, self.log_dir)
+        # only the game with a move logged after the snapshot is decoded at startup, the others on first use
+        self.assertEqual(self.db.hibernation_stats()['resident'], 1)
+        self.assertEqual(self.db.hibernation_stats()['hibernated'], 4)
+        self.assertEqual([(await self.db.get_game(game_id)).current_turn for game_id in game_ids + [new_id]],
+                         [2, 2, 1, 1, 0])
+        self.assertEqual(self.db.hibernation_stats()['rehydrations'], 4)
+
+    async def test_idle_hibernation(self):
+        await self.db.close()
+        self.db = AsyncChessGameDB(None, self.db_path, self.log_dir, idle_timeout=0.05)
+        first_id, term_pass, owner = await self.db.add_game('owner')
+        await self.db.make_move(first_id, 0, 'e2e3')
+        await asyncio.sleep(0.1)
+        second_id, term_pass, owner = await self.db.add_game('owner')
+        self.assertEqual(self.db.hibernation_stats()['hibernated'], 1)
+        self.assertEqual((await self.db.get_game(first_id)).current_turn, 1)
+
+    async def test_clock_timeout(self):
+        await self.db.close()
+        self.db = AsyncChessGameDB(None, self.db_path, self.log_dir, clock_tick=0.01)
+        self.db.start_clocks()
+        game_id, term_pass, owner = await self.db.add_game('owner', time_control=(0.2, 0.0))
+        untimed_id, term_pass, owner = await self.db.add_game('owner')
+        subscription = self.db.subscribe(game_id)
+        await subscription.get()
+        etag, document = await self.db.game_state(game_id)
+        self.assertEqual(await self.db.make_move(game_id, 0, 'e2e3'), True)
+        self.assertEqual((await self.db.clock_state(game_id))['running'], 'black')
+        self.assertEqual(await self.db.clock_state(untimed_id), None)
+        # black never answers, the scheduler adjudicates within a few ticks
+        await asyncio.sleep(0.3)
+        self.assertEqual((await self.db.get_game(game_id)).who_won(), "White Won")
+        self.assertEqual(await self.db.make_move(game_id, 1, 'e7e6'), False)
+        await subscription.get()
+        self.assertEqual(json.loads(await subscription.get()),
+                         {'type': 'game_over', 'game_id': game_id, 'winner': "White Won", 'reason': 'time'})
+        self.assertNotEqual((await self.db.game_state(game_id))[0], etag)
+        self.assertEqual((await self.db.clock_state(game_id))['flagged'], 'black')
+        await self.db.close()
+        self.db = AsyncChessGameDB(None, self.db_path, self.log_dir)
+        self.assertEqual((await self.db.get_game(game_id)).who_won(), "White Won")
+        await self.db.snapshot()
+        await self.db.close()
+        self.db = AsyncChessGameDB(None, self.db_path, self.log_dir)
+        self.assertEqual((await self.db.clock_state(game_id))['flagged'], 'black')
+
+    async def test_clock_times_survive_restart(self):
+        game_id, term_pass, owner = await self.db.add_game('owner', time_control=(100.0, 0.0))
+        self.assertEqual(await self.db.make_move(game_id, 0, 'e2e3'), True)
+        await asyncio.sleep(0.2)
+        self.assertEqual(await self.db.make_move(game_id, 1, 'e7e6'), True)
+        # no snapshot is taken, the time black used is stored with its move
+        await self.db.close()
+        self.db = AsyncChessGameDB(None, self.db_path, self.log_dir)
+        clock = await self.db.clock_state(game_id)
+        self.assertLess(clock['black'], 99.85)
+        self.assertEqual(clock['running'], 'white')
+
+    async def test_clock_task_survives_errors(self):
+        await self.db.close()
+        self.db = AsyncChessGameDB(None, self.db_path, self.log_dir, clock_tick=0.01)
+        self.db.start_clocks()
+        game_id, term_pass, owner = await self.db.add_game('owner', time_control=(0.05, 0.0))
+        other_id, term_pass, owner = await self.db.add_game('owner', time_control=(0.05, 0.0))
+        check_clock = self.db.check_clock
+
+        async def failing_check(checked_id: str) -> bool:
+            if checked_id == game_id:
+                raise RuntimeError("adjudication failed")
+            return await check_clock(checked_id)
+
+        with mock.patch.object(self.db, 'check_clock', failing_check), \
+                self.assertLogs('chess_db', 'ERROR'):
+            await self.db.make_move(game_id, 0, 'e2e3')
+            await self.db.make_move(other_id, 0, 'e2e3')
+            await asyncio.sleep(0.2)
+        # the failing game did not keep the other one from being adjudicated, nor stop the task
+        self.assertEqual((await self.db.get_game(other_id)).who_won(), "White Won")
+        self.assertFalse(self.db._clock_task.done())
+
+    async def test_premoves(self):
+        game_id, term_pass, owner = await self.db.add_game('owner')
+        # black cannot queue replies before white has a move to make
+        self.assertEqual(await self.db.set_premoves(game_id, 0, {'*': {'reply': 'e2e3', 'then': {}}}), False)
+        line = {'g1f3': {'reply': 'g8f6', 'then': {'f3g1': {'reply': 'f6g8', 'then': {}}}},
+                '*': {'reply': 'e7e6', 'then': {}}}
+        self.assertEqual(await self.db.set_premoves(game_id, 1, line), True)
+        subscription = self.db.subscribe(game_id)
+        await subscription.get()
+        # each white move is answered in the same command, no request from black
+        self.assertEqual(await self.db.make_move(game_id, 0, 'g1f3'), True)
+        self.assertEqual((await self.db.get_game(game_id)).current_turn, 2)
+        self.assertEqual(await self.db.get_premoves(game_id, 1), {'f3g1': {'reply': 'f6g8', 'then': {}}})
+        # white deviates from the queued line, black's tree is abandoned
+        self.assertEqual(await self.db.make_move(game_id, 0, 'b1c3'), True)
+        self.assertEqual((await self.db.get_game(game_id)).current_turn, 3)
+        self.assertEqual(await self.db.get_premoves(game_id, 1), {})
+        events = [json.loads(await subscription.get()) for _ in range(3)]
+        self.assertEqual([(event['player'], event['move']) for event in events],
+                         [(0, 'g1f3'), (1, 'g8f6'), (0, 'b1c3')])
+        # both sides premoving play out their lines back to back
+        self.assertEqual(await self.db.set_premoves(game_id, 0, {'*': {'reply': 'c3b1', 'then': {}}}), True)
+        self.assertEqual(await self.db.make_move(game_id, 1, 'f6g8'), True)
+        self.assertEqual((await self.db.get_game(game_id)).current_turn, 5)
+
+    async def test_user_premoves(self):
+        (game_id, term_pass), = await self.db.add_games('owner', [['host', 'host']])
+        self.assertEqual(await self.db.set_user_premoves('host', str(uuid4()), {}), 'not_found')
+        self.assertEqual(await self.db.set_user_premoves('guest', game_id, {}), 'not_player')
+        # a user holding both seats queues replies for the side waiting for its opponent, black here
+        line = {'e2e3': {'reply': 'e7e6', 'then': {}}}
+        self.assertEqual(await self.db.set_user_premoves('host', game_id, line), 'queued')
+        self.assertEqual(await self.db.get_user_premoves('host', game_id), line)
+        self.assertEqual(await self.db.get_user_premoves('guest', game_id), None)
+        self.assertEqual(await self.db.make_moves('host', [(game_id, 'e2e3')]), ['played'])
+        self.assertEqual((await self.db.get_game(game_id)).current_turn, 2)
+        with self.assertRaises(KeyError):
+            await self.db.get_user_premoves('host', str(uuid4()))
+
+    async def test_results(self):
+        (game_id, term_pass), = await self.db.add_games('owner', [['white', 'black']])
+        moves = ['g1f3', 'g8f6', 'f3g1', 'f6g8'] * 2
+        for idx, move in enumerate(moves):
+            self.assertEqual(await self.db.make_move(game_id, idx % 2, move), True)
+        # the game is over, further moves are refused and the recorded result stays
+        self.assertEqual(await self.db.make_move(game_id, 0, 'g1f3'), False)
+        # only committed results are visible
+        self.assertEqual(await self.db.results_after(0), [])
+        # a move logged after the end, as older versions accepted, is not replayed
+        self.db._queue_log(game_id, len(moves), ChessGame.encode_move(Move().interpret_move(list('g1f3'))))
+        await self.db.flush()
+        self.assertEqual(await self.db.results_after(0), [(1, 'white', 'black', '1/2-1/2')])
+        await self.db.close()
+        self.db = AsyncChessGameDB(None, self.db_path, self.log_dir)
+        game = await self.db.get_game(game_id)
+        self.assertEqual((game.current_turn, game.who_won()), (len(moves), 'Draw'))
+        self.assertEqual(await self.db.make_move(game_id, 1, 'g8f6'), False)
+        other_id, term_pass, owner = await self.db.add_game('owner')
+        await self.db.flush()
+        self.assertEqual(await self.db.results_after(1), [])
+
+    async def test_export_results(self):
+        games = await self.db.add_games('owner', [['a', 'b'], ['b', 'c'], ['c', 'a']])
+        for game_id, term_pass in games:
+            for idx, move in enumerate(['g1f3', 'g8f6', 'f3g1', 'f6g8'] * 2):
+                await self.db.make_move(game_id, idx % 2, move)
+        await self.db.flush()
+        exported = [row async for row in self.db.export_results(batch_size=2)]
+        self.assertEqual([row[1] for row in exported], [game_id for game_id, term_pass in games])
+        self.assertEqual(len(exported[0][6]), 16)
+        self.assertEqual([row[1] async for row in self.db.export_results('a', batch_size=1)],
+                         [games[0][0], games[2][0]])
+        finished = exported[1][5]
+        self.assertEqual([row[1] async for row in self.db.export_results(since=finished)], [games[1][0], games[2][0]])
+        self.assertEqual([row async for row in self.db.export_results(until=exported[0][5])], [])
@@ -0,0 +1,49 @@
+from unittest import IsolatedAsyncioTestCase
+import json
+from chess.chess import ChessGame
+from game_broadcast import GameBroadcaster, board_diff, board_fen
+
+
+class TestGameBroadcaster(IsolatedAsyncioTestCase):
+    def play(self, game: ChessGame, player_idx: int, player_move: str) -> bool:
+        if not game.get_move(player_idx, player_move):
+            return False
+        game.execute_move(player_idx)
+        return True
+
+    async def test_board_encoding(self):
+        game = ChessGame()
+        before = game.encode_board()
+        self.assertEqual(board_fen(before), 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR')
+        self.play(game, 0, 'e2e3')
+        self.assertEqual(board_fen(game.encode_board()), 'rnbqkbnr/pppppppp/8/8/8/4P3/PPPP1PPP/RNBQKBNR')
+        self.assertEqual(board_diff(before, game.encode_board()), [['e3', 'P'], ['e2', '']])
+
+    async def test_fan_out(self):
+        game = ChessGame()
+        broadcaster = GameBroadcaster('game', game, max_pending=4)
+        fast = broadcaster.subscribe()
+        slow = broadcaster.subscribe()
+        self.assertEqual(json.loads(await fast.get())['board'], 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR')
+        moves = ['g1f3', 'g8f6', 'f3g1', 'f6g8'] * 2
+        for idx, player_move in enumerate(moves):
+            self.assertEqual(self.play(game, idx % 2, player_move), True)
+            broadcaster.publish_move(game, idx % 2, player_move)
+            self.assertEqual(json.loads(await fast.get())['move'], player_move)
+        # the slow subscriber never read, its backlog was coalesced into snapshots
+        received = []
+        while slow._pending:
+            received.append(json.loads(await slow.get()))
+        self.assertEqual(len(received) <= 4, True)
+        self.assertEqual(received[0]['type'], 'snapshot')
+        # the knights are back home for the third time
+        self.assertEqual(received[-2]['turn'], len(moves))
+        self.assertEqual(received[-1], {'type': 'game_over', 'game_id': 'game', 'winner': 'Draw'})
+        self.assertEqual(slow.dropped > 0, True)
+
+        self.assertEqual(json.loads(await fast.get())['type'], 'game_over')
+        broadcaster.unsubscribe(slow)
+        broadcaster.close()
+        self.assertEqual(json.loads(await fast.get())['type'], 'terminated')
+        self.assertEqual(await fast.get(), None)
+        self.assertEqual(len(broadcaster), 0)
@@ -0,0 +1,43 @@
+from unittest import IsolatedAsyncioTestCase
+from datetime import date, datetime, timezone
+import json
+from array import array
+from chess.chess import ChessGame, Move
+from game_export import export_chunks, export_range, pgn_game, ndjson_game
+
+
+def finished_game(moves, result='1/2-1/2'):
+    codes = array('H', [ChessGame.encode_move(Move().interpret_move(list(move))) for move in moves])
+    finished = datetime(2026, 10, 19, 12, tzinfo=timezone.utc).timestamp()
+    return 1, 'game-1', 'alice', 'bob "b"', result, finished, codes.tobytes()
+
+
+class TestGameExport(IsolatedAsyncioTestCase):
+    def test_pgn(self):
+        pgn = pgn_game(finished_game(['e2e3', 'e7e6', 'g1f3'], '*'))
+        self.assertIn('[Date "2026.10.19"]\n', pgn)
+        self.assertIn('[Black "bob \\"b\\""]\n', pgn)
+        self.assertTrue(pgn.endswith('\n\n1. e2e3 e7e6 2. g1f3 *\n\n'))
+        # long games wrap their movetext
+        pgn = pgn_game(finished_game(['g1f3', 'g8f6', 'f3g1', 'f6g8'] * 10))
+        movetext = pgn.split('\n\n')[1].split('\n')
+        self.assertGreater(len(movetext), 1)
+        self.assertTrue(all(len(line) < 80 for line in movetext))
+
+    def test_ndjson(self):
+        document = json.loads(ndjson_game(finished_game(['e2e3'])))
+        self.assertEqual((document['moves'], document['finished']), (['e2e3'], '2026-10-19T12:00:00+00:00'))
+
+    def test_export_range(self):
+        since, until = export_range(date(2026, 10, 19), date(2026, 10, 19))
+        self.assertEqual(until - since, 86400)
+        self.assertEqual(export_range(None, None), (None, None))
+
+    async def test_chunks(self):
+        async def games():
+            for _ in range(100):
+                yield finished_game(['e2e3'])
+
+        chunks = [chunk async for chunk in export_chunks(games(), 'ndjson', chunk_size=1000)]
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(b''.join(chunks).count(b'\n'), 100)
@@ -0,0 +1,87 @@
+from unittest import IsolatedAsyncioTestCase
+import asyncio
+import os
+import random
+import tempfile
+import time
+from chess_db import AsyncChessGameDB
+from matchmaking import MatchmakingQueue
+
+
+class TestMatchmakingQueue(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        asyncio.get_running_loop().set_debug(False)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db = AsyncChessGameDB(None, os.path.join(self.tmp_dir.name, 'games.sqlite3'),
+                                   os.path.join(self.tmp_dir.name, 'log'))
+
+        async def create_game(white, black, time_control):
+            (game_id, term_pass), = await self.db.add_games(white, [[white, black]], time_control)
+            return game_id, term_pass
+
+        self.queue = MatchmakingQueue(create_game)
+
+    async def asyncTearDown(self) -> None:
+        await self.db.close()
+        self.tmp_dir.cleanup()
+
+    async def test_pairing(self):
+        far = await self.queue.join('far', 1900)
+        near = await self.queue.join('near', 1540)
+        blitz = await self.queue.join('blitz', 1500, (180, 2))
+        self.assertEqual(len(self.queue), 3)
+        # the closest rating with the same time control is picked
+        ticket = await self.queue.join('new', 1500)
+        match = await self.queue.wait(ticket, 0)
+        self.assertEqual((match['color'], match['opponent'], match['opponent_rating']), ('black', 'near', 1540))
+        waited = await self.queue.wait(near, 0)
+        self.assertEqual((waited['color'], waited['opponent'], waited['game_id']), ('white', 'new', match['game_id']))
+        self.assertIn('termination_password', waited)
+        self.assertEqual(await self.db.game_info(match['game_id']), ('near', ['near', 'new']))
+        self.assertEqual(self.queue.ticket('near'), None)
+        # nobody else is within the window of a fresh ticket
+        self.assertEqual(await self.queue.wait(await self.queue.join('other', 1500), 0), None)
+        self.assertEqual(await self.queue.wait(far, 0), None)
+        self.assertEqual(self.queue.leave('far'), True)
+        with self.assertRaises(LookupError):
+            await self.queue.wait(far, 0)
+        match = await self.queue.wait(await self.queue.join('blitz2', 1450, (180, 2)), 0)
+        self.assertEqual(match['time_control'], (180, 2))
+        self.assertEqual((await self.db.get_game(match['game_id'])).clock.base, 180)
+        self.assertEqual(self.queue.stats()['matched'], 2)
+
+    async def test_failed_game_creation(self):
+        failures = [RuntimeError('database unavailable')]
+        create_game = self.queue._create_game
+
+        async def flaky_create_game(white, black, time_control):
+            if failures:
+                raise failures.pop()
+            return await create_game(white, black, time_control)
+
+        self.queue._create_game = flaky_create_game
+        waiting = await self.queue.join('waiting', 1500)
+        with self.assertLogs('matchmaking', 'ERROR'):
+            joining = await self.queue.join('joining', 1500)
+        # both players are back in the queue instead of seeing the error
+        self.assertEqual(await self.queue.wait(waiting, 0), None)
+        self.assertEqual(await self.queue.wait(joining, 0), None)
+        self.assertEqual(len(self.queue), 2)
+        match = await self.queue.wait(await self.queue.join('third', 1500), 0)
+        self.assertEqual((match['color'], match['opponent']), ('black', 'waiting'))
+        self.assertEqual(self.queue.ticket('joining'), joining)
+
+    async def test_many_waiting(self):
+        rng = random.Random(0)
+        # far apart time controls, so nobody is paired while the queue fills up
+        for idx in range(20000):
+            await self.queue.join(f'waiting{idx}', rng.uniform(800, 2800), (idx, 0))
+        for idx in range(2000):
+            await self.queue.join(f'player{idx}', rng.uniform(800, 2800), (60, 0))
+        start = time.perf_counter()
+        for idx in range(2000):
+            await self.queue.join(f'joining{idx}', rng.uniform(800, 2800), (60, 0))
+        elapsed = time.perf_counter() - start
+        # bucket lookups keep joins fast however many players are waiting
+        self.assertGreater(2000 / elapsed, 400)
+        self.assertGreater(self.queue.stats()['matched'], 1500)
@@ -0,0 +1,52 @@
+from unittest import TestCase
+import os
+import random
+import tempfile
+from ratings import Leaderboard, RatingService
+
+
+class TestLeaderboard(TestCase):
+    def test_matches_sorted_list(self):
+        rng = random.Random(0)
+        leaderboard = Leaderboard()
+        ratings = {}
+        for step in range(5000):
+            username = f'user{rng.randrange(800)}'
+            if username in ratings and rng.random() < 0.2:
+                leaderboard.remove(username)
+                del ratings[username]
+            else:
+                ratings[username] = round(rng.uniform(1000, 2000))
+                leaderboard.set(username, ratings[username])
+        expected = sorted(ratings.items(), key=lambda item: (-item[1], item[0]))
+        self.assertEqual(len(leaderboard), len(expected))
+        self.assertEqual(leaderboard.top(len(expected) + 10), expected)
+        self.assertEqual(leaderboard.top(25, 100), expected[100:125])
+        for rank, (username, rating) in enumerate(expected, 1):
+            self.assertEqual(leaderboard.rank(username), rank)
+        self.assertEqual(leaderboard.rank('nobody'), None)
+
+
+class TestRatingService(TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp_dir.name, 'ratings.sqlite3')
+        self.ratings = RatingService(self.db_path)
+
+    def tearDown(self) -> None:
+        self.ratings.close()
+        self.tmp_dir.cleanup()
+
+    def test_results(self):
+        self.ratings.record('a', 'b', '1-0')
+        self.assertEqual((self.ratings.rating('a'), self.ratings.rating('b')), (1520, 1480))
+        self.ratings.apply_results('shard', [(1, 'b', 'c', '1/2-1/2'), (2, 'a', 'a', '1-0'), (3, 'c', None, '0-1'),
+                                             (4, 'c', 'a', '*')])
+        self.assertEqual(self.ratings.cursor('shard'), 4)
+        self.assertEqual([username for username, rating in self.ratings.leaderboard.top(3)], ['a', 'c', 'b'])
+        self.assertEqual(self.ratings.games('a'), 1)
+        self.ratings.close()
+        self.ratings = RatingService(self.db_path)
+        self.assertEqual((self.ratings.cursor('shard'), self.ratings.cursor('other')), (4, 0))
+        self.assertEqual(self.ratings.leaderboard.rank('b'), 3)
+        self.assertEqual(self.ratings.rating('new'), 1500)
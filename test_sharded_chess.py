@@ -0,0 +1,192 @@
+from unittest import TestCase, mock
+import importlib
+import json
+import os
+import secrets
+import subprocess
+import sys
+import tempfile
+import time
+import httpx
+from fastapi.testclient import TestClient
+from starlette.websockets import WebSocketDisconnect
+from chess_db import shard_for_game
+from shared_game_store import SharedGameStore
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+NUM_SHARDS = 2
+
+
+class TestShardedChess(TestCase):
+    """
+    Runs the router in process against two real shard workers listening on
+    unix sockets, the same way sharded_chess.main starts them.
+    """
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.tmp_dir = tempfile.TemporaryDirectory()
+        cls.cwd = os.getcwd()
+        # every process keeps its databases in the working directory
+        os.chdir(cls.tmp_dir.name)
+        store_name = f'chess_test_router_{os.getpid()}'
+        cls.environ = mock.patch.dict(os.environ, {
+            'CHESS_SHARD_COUNT': str(NUM_SHARDS), 'CHESS_SOCKET_DIR': cls.tmp_dir.name,
+            'CHESS_SHARED_STORE': store_name, 'CHESS_SESSION_KEY': secrets.token_hex(32)})
+        cls.environ.start()
+        cls.store = SharedGameStore(store_name, 1024, create=True)
+        cls.sharded = importlib.reload(sys.modules['sharded_chess']) if 'sharded_chess' in sys.modules \
+            else importlib.import_module('sharded_chess')
+        cls.sharded.RATING_INTERVAL = 0.05
+        cls.sharded.REPLICATION_INTERVAL = 0.05
+        cls.workers = []
+        for shard_index in range(NUM_SHARDS):
+            env = dict(os.environ, CHESS_SHARD_INDEX=str(shard_index), PYTHONPATH=REPO_DIR)
+            cls.workers.append(subprocess.Popen(
+                [sys.executable, '-m', 'uvicorn', 'web_chess:app', '--uds', cls.sharded.shard_socket(shard_index),
+                 '--log-level', 'warning'], env=env))
+        deadline = time.monotonic() + 30
+        while not all(os.path.exists(cls.sharded.shard_socket(idx)) for idx in range(NUM_SHARDS)):
+            if time.monotonic() > deadline:
+                cls.tearDownClass()
+                raise RuntimeError("shard workers did not start")
+            time.sleep(0.05)
+        cls.client = TestClient(cls.sharded.router)
+        cls.client.__enter__()
+        cls.tokens = {}
+        for username in ('alice', 'bob'):
+            response = cls.client.post('/user/create', params={'username': username})
+            password = response.json()['password']
+            cls.tokens[username] = cls.client.post('/user/login', auth=(username, password)).json()['token']
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        if getattr(cls, 'client', None) is not None:
+            cls.client.__exit__(None, None, None)
+        for worker in cls.workers:
+            worker.terminate()
+            worker.wait()
+        cls.store.close()
+        cls.store.unlink()
+        cls.environ.stop()
+        os.chdir(cls.cwd)
+        cls.tmp_dir.cleanup()
+
+    def auth(self, username: str) -> dict:
+        return {'Authorization': f'Bearer {self.tokens[username]}'}
+
+    def create_games(self, count: int) -> list:
+        response = self.client.post('/game/create_games', headers=self.auth('alice'),
+                                    json={'games': [['alice', 'bob']] * count})
+        self.assertEqual(response.status_code, 201)
+        return [game['game_id'] for game in response.json()['games']]
+
+    def test_accounts_are_replicated(self):
+        # a Basic auth request is checked by the owning shard against its copy of the account
+        password = self.client.post('/user/create', params={'username': 'carol'}).json()['password']
+        game_id = self.client.get('/game/create_game', auth=('carol', password)).json()['game_id']
+        response = self.client.get(f'/game/{game_id}/get_player_idx', params={'username': 'carol'},
+                                   auth=('carol', password))
+        self.assertEqual(response.json()['player_idx'], 0)
+        # a revoked token is refused by every shard
+        token = self.client.post('/user/login', auth=('carol', password)).json()['token']
+        headers = {'Authorization': f'Bearer {token}'}
+        self.assertEqual(self.client.post('/user/logout', headers=headers).status_code, 200)
+        response = self.client.get(f'/game/{game_id}/get_player_idx', params={'username': 'carol'}, headers=headers)
+        self.assertEqual(response.status_code, 401)
+
+    def test_account_replication_retried(self):
+        client = self.sharded._clients[1]
+        with mock.patch.object(client, 'put', side_effect=httpx.ConnectError("shard down")):
+            response = self.client.post('/user/create', params={'username': 'dave'})
+        self.assertEqual(response.status_code, 201)
+        password = response.json()['password']
+        # the shard that was down gets the account on a later pass
+        game_id = next(game_id for game_id in self.create_games(4) if shard_for_game(game_id, NUM_SHARDS) == 1)
+        deadline = time.monotonic() + 10
+        while True:
+            response = self.client.get(f'/game/{game_id}/get_player_idx', params={'username': 'bob'},
+                                       auth=('dave', password))
+            if response.status_code != 401 or time.monotonic() > deadline:
+                break
+            time.sleep(0.05)
+        self.assertEqual(response.json()['player_idx'], 1)
+
+    def test_game_channel_shard_down(self):
+        game_id, = self.create_games(1)
+        with mock.patch.object(self.sharded, 'unix_connect', mock.AsyncMock(side_effect=ConnectionRefusedError)):
+            with self.assertRaises(WebSocketDisconnect) as raised:
+                with self.client.websocket_connect(f'/game/{game_id}/ws', headers=self.auth('alice')):
+                    pass
+        self.assertEqual(raised.exception.code, 1013)
+
+    def test_forwarding(self):
+        game_ids = self.create_games(6)
+        self.assertEqual(len({shard_for_game(game_id, NUM_SHARDS) for game_id in game_ids}), NUM_SHARDS)
+        response = self.client.get(f'/game/{game_ids[0]}/legal_moves')
+        self.assertIn('e2e3', response.json()['legal_moves'])
+        self.assertEqual(self.client.get('/game/not-a-game/legal_moves').status_code, 404)
+        # answered from the shared store, then revalidated
+        response = self.client.get(f'/game/{game_ids[1]}/state')
+        self.assertEqual(response.json()['turn'], 0)
+        response = self.client.get(f'/game/{game_ids[1]}/state', headers={'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+    def test_batch_moves(self):
+        game_ids = self.create_games(4)
+        batch = [{'game_id': game_id, 'move': 'e2e3'} for game_id in game_ids] + \
+            [{'game_id': 'not-a-game', 'move': 'e2e3'}, {'game_id': game_ids[0], 'move': 'e3e4'}]
+        results = self.client.post('/moves/batch', headers=self.auth('alice'), json=batch).json()['results']
+        self.assertEqual([result['result'] for result in results], ['played'] * 4 + ['not_found', 'invalid'])
+        self.assertEqual([result['game_id'] for result in results], [move['game_id'] for move in batch])
+        results = self.client.post('/moves/batch', headers=self.auth('bob'),
+                                   json=[{'game_id': game_ids[2], 'move': 'e7e6'}]).json()['results']
+        self.assertEqual(results[0]['success'], True)
+        self.assertEqual(self.client.post('/moves/batch', json=batch).status_code, 401)
+        self.assertEqual(self.client.post('/moves/batch', headers=self.auth('alice'), json=[{}]).status_code, 422)
+
+    def test_list_games(self):
+        game_ids = self.create_games(5)
+        listed = []
+        cursor = None
+        while True:
+            params = {'player': 'bob', 'limit': 2}
+            if cursor is not None:
+                params['cursor'] = cursor
+            page = self.client.get('/games', params=params).json()
+            self.assertLessEqual(len(page['games']), 2)
+            listed.extend(game['game_id'] for game in page['games'])
+            cursor = page['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(len(listed), len(set(listed)))
+        self.assertLessEqual(set(game_ids), set(listed))
+        # a cursor pointing past the last shard ends the listing
+        self.assertEqual(self.client.get('/games', params={'cursor': f'{NUM_SHARDS}.'}).json()['games'], [])
+        self.assertEqual(self.client.get('/games', params={'cursor': 'x'}).status_code, 422)
+
+    def test_game_channel(self):
+        game_id, = self.create_games(1)
+        with self.client.websocket_connect(f'/game/{game_id}/ws', headers=self.auth('alice')) as websocket:
+            self.assertEqual(websocket.receive_json()['type'], 'snapshot')
+            websocket.send_text(json.dumps({'move': 'e2e3'}))
+            event = websocket.receive_json()
+            self.assertEqual((event['type'], event['move']), ('move', 'e2e3'))
+            websocket.send_text(json.dumps({'move': 'e7e6'}))
+            self.assertEqual(websocket.receive_json()['type'], 'error')
+
+    def test_finished_games(self):
+        game_id, = self.create_games(1)
+        for idx, move in enumerate(['g1f3', 'g8f6', 'f3g1', 'f6g8'] * 2):
+            response = self.client.post('/moves/batch', headers=self.auth('bob' if idx % 2 else 'alice'),
+                                        json=[{'game_id': game_id, 'move': move}])
+            self.assertEqual(response.json()['results'][0]['result'], 'played')
+        self.assertEqual(self.client.get(f'/game/{game_id}/winners').json()['winner'], 'Draw')
+        # the router rates the games of every shard
+        deadline = time.monotonic() + 10
+        while self.client.get('/user/alice/rating').json()['games'] == 0 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(self.client.get('/user/alice/rating').json()['rank'] is not None, True)
+        response = self.client.get('/games/export', params={'format': 'ndjson', 'player': 'alice'})
+        games = [json.loads(line) for line in response.text.splitlines()]
+        self.assertIn(game_id, [game['game_id'] for game in games])
@@ -0,0 +1,35 @@
+from unittest import TestCase
+import random
+from timer_wheel import TimerWheel
+
+
+class TestTimerWheel(TestCase):
+    def test_deadlines(self):
+        # small wheel so deadlines cascade through every level and the overflow table
+        wheel = TimerWheel(tick=1.0, slots=4, levels=2)
+        rng = random.Random(0)
+        deadlines = {key: rng.uniform(0, 200) for key in range(500)}
+        for key, deadline in deadlines.items():
+            wheel.schedule(key, deadline)
+        fired = {}
+        for now in range(201):
+            for key in wheel.advance(now):
+                fired[key] = now
+        self.assertEqual(len(wheel), 0)
+        for key, deadline in deadlines.items():
+            # a timer fires at the first tick at or after its deadline
+            self.assertGreaterEqual(fired[key], deadline)
+            self.assertLess(fired[key] - deadline, 1.0)
+
+    def test_reschedule_and_cancel(self):
+        wheel = TimerWheel(tick=0.1)
+        wheel.schedule('a', 1.0)
+        wheel.schedule('b', 1.0)
+        wheel.schedule('a', 5.0)
+        wheel.cancel('b')
+        self.assertEqual(wheel.advance(2.0), [])
+        self.assertIn('a', wheel)
+        self.assertEqual(wheel.advance(5.0), ['a'])
+        # deadlines already in the past fire on the next tick
+        wheel.schedule('c', 1.0)
+        self.assertEqual(wheel.advance(5.1), ['c'])
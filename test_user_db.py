@@ -0,0 +1,117 @@
+import asyncio
+import os
+import tempfile
+from unittest import TestCase, IsolatedAsyncioTestCase, mock
+from user_db import UserDB, HashQueueFull, load_session_key
+
+
+class TestUserDB(TestCase):
+    def setUp(self) -> None:
+        self.user_db = UserDB()
+        self.username, self.password = self.user_db.create_user('player')
+
+    def test_session(self):
+        self.assertEqual(self.user_db.create_session(self.username, 'wrong'), None)
+        token, expiry = self.user_db.create_session(self.username, self.password)
+        self.assertEqual(self.user_db.check_session(token), self.username)
+        self.assertEqual(UserDB(b'other key').check_session(token), None)
+        session_id, expiry, username, signature = token.split('.')
+        self.assertEqual(self.user_db.check_session('.'.join([session_id, str(int(expiry) + 60), username,
+                                                              signature])), None)
+        self.assertEqual(self.user_db.check_session('garbage'), None)
+        self.assertEqual(self.user_db.revoke_session(token), True)
+        self.assertEqual(self.user_db.check_session(token), None)
+        self.assertEqual(self.user_db.revoke_session(token), False)
+
+    def test_revocation_expiry(self):
+        token, expiry = self.user_db.create_session(self.username, self.password)
+        self.user_db.revoke_session(token)
+        # once the token has expired its revocation is forgotten on the next revoke
+        with mock.patch('user_db.time.time', return_value=expiry + 1):
+            self.assertEqual(self.user_db.check_session(token), None)
+            later_token, later_expiry = self.user_db.create_session(self.username, self.password)
+            self.assertEqual(self.user_db.revoke_session(later_token), True)
+        self.assertEqual(self.user_db._revoked_sessions, {later_token.split('.')[0]: later_expiry})
+
+    def test_session_expiry(self):
+        user_db = UserDB(session_ttl=-1)
+        username, password = user_db.create_user('player')
+        token, expiry = user_db.create_session(username, password)
+        self.assertEqual(user_db.check_session(token), None)
+
+    def test_persistent_accounts(self):
+        with tempfile.TemporaryDirectory() as directory:
+            db_path = os.path.join(directory, 'users.sqlite3')
+            user_db = UserDB(db_path=db_path, cache_size=1)
+            username, password = user_db.create_user('player')
+            other_username, other_password = user_db.create_user('other')
+            # 'player' was evicted from the cache and is read back from the database
+            self.assertEqual(user_db.is_valid(username, password), True)
+            user_db.close()
+
+            user_db = UserDB(db_path=db_path)
+            self.assertEqual(user_db.is_valid(username, password), True)
+            self.assertEqual(user_db.is_valid(other_username, other_password), True)
+            self.assertEqual(user_db.is_valid(username, other_password), False)
+            with self.assertRaises(ValueError):
+                user_db.create_user('player')
+            with self.assertRaises(KeyError):
+                user_db.password_hash('nobody')
+            user_db.close()
+
+    def test_persistent_revocations(self):
+        with tempfile.TemporaryDirectory() as directory:
+            db_path = os.path.join(directory, 'users.sqlite3')
+            user_db = UserDB(session_key=b'key', db_path=db_path)
+            username, password = user_db.create_user('player')
+            token, expiry = user_db.create_session(username, password)
+            other_token, other_expiry = user_db.create_session(username, password)
+            self.assertEqual(user_db.revoke_session(token), True)
+            user_db.close()
+
+            user_db = UserDB(session_key=b'key', db_path=db_path)
+            self.assertEqual(user_db.check_session(token), None)
+            self.assertEqual(user_db.check_session(other_token), username)
+            user_db.close()
+
+    def test_session_key_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            key_path = os.path.join(directory, 'session.key')
+            user_db = UserDB(session_key=load_session_key(key_path))
+            username, password = user_db.create_user('player')
+            token, expiry = user_db.create_session(username, password)
+            user_db.close()
+            self.assertEqual(os.stat(key_path).st_mode & 0o777, 0o600)
+            self.assertEqual(os.listdir(directory), ['session.key'])
+            # a restarted server reads the same key and accepts the tokens it signed before
+            user_db = UserDB(session_key=load_session_key(key_path))
+            self.assertEqual(user_db.check_session(token), username)
+            user_db.close()
+            with open(key_path, 'wb') as key_file:
+                key_file.write(b'short')
+            with self.assertRaises(ValueError):
+                load_session_key(key_path)
+
+
+class TestAsyncUserDB(IsolatedAsyncioTestCase):
+    async def test_async_hashing(self):
+        user_db = UserDB(hash_workers=2, max_pending_hashes=2)
+        username, password = await user_db.create_user_async('player')
+        self.assertEqual(user_db.is_valid(username, password), True)
+        self.assertEqual(await user_db.is_valid_async(username, password), True)
+        self.assertEqual(await user_db.is_valid_async(username, 'wrong'), False)
+        self.assertEqual(await user_db.is_valid_async('nobody', password), False)
+        token, expiry = await user_db.create_session_async(username, password)
+        self.assertEqual(user_db.check_session(token), username)
+        with self.assertRaises(ValueError):
+            await user_db.create_user_async('player')
+
+        results = await asyncio.gather(*[user_db.is_valid_async(username, password) for _ in range(4)],
+                                       return_exceptions=True)
+        self.assertEqual(results[:2], [True, True])
+        self.assertEqual(all(isinstance(result, HashQueueFull) for result in results[2:]), True)
+        stats = user_db.hash_stats()
+        self.assertEqual(stats['pending'], 0)
+        self.assertEqual(stats['completed'], 6)
+        self.assertEqual(stats['rejected'], 2)
+        user_db.close()
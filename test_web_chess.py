@@ -0,0 +1,244 @@
+from unittest import TestCase, mock
+import importlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+from fastapi.testclient import TestClient
+from starlette.websockets import WebSocketDisconnect
+
+
+class TestWebChess(TestCase):
+    """
+    Runs the single process server in process, with its databases in a temporary directory.
+    """
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.tmp_dir = tempfile.TemporaryDirectory()
+        cls.cwd = os.getcwd()
+        os.chdir(cls.tmp_dir.name)
+        cls.environ = mock.patch.dict(os.environ)
+        cls.environ.start()
+        for name in ('CHESS_SHARD_INDEX', 'CHESS_SHARD_COUNT', 'CHESS_SHARED_STORE', 'CHESS_SESSION_KEY',
+                     'CHESS_SESSION_KEY_FILE'):
+            os.environ.pop(name, None)
+        cls.web = importlib.reload(sys.modules['web_chess']) if 'web_chess' in sys.modules \
+            else importlib.import_module('web_chess')
+        cls.imported_files = os.listdir()
+        cls.client = TestClient(cls.web.app)
+        cls.client.__enter__()
+        cls.tokens = {}
+        for username in ('alice', 'bob', 'carol', 'dave'):
+            response = cls.client.post('/user/create', params={'username': username})
+            password = response.json()['password']
+            cls.tokens[username] = cls.client.post('/user/login', auth=(username, password)).json()['token']
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.client.__exit__(None, None, None)
+        cls.environ.stop()
+        os.chdir(cls.cwd)
+        cls.tmp_dir.cleanup()
+
+    def auth(self, username: str) -> dict:
+        return {'Authorization': f'Bearer {self.tokens[username]}'}
+
+    def create_games(self, count: int, players: list = ('alice', 'bob')) -> list:
+        response = self.client.post('/game/create_games', headers=self.auth('alice'),
+                                    json={'games': [list(players)] * count})
+        self.assertEqual(response.status_code, 201)
+        return [(game['game_id'], game['termination_password']) for game in response.json()['games']]
+
+    def test_databases_opened_on_startup(self):
+        # importing the module creates nothing, the databases are opened by the lifespan handler
+        self.assertEqual(self.imported_files, [])
+        self.assertIn('chess_users.sqlite3', os.listdir())
+        # without CHESS_SESSION_KEY tokens are signed with the key file, so they survive restarts
+        with open('chess_session.key', 'rb') as key_file:
+            self.assertEqual(key_file.read(), self.web.SESSION_KEY)
+
+    def test_game_channel(self):
+        (game_id, term_pass), = self.create_games(1)
+        with self.assertRaises(WebSocketDisconnect):
+            with self.client.websocket_connect(f'/game/{game_id}/ws') as websocket:
+                websocket.receive_json()
+        with self.assertRaises(WebSocketDisconnect):
+            with self.client.websocket_connect('/game/not-a-game/ws', headers=self.auth('alice')) as websocket:
+                websocket.receive_json()
+        with self.client.websocket_connect(f'/game/{game_id}/ws', headers=self.auth('alice')) as white, \
+                self.client.websocket_connect(f'/game/{game_id}/ws?token={self.tokens["carol"]}') as spectator:
+            self.assertEqual(white.receive_json()['type'], 'snapshot')
+            self.assertEqual(spectator.receive_json()['type'], 'snapshot')
+            white.send_text(json.dumps({'move': 'e2e3'}))
+            for websocket in (white, spectator):
+                event = websocket.receive_json()
+                self.assertEqual((event['type'], event['move']), ('move', 'e2e3'))
+            # moves played over HTTP reach the channel too
+            response = self.client.post('/moves/batch', headers=self.auth('bob'),
+                                        json=[{'game_id': game_id, 'move': 'e7e6'}])
+            self.assertEqual(response.json()['results'][0]['result'], 'played')
+            self.assertEqual(white.receive_json()['move'], 'e7e6')
+            self.assertEqual(spectator.receive_json()['move'], 'e7e6')
+            white.send_text('not json')
+            self.assertEqual(white.receive_json()['type'], 'error')
+            spectator.send_text(json.dumps({'move': 'd2d3'}))
+            self.assertEqual(spectator.receive_json()['detail'], 'Not a player of this game')
+            white.send_text(json.dumps({'move': 'e3e5'}))
+            self.assertEqual(white.receive_json()['detail'], 'Invalid move')
+            response = self.client.post(f'/game/{game_id}/terminate', params={'password': term_pass},
+                                        headers=self.auth('alice'))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(white.receive_json()['type'], 'terminated')
+            self.assertEqual(spectator.receive_json()['type'], 'terminated')
+
+    def test_game_events(self):
+        (game_id, term_pass), = self.create_games(1)
+        self.assertEqual(self.client.get('/game/not-a-game/events').status_code, 404)
+        responses = []
+        # the stream only ends, and the test client only returns, once the game is terminated
+        reader = threading.Thread(target=lambda: responses.append(self.client.get(f'/game/{game_id}/events')))
+        reader.start()
+        deadline = time.monotonic() + 10
+        while game_id not in self.web.CHESS_DB._broadcasters and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.client.post('/moves/batch', headers=self.auth('alice'), json=[{'game_id': game_id, 'move': 'e2e3'}])
+        self.client.post(f'/game/{game_id}/terminate', params={'password': term_pass}, headers=self.auth('alice'))
+        reader.join(10)
+        response, = responses
+        self.assertEqual(response.headers['content-type'].split(';')[0], 'text/event-stream')
+        events = [json.loads(line[len('data: '):]) for line in response.text.split('\n\n') if line]
+        self.assertEqual([event['type'] for event in events], ['snapshot', 'move', 'terminated'])
+        self.assertEqual(events[1]['move'], 'e2e3')
+
+    def test_state(self):
+        (game_id, term_pass), = self.create_games(1)
+        self.assertEqual(self.client.get('/game/not-a-game/state').status_code, 404)
+        response = self.client.get(f'/game/{game_id}/state')
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+        self.assertEqual((response.json()['game_id'], response.json()['turn']), (game_id, 0))
+        response = self.client.get(f'/game/{game_id}/state', headers={'If-None-Match': etag})
+        self.assertEqual((response.status_code, response.headers['ETag'], response.content), (304, etag, b''))
+        self.assertEqual(self.client.get(f'/game/{game_id}/state', headers={'If-None-Match': '*'}).status_code, 304)
+        # a move changes the document and its tag
+        self.client.post('/moves/batch', headers=self.auth('alice'), json=[{'game_id': game_id, 'move': 'e2e3'}])
+        response = self.client.get(f'/game/{game_id}/state', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertEqual(response.json()['turn'], 1)
+
+    def test_batch_moves(self):
+        game_ids = [game_id for game_id, term_pass in self.create_games(3)]
+        batch = [{'game_id': game_id, 'move': 'e2e3'} for game_id in game_ids] + \
+            [{'game_id': 'not-a-game', 'move': 'e2e3'}, {'game_id': game_ids[0], 'move': 'e3e5'}]
+        self.assertEqual(self.client.post('/moves/batch', json=batch).status_code, 401)
+        results = self.client.post('/moves/batch', headers=self.auth('alice'), json=batch).json()['results']
+        self.assertEqual([result['result'] for result in results], ['played'] * 3 + ['not_found', 'invalid'])
+        self.assertEqual([result['success'] for result in results], [True] * 3 + [False, False])
+        results = self.client.post('/moves/batch', headers=self.auth('carol'),
+                                   json=[{'game_id': game_ids[0], 'move': 'e7e6'}]).json()['results']
+        self.assertEqual(results[0]['result'], 'not_player')
+        # moves on the same game are played in order
+        results = self.client.post('/moves/batch', headers=self.auth('bob'),
+                                   json=[{'game_id': game_ids[1], 'move': 'e7e6'},
+                                         {'game_id': game_ids[1], 'move': 'e6e5'}]).json()['results']
+        self.assertEqual([result['result'] for result in results], ['played', 'invalid'])
+        # against themselves, a player moves both sides
+        (own_game, term_pass), = self.create_games(1, ('alice', 'alice'))
+        results = self.client.post('/moves/batch', headers=self.auth('alice'),
+                                   json=[{'game_id': own_game, 'move': 'e2e3'},
+                                         {'game_id': own_game, 'move': 'e7e6'}]).json()['results']
+        self.assertEqual([result['result'] for result in results], ['played', 'played'])
+        response = self.client.post(f'/game/{own_game}/player/0/d2d3', headers=self.auth('alice'))
+        self.assertEqual(response.status_code, 200)
+        response = self.client.post(f'/game/{own_game}/player/1/d7d6', headers=self.auth('alice'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.post(f'/game/{own_game}/player/2/d3d4', headers=self.auth('alice')).status_code,
+                         401)
+        self.assertEqual(self.client.post('/moves/batch', headers=self.auth('alice'), json=[{}]).status_code, 422)
+        with mock.patch.object(self.web, 'MAX_BATCH_MOVES', 2):
+            response = self.client.post('/moves/batch', headers=self.auth('alice'), json=batch)
+        self.assertEqual(response.status_code, 413)
+
+    def test_premoves(self):
+        (game_id, term_pass), = self.create_games(1)
+        line = {'e2e3': {'reply': 'e7e6', 'then': {}}}
+        response = self.client.put(f'/game/{game_id}/premoves', headers=self.auth('bob'), json=line)
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(f'/game/{game_id}/premoves', headers=self.auth('bob'))
+        self.assertEqual(response.json()['premoves'], line)
+        self.assertEqual(self.client.put(f'/game/{game_id}/premoves', headers=self.auth('alice'),
+                                         json=line).status_code, 409)
+        self.assertEqual(self.client.get(f'/game/{game_id}/premoves', headers=self.auth('carol')).status_code, 401)
+        for method in ('get', 'put'):
+            response = self.client.request(method, '/game/not-a-game/premoves', headers=self.auth('bob'), json={})
+            self.assertEqual(response.status_code, 404)
+
+    def test_list_games(self):
+        game_ids = [game_id for game_id, term_pass in self.create_games(5, ('bob', 'carol'))]
+        listed = []
+        cursor = None
+        while True:
+            params = {'player': 'carol', 'limit': 2}
+            if cursor is not None:
+                params['cursor'] = cursor
+            page = self.client.get('/games', params=params).json()
+            self.assertLessEqual(len(page['games']), 2)
+            self.assertTrue(all(game['players'] == ['bob', 'carol'] for game in page['games']))
+            listed.extend(game['game_id'] for game in page['games'])
+            cursor = page['next_cursor']
+            if cursor is None:
+                break
+        # newest first
+        self.assertEqual(listed, game_ids[::-1])
+        owned_id = self.client.get('/game/create_game', headers=self.auth('bob')).json()['game_id']
+        games = self.client.get('/games', params={'owner': 'bob'}).json()['games']
+        self.assertEqual([(game['game_id'], game['owner']) for game in games], [(owned_id, 'bob')])
+        self.assertEqual(self.client.get('/games', params={'limit': 0}).status_code, 422)
+        self.assertEqual(self.client.get('/games', params={'cursor': 'x'}).status_code, 422)
+
+    def test_export_games(self):
+        (game_id, term_pass), = self.create_games(1, ('dave', 'bob'))
+        moves = ['g1f3', 'g8f6', 'f3g1', 'f6g8'] * 2
+        for idx, move in enumerate(moves):
+            response = self.client.post('/moves/batch', headers=self.auth('bob' if idx % 2 else 'dave'),
+                                        json=[{'game_id': game_id, 'move': move}])
+            self.assertEqual(response.json()['results'][0]['result'], 'played')
+        # results are exported once the batched writes are committed
+        deadline = time.monotonic() + 10
+        response = self.client.get('/games/export', params={'format': 'ndjson', 'player': 'dave'})
+        while not response.text and time.monotonic() < deadline:
+            time.sleep(0.05)
+            response = self.client.get('/games/export', params={'format': 'ndjson', 'player': 'dave'})
+        self.assertEqual(response.headers['content-type'], 'application/x-ndjson')
+        self.assertEqual(response.headers['content-disposition'], 'attachment; filename="games.ndjson"')
+        games = [json.loads(line) for line in response.text.splitlines()]
+        self.assertEqual([(game['game_id'], game['white'], game['black'], game['result'], game['moves'])
+                          for game in games], [(game_id, 'dave', 'bob', '1/2-1/2', moves)])
+        response = self.client.get('/games/export', params={'player': 'dave', 'since': str(date.today())})
+        self.assertEqual(response.headers['content-type'], 'application/x-chess-pgn')
+        self.assertIn('[White "dave"]\n', response.text)
+        self.assertIn(f'[GameId "{game_id}"]\n', response.text)
+        yesterday = date.today() - timedelta(days=1)
+        response = self.client.get('/games/export', params={'player': 'dave', 'until': str(yesterday)})
+        self.assertEqual((response.status_code, response.text), (200, ''))
+        self.assertEqual(self.client.get('/games/export', params={'format': 'xml'}).status_code, 422)
+
+    def test_matchmaking(self):
+        self.web.RATINGS.record('alice', 'carol', '1-0')
+        # a rating sent by the client is ignored
+        response = self.client.post('/matchmaking/join', params={'wait': 0}, headers=self.auth('carol'),
+                                    json={'rating': 2500, 'base': 600})
+        self.assertEqual((response.status_code, response.json()['rating']), (202, self.web.RATINGS.rating('carol')))
+        self.assertLess(response.json()['rating'], 1500)
+        response = self.client.post('/matchmaking/join', params={'wait': 0}, headers=self.auth('dave'),
+                                    json={'rating': 1000, 'base': 600})
+        self.assertEqual(response.json()['status'], 'matched')
+        self.assertEqual((response.json()['opponent'], response.json()['opponent_rating']),
+                         ('carol', self.web.RATINGS.rating('carol')))
+        response = self.client.get('/matchmaking', params={'wait': 0}, headers=self.auth('carol'))
+        self.assertEqual(response.json()['opponent'], 'dave')
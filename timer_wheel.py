@@ -0,0 +1,114 @@
+from typing import Dict, Hashable, List, Tuple
+import math
+
+
+class TimerWheel(object):
+    """
+    Hierarchical timing wheel.  Level 0 has one slot per tick, every level
+    above has slots that span a full turn of the level below; a timer is put
+    in the lowest level whose turn contains its deadline and moves down a
+    level whenever the wheel reaches its slot, until it expires from level 0.
+    Scheduling and cancelling are O(1), and advancing costs O(1) per tick plus
+    the timers that expire or move down, however many timers are pending.
+    Deadlines further away than the top level can hold wait in an overflow
+    table that is only rescanned once per turn of the top level.
+    """
+
+    def __init__(self, tick: float = 0.1, slots: int = 64, levels: int = 4, now: float = 0.0):
+        """
+        :param tick: seconds per level 0 slot, timers fire at most one tick late
+        :param slots: slots per level
+        :param levels: number of levels, together they hold tick * slots ** levels seconds
+        :param now: current time, in the unit of the deadlines
+        """
+        self.tick = tick
+        self._slots = slots
+        self._levels = levels
+        self._wheels: List[List[Dict[Hashable, int]]] = [[{} for _ in range(slots)] for _ in range(levels)]
+        self._overflow: Dict[Hashable, int] = {}
+        # key -> (level, slot), level == levels for the overflow table
+        self._where: Dict[Hashable, Tuple[int, int]] = {}
+        self._current = self._ticks(now)
+
+    def _ticks(self, now: float) -> int:
+        # tolerates float error such as 5.1 / 0.1 == 50.99999999999999
+        return math.floor(now / self.tick + 1e-9)
+
+    def __len__(self) -> int:
+        return len(self._where)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._where
+
+    def _place(self, key: Hashable, expiry: int):
+        # an expired deadline fires on the next tick
+        expiry = max(expiry, self._current + 1)
+        for level in range(self._levels):
+            span = self._slots ** (level + 1)
+            if expiry // span == self._current // span:
+                slot = (expiry // self._slots ** level) % self._slots
+                self._wheels[level][slot][key] = expiry
+                self._where[key] = (level, slot)
+                return
+        self._overflow[key] = expiry
+        self._where[key] = (self._levels, 0)
+
+    def schedule(self, key: Hashable, deadline: float):
+        """
+        Sets the timer of a key, replacing its previous deadline.
+
+        :param key: identifies the timer, such as a game id
+        :param deadline: time at which the timer expires
+        :return: None
+        """
+        self.cancel(key)
+        self._place(key, math.ceil(deadline / self.tick))
+
+    def cancel(self, key: Hashable):
+        """
+        Removes the timer of a key, if any.
+
+        :return: None
+        """
+        where = self._where.pop(key, None)
+        if where is None:
+            return
+        level, slot = where
+        if level == self._levels:
+            del self._overflow[key]
+        else:
+            del self._wheels[level][slot][key]
+
+    def advance(self, now: float) -> List[Hashable]:
+        """
+        Moves the wheel up to the given time.
+
+        :param now: current time
+        :return: keys of the timers that expired, their timers are removed
+        """
+        expired = []
+        target = self._ticks(now)
+        while self._current < target:
+            self._current += 1
+            # at the start of a turn of a level, its next slot moves down a level
+            for level in range(1, self._levels + 1):
+                if self._current % self._slots ** level:
+                    break
+                if level == self._levels:
+                    pending, self._overflow = self._overflow, {}
+                else:
+                    slot = (self._current // self._slots ** level) % self._slots
+                    pending, self._wheels[level][slot] = self._wheels[level][slot], {}
+                for key, expiry in pending.items():
+                    if expiry == self._current:
+                        del self._where[key]
+                        expired.append(key)
+                    else:
+                        self._place(key, expiry)
+            slot = self._current % self._slots
+            if self._wheels[0][slot]:
+                due, self._wheels[0][slot] = self._wheels[0][slot], {}
+                for key in due:
+                    del self._where[key]
+                expired.extend(due)
+        return expired
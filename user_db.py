@@ -1,18 +1,116 @@
-from typing import Tuple, Dict
+from typing import Tuple, Dict, List, Optional, Callable, Any
+from collections import OrderedDict
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import binascii
+import hashlib
+import heapq
+import hmac
+import os
 import secrets
+import sqlite3
+import time
+import nacl.exceptions
 import nacl.pwhash
 
 
+class HashQueueFull(Exception):
+    """
+    Raised by the async UserDB methods when too many password hashes are
+    already waiting for the hashing pool.
+    """
+    pass
+
+
+def load_session_key(path: str) -> bytes:
+    """
+    Reads the session key kept in a file, creating it with a random key on
+    first use, so session tokens stay valid when the server restarts.
+
+    :raises: ValueError if the file holds less than 32 bytes
+    :param path: path of the key file, only readable by its owner once created
+    :return: the session key
+    """
+    if not os.path.exists(path):
+        # written aside and linked into place, so a process starting at the same time never reads a partial key
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as key_file:
+            key_file.write(secrets.token_bytes(32))
+        try:
+            os.link(temp_path, path)
+        except FileExistsError:
+            # the other process won, every process uses its key
+            pass
+        finally:
+            os.remove(temp_path)
+    with open(path, 'rb') as key_file:
+        session_key = key_file.read()
+    if len(session_key) < 32:
+        raise ValueError(f"session key file {path} is too short")
+    return session_key
+
+
 class UserDB(object):
-    def __init__(self):
-        self._accounts: Dict[str, bytes] = {}
+    """
+    Accounts are stored in an SQLite table keyed by username, so they survive
+    restarts and nothing is read at startup.  Each lookup is a primary key
+    search; the hashes of recently used accounts are kept in a bounded LRU
+    cache in self._accounts.  Revoked sessions are stored alongside until
+    their tokens would have expired, and are loaded at startup.
+    """
+    _SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS accounts (username TEXT PRIMARY KEY, password_hash BLOB NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS revocations (session_id TEXT PRIMARY KEY, expiry INTEGER NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS revocations_expiry ON revocations (expiry)",
+    )
+
+    def __init__(self, session_key: Optional[bytes] = None, session_ttl: int = 24 * 60 * 60,
+                 hash_workers: int = 4, max_pending_hashes: int = 64, db_path: str = ':memory:',
+                 cache_size: int = 100000):
+        """
+        :param session_key: key that signs session tokens, processes sharing a key accept each other's tokens
+        :param session_ttl: seconds a session token stays valid
+        :param hash_workers: threads hashing passwords for the async methods, libsodium releases the GIL
+        :param max_pending_hashes: hashes queued or running before the async methods raise HashQueueFull
+        :param db_path: path of the SQLite account database, the default keeps accounts in memory only
+        :param cache_size: number of account hashes kept in memory
+        """
+        # username -> password hash of recently used accounts, least recently used first
+        self._accounts: OrderedDict = OrderedDict()
+        self._cache_size = cache_size
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        for statement in self._SCHEMA:
+            self._conn.execute(statement)
+        self._conn.commit()
+        self._session_key = session_key if session_key is not None else secrets.token_bytes(32)
+        self._session_ttl = session_ttl
+        # revoked session id -> expiry, entries are dropped once the token would have expired anyway
+        self._revoked_sessions: Dict[str, int] = {}
+        # (expiry, session id) of the revoked sessions, the next to expire first
+        self._revocation_expiries: List[Tuple[int, str]] = []
+        with self._conn:
+            self._conn.execute("DELETE FROM revocations WHERE expiry < ?", (time.time(),))
+        for session_id, expiry in self._conn.execute("SELECT session_id, expiry FROM revocations"):
+            self._revoked_sessions[session_id] = expiry
+            self._revocation_expiries.append((expiry, session_id))
+        heapq.heapify(self._revocation_expiries)
+        # created on first use so processes that never hash do not start threads
+        self._hash_executor: Optional[ThreadPoolExecutor] = None
+        self._hash_workers = hash_workers
+        self._max_pending_hashes = max_pending_hashes
+        self._pending_hashes = 0
+        self._hash_counters = {'completed': 0, 'rejected': 0, 'wait_seconds': 0.0, 'hash_seconds': 0.0}
 
     def create_user(self, username: str) -> Tuple[str, str]:
         """
         Creates a user and returns a automatically-generated token (password)
         for the user.  You can generate this token using secrets.token_urlsafe()
 
-        Only the one-way hash is stored in self._accounts.
+        Only the one-way hash is stored in the accounts table.
 
         To make hashes, read: https://pynacl.readthedocs.io/en/latest/password_hashing/
         In particular, you want to use the nacl.pwhash.str() function.
@@ -24,16 +122,146 @@ class UserDB(object):
         :return: (username, password_token)
         """
 
-        if username in self._accounts.keys():
+        if self._lookup(username) is not None:
             raise ValueError("Username already exists")
 
         password_token = str.encode(secrets.token_urlsafe())
-        self._accounts[username] = nacl.pwhash.str(password_token)
+        self._insert(username, nacl.pwhash.str(password_token))
         password_token = bytes.decode(password_token)
 
         return username, password_token
         pass
 
+    def _lookup(self, username: str) -> Optional[bytes]:
+        """
+        Gets the password hash of an account, from the cache or the database.
+
+        :return: the hash or None if the account does not exist
+        """
+        password_hash = self._accounts.get(username, None)
+        if password_hash is not None:
+            self._accounts.move_to_end(username)
+            return password_hash
+        row = self._conn.execute("SELECT password_hash FROM accounts WHERE username = ?", (username,)).fetchone()
+        if row is None:
+            return None
+        self._cache(username, row[0])
+        return row[0]
+
+    def _cache(self, username: str, password_hash: bytes):
+        self._accounts[username] = password_hash
+        self._accounts.move_to_end(username)
+        if len(self._accounts) > self._cache_size:
+            self._accounts.popitem(last=False)
+
+    def _insert(self, username: str, password_hash: bytes, replace: bool = False):
+        """
+        Stores an account.
+
+        :raises: ValueError if the username already exists and replace is False
+        """
+        try:
+            with self._conn:
+                self._conn.execute(f"INSERT {'OR REPLACE ' if replace else ''}INTO accounts "
+                                   "(username, password_hash) VALUES (?, ?)", (username, password_hash))
+        except sqlite3.IntegrityError:
+            raise ValueError("Username already exists")
+        self._cache(username, password_hash)
+
+    async def _run_hash(self, function: Callable, *args) -> Any:
+        """
+        Runs a password hash function on the hashing pool without blocking the event loop.
+
+        :raises: HashQueueFull if max_pending_hashes hashes are already queued or running
+        :param function: nacl.pwhash.str or nacl.pwhash.verify
+        :return: the result of the function
+        """
+        if self._pending_hashes >= self._max_pending_hashes:
+            self._hash_counters['rejected'] += 1
+            raise HashQueueFull("Too many password hashes pending")
+        if self._hash_executor is None:
+            self._hash_executor = ThreadPoolExecutor(self._hash_workers, thread_name_prefix='pwhash')
+        self._pending_hashes += 1
+        submitted = time.perf_counter()
+        started = []
+
+        def timed():
+            started.append(time.perf_counter())
+            return function(*args)
+
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._hash_executor, timed)
+        finally:
+            self._pending_hashes -= 1
+            finished = time.perf_counter()
+            if started:
+                self._hash_counters['completed'] += 1
+                self._hash_counters['wait_seconds'] += started[0] - submitted
+                self._hash_counters['hash_seconds'] += finished - started[0]
+
+    async def create_user_async(self, username: str) -> Tuple[str, str]:
+        """
+        Same as create_user, but hashes the password on the hashing pool.
+
+        :raises: ValueError if the username already exists
+        :raises: HashQueueFull if the hashing pool is saturated
+        :param username: desired username
+        :return: (username, password_token)
+        """
+        if self._lookup(username) is not None:
+            raise ValueError("Username already exists")
+        password_token = secrets.token_urlsafe()
+        password_hash = await self._run_hash(nacl.pwhash.str, password_token.encode())
+        # another request may have taken the name while the hash was computed, the insert fails then
+        self._insert(username, password_hash)
+        return username, password_token
+
+    def hash_stats(self) -> Dict[str, float]:
+        """
+        Gets the counters of the hashing pool
+
+        :return: dict of workers, pending, max_pending, completed, rejected and the
+            average seconds a hash waited in the queue and ran
+        """
+        completed = self._hash_counters['completed']
+        return {'workers': self._hash_workers, 'pending': self._pending_hashes,
+                'max_pending': self._max_pending_hashes, 'completed': completed,
+                'rejected': self._hash_counters['rejected'],
+                'average_wait_seconds': self._hash_counters['wait_seconds'] / completed if completed else 0.0,
+                'average_hash_seconds': self._hash_counters['hash_seconds'] / completed if completed else 0.0}
+
+    def close(self):
+        """
+        Stops the hashing pool threads and closes the account database.
+        """
+        if self._hash_executor is not None:
+            self._hash_executor.shutdown(wait=False)
+            self._hash_executor = None
+        self._conn.close()
+
+    def password_hash(self, username: str) -> bytes:
+        """
+        Gets the stored password hash of a user, used to copy accounts to other processes.
+
+        :raises: KeyError if the username does not exist
+        :param username:
+        :return: the nacl.pwhash.str hash
+        """
+        password_hash = self._lookup(username)
+        if password_hash is None:
+            raise KeyError(username)
+        return password_hash
+
+    def add_hashed_user(self, username: str, password_hash: bytes):
+        """
+        Stores an account whose password was hashed elsewhere (see password_hash).
+
+        :param username:
+        :param password_hash: the nacl.pwhash.str hash
+        :return: None
+        """
+        self._insert(username, password_hash, replace=True)
+
     def is_valid(self, username: str, password) -> bool:
         """
         Check whether the given username and password match a user
@@ -49,8 +277,138 @@ class UserDB(object):
         password_bytes = str.encode(password)
 
         try:
-            if username in self._accounts.keys() and nacl.pwhash.verify(self._accounts[username], password_bytes):
+            password_hash = self._lookup(username)
+            if password_hash is not None and nacl.pwhash.verify(password_hash, password_bytes):
                 return True
         except:
             return False
         pass
+
+    async def is_valid_async(self, username: str, password: str) -> bool:
+        """
+        Same as is_valid, but verifies the hash on the hashing pool.
+
+        :raises: HashQueueFull if the hashing pool is saturated
+        :param username:
+        :param password:
+        :return: True if the credentials are valid, False if not.
+        """
+        password_hash = self._lookup(username)
+        if password_hash is None:
+            return False
+        try:
+            return await self._run_hash(nacl.pwhash.verify, password_hash, password.encode())
+        except nacl.exceptions.InvalidkeyError:
+            return False
+
+    def _sign(self, session_id: str, expiry: int, username: str) -> bytes:
+        message = f'{session_id}.{expiry}.{username}'.encode()
+        return hmac.new(self._session_key, message, hashlib.sha256).digest()
+
+    def create_session(self, username: str, password: str) -> Optional[Tuple[str, int]]:
+        """
+        Verifies the password once and issues a signed session token, so later
+        requests can be authenticated with check_session instead of a password hash.
+
+        Token format: session_id.expiry.base64(username).base64(HMAC-SHA256)
+
+        :param username:
+        :param password:
+        :return: (token, expiry as a unix timestamp), or None if the credentials are invalid
+        """
+        if not self.is_valid(username, password):
+            return None
+        return self.issue_session(username)
+
+    def issue_session(self, username: str) -> Tuple[str, int]:
+        """
+        Issues a session token for a user who was already authenticated.
+
+        :param username:
+        :return: (token, expiry as a unix timestamp)
+        """
+        session_id = secrets.token_urlsafe(12)
+        expiry = int(time.time()) + self._session_ttl
+        signature = self._sign(session_id, expiry, username)
+        token = '.'.join([session_id, str(expiry), urlsafe_b64encode(username.encode()).decode(),
+                          urlsafe_b64encode(signature).decode()])
+        return token, expiry
+
+    async def create_session_async(self, username: str, password: str) -> Optional[Tuple[str, int]]:
+        """
+        Same as create_session, but verifies the password on the hashing pool.
+
+        :raises: HashQueueFull if the hashing pool is saturated
+        :param username:
+        :param password:
+        :return: (token, expiry as a unix timestamp), or None if the credentials are invalid
+        """
+        if not await self.is_valid_async(username, password):
+            return None
+        return self.issue_session(username)
+
+    def _parse_session(self, token: str) -> Optional[Tuple[str, int, str]]:
+        """
+        Checks the signature and expiry of a token.
+
+        :return: (session_id, expiry, username), or None if the token is forged, malformed or expired
+        """
+        try:
+            session_id, expiry, username, signature = token.split('.')
+            expiry = int(expiry)
+            username = urlsafe_b64decode(username.encode()).decode()
+            signature = urlsafe_b64decode(signature.encode())
+        except (ValueError, binascii.Error, UnicodeDecodeError):
+            return None
+        if not hmac.compare_digest(signature, self._sign(session_id, expiry, username)):
+            return None
+        if expiry < time.time():
+            return None
+        return session_id, expiry, username
+
+    def check_session(self, token: str) -> Optional[str]:
+        """
+        Validates a session token issued by create_session.
+
+        :param token:
+        :return: the username, or None if the token is invalid, expired or revoked
+        """
+        session = self._parse_session(token)
+        if session is None or session[0] in self._revoked_sessions:
+            return None
+        return session[2]
+
+    def revoke_session(self, token: str) -> bool:
+        """
+        Revokes a session token before it expires.
+
+        :param token:
+        :return: True if the token was valid and is now revoked, False if it was invalid or already revoked
+        """
+        session = self._parse_session(token)
+        if session is None or session[0] in self._revoked_sessions:
+            return False
+        session_id, expiry, username = session
+        self._prune_revocations()
+        with self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO revocations (session_id, expiry) VALUES (?, ?)",
+                               (session_id, expiry))
+        self._revoked_sessions[session_id] = expiry
+        heapq.heappush(self._revocation_expiries, (expiry, session_id))
+        return True
+
+    def _prune_revocations(self):
+        """
+        Forgets the revoked sessions whose tokens have expired since, which check_session refuses anyway.
+
+        :return: None
+        """
+        now = time.time()
+        pruned = False
+        while self._revocation_expiries and self._revocation_expiries[0][0] < now:
+            expiry, session_id = heapq.heappop(self._revocation_expiries)
+            del self._revoked_sessions[session_id]
+            pruned = True
+        if pruned:
+            with self._conn:
+                self._conn.execute("DELETE FROM revocations WHERE expiry < ?", (now,))
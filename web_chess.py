@@ -1,17 +1,175 @@
+import asyncio
+import json
+import os
+from contextlib import asynccontextmanager
+from datetime import date
 import uvicorn
-from typing import Optional
-from fastapi import FastAPI, HTTPException, Path, status, Query, Depends
-from chess_db import AsyncChessGameDB, ChessGame
-from user_db import UserDB
-from fastapi.security import HTTPBasic, HTTPBasicCredentials
-
-USER_DB = UserDB()
-CHESS_DB = AsyncChessGameDB(USER_DB)
+from typing import Optional, List, Dict
+from pydantic import BaseModel, Field
+from fastapi import FastAPI, HTTPException, Path, status, Query, Depends, Body, Request, Response, Header, \
+    WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, StreamingResponse
+from chess_db import AsyncChessGameDB, ChessGame, round_robin_pairings
+from user_db import UserDB, HashQueueFull, load_session_key
+from shared_game_store import SharedGameStore
+from game_broadcast import etag_matches
+from matchmaking import MatchmakingQueue, MatchRequest, match_response
+from ratings import RatingService
+from game_export import EXPORT_MEDIA_TYPES, export_chunks, export_range
+from fastapi.security import HTTPBasic, HTTPBasicCredentials, HTTPBearer, HTTPAuthorizationCredentials
+
+# set by sharded_chess.py when this process serves one shard of the games
+SHARD_INDEX = int(os.environ.get('CHESS_SHARD_INDEX', 0))
+NUM_SHARDS = int(os.environ.get('CHESS_SHARD_COUNT', 1))
+
+# key signing session tokens: CHESS_SESSION_KEY (hex), which sharded_chess.py shares with every process,
+# or else the key file, created on first start, so tokens survive restarts
+SESSION_KEY_FILE = os.environ.get('CHESS_SESSION_KEY_FILE', 'chess_session.key')
+SESSION_KEY: Optional[bytes] = None
+
+# idle games are hibernated to their encoded form after an hour, or sooner beyond this many decoded games
+MAX_RESIDENT_GAMES = int(os.environ.get('CHESS_MAX_RESIDENT_GAMES', 100000))
+IDLE_TIMEOUT = float(os.environ.get('CHESS_IDLE_TIMEOUT', 3600))
+
+# opened by the lifespan handler, so importing this module creates no files and holds no locks
+USER_DB: Optional[UserDB] = None
+CHESS_DB: Optional[AsyncChessGameDB] = None
+# shared memory game store created by sharded_chess.py, if any (named by CHESS_SHARED_STORE)
+SHARED_STORE: Optional[SharedGameStore] = None
+# in sharded mode the router rates the finished games of every shard (see /internal/results)
+RATINGS: Optional[RatingService] = None
+# seconds between two passes of the rating updates over the newly finished games
+RATING_INTERVAL = 1.0
+
+
+async def create_matched_game(white: str, black: str, time_control: Optional[tuple]) -> tuple:
+    # game and players are created in one step, the game is never seen without its players
+    (game_id, term_pass), = await CHESS_DB.add_games(white, [[white, black]], time_control)
+    return game_id, term_pass
+
+
+# largest number of moves accepted by /moves/batch and of games created by /game/create_games
+MAX_BATCH_MOVES = 1000
+MAX_BATCH_GAMES = 1000
+# largest number of replies a player may queue on one game through /game/{game_id}/premoves
+MAX_PREMOVES = 256
+# in sharded mode the router runs the queue instead, see sharded_chess.py
+MATCHMAKING = MatchmakingQueue(create_matched_game)
+_background_tasks: List[asyncio.Task] = []
+
+
+def open_databases():
+    """
+    Opens the databases of this process in the working directory.
+    """
+    global SESSION_KEY, USER_DB, CHESS_DB, SHARED_STORE, RATINGS
+    if 'CHESS_SESSION_KEY' in os.environ:
+        SESSION_KEY = bytes.fromhex(os.environ['CHESS_SESSION_KEY'])
+    else:
+        SESSION_KEY = load_session_key(SESSION_KEY_FILE)
+    if 'CHESS_SHARED_STORE' in os.environ:
+        SHARED_STORE = SharedGameStore(os.environ['CHESS_SHARED_STORE'])
+    if NUM_SHARDS > 1:
+        # accounts are copied to every shard by the router (see /internal/user)
+        USER_DB = UserDB(SESSION_KEY, db_path=f'chess_users-{SHARD_INDEX}.sqlite3')
+        CHESS_DB = AsyncChessGameDB(USER_DB, f'chess_games-{SHARD_INDEX}.sqlite3', f'chess_log-{SHARD_INDEX}',
+                                    shard_index=SHARD_INDEX, num_shards=NUM_SHARDS, shared_store=SHARED_STORE,
+                                    max_resident_games=MAX_RESIDENT_GAMES, idle_timeout=IDLE_TIMEOUT)
+    else:
+        # a single process owns every game; uvicorn --workers is not supported, the second worker cannot
+        # open the game database (see AsyncChessGameDB), run several processes with sharded_chess.py instead
+        USER_DB = UserDB(SESSION_KEY, db_path='chess_users.sqlite3')
+        CHESS_DB = AsyncChessGameDB(USER_DB, shared_store=SHARED_STORE, max_resident_games=MAX_RESIDENT_GAMES,
+                                    idle_timeout=IDLE_TIMEOUT)
+        RATINGS = RatingService('chess_ratings.sqlite3')
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    open_databases()
+    # the clocks and the rating updates need the running event loop
+    CHESS_DB.start_clocks()
+    if RATINGS is not None:
+        _background_tasks.append(asyncio.create_task(sync_ratings()))
+    yield
+    for task in _background_tasks:
+        task.cancel()
+    await CHESS_DB.close()
+    USER_DB.close()
+    if RATINGS is not None:
+        RATINGS.close()
+    if SHARED_STORE is not None:
+        SHARED_STORE.close()
+
+
 app = FastAPI(
     title="Chess Server",
-    description="Implementation of a simultaneous multi-game Chess server by Alejandro Martinez."
+    description="Implementation of a simultaneous multi-game Chess server by Alejandro Martinez.",
+    lifespan=lifespan
 )
-security = HTTPBasic()
+security = HTTPBasic(auto_error=False)
+bearer = HTTPBearer(auto_error=False)
+
+
+async def authenticate(credentials: Optional[HTTPBasicCredentials] = Depends(security),
+                       token: Optional[HTTPAuthorizationCredentials] = Depends(bearer)) -> str:
+    """
+    Authenticate the request, otherwise raise a 401.  Session tokens from
+    /user/login only need an HMAC check; HTTP Basic credentials still work but
+    pay for a full password hash verification on every request, run on the
+    UserDB hashing pool so the event loop keeps serving other games.
+
+    :return: the username of the authenticated user
+    """
+    if token is not None:
+        username = USER_DB.check_session(token.credentials)
+        if username is not None:
+            return username
+    elif credentials is not None and await USER_DB.is_valid_async(credentials.username, credentials.password):
+        return credentials.username
+    raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid credentials",
+                        headers={'WWW-Authenticate': 'Basic'})
+
+
+class BatchMove(BaseModel):
+    game_id: str
+    move: str
+
+
+class GameBatch(BaseModel):
+    # either explicit pairings, players of each game in player index order...
+    games: Optional[List[List[str]]] = None
+    # ...or the entrants of a round-robin tournament and the zero-indexed round to pair
+    players: Optional[List[str]] = None
+    round: int = 0
+    # time control of every game in seconds, untimed without a base
+    base: Optional[float] = Field(None, gt=0)
+    increment: float = Field(0.0, ge=0)
+
+
+class ConditionalMove(BaseModel):
+    # the player's answer, then the answers to the opponent's following move, keyed like the tree itself
+    reply: str
+    then: Dict[str, 'ConditionalMove'] = {}
+
+    def size(self) -> int:
+        return 1 + sum(branch.size() for branch in self.then.values())
+
+
+def websocket_user(websocket: WebSocket) -> Optional[str]:
+    """
+    Authenticates a WebSocket handshake with a session token from /user/login,
+    sent as a Bearer Authorization header or, for browsers that cannot set
+    headers on a WebSocket, as the token query parameter.
+
+    :return: the username, or None if the token is missing or invalid
+    """
+    authorization = websocket.headers.get('authorization', '')
+    if authorization.lower().startswith('bearer '):
+        token = authorization[len('bearer '):]
+    else:
+        token = websocket.query_params.get('token', None)
+    return USER_DB.check_session(token) if token else None
 
 
 async def get_game(game_id: str) -> ChessGame:
@@ -26,6 +184,24 @@ async def get_game(game_id: str) -> ChessGame:
     return the_game
 
 
+@app.exception_handler(HashQueueFull)
+async def hash_queue_full(request: Request, exc: HashQueueFull):
+    # shed auth load instead of queueing hashes without limit
+    return JSONResponse({'detail': str(exc)}, status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                        headers={'Retry-After': '1'})
+
+
+async def sync_ratings():
+    """
+    Rates the games that finished since the last pass, in the order they finished.
+    """
+    while True:
+        results = await CHESS_DB.results_after(RATINGS.cursor('games'))
+        RATINGS.apply_results('games', results)
+        if len(results) < 1000:
+            await asyncio.sleep(RATING_INTERVAL)
+
+
 @app.get('/')
 async def home():
     return {"message": "Welcome to Chess!"}
@@ -33,21 +209,154 @@ async def home():
 
 @app.post('/user/create', status_code=status.HTTP_201_CREATED)
 async def create_user(username: str):
-    the_username, the_password = USER_DB.create_user(username)
+    the_username, the_password = await USER_DB.create_user_async(username)
     return {'success': True, 'username': the_username, 'password': the_password}
 
 
+@app.post('/user/login')
+async def login(credentials: HTTPBasicCredentials = Depends(HTTPBasic())):
+    session = await USER_DB.create_session_async(credentials.username, credentials.password)
+    if session is None:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid credentials")
+    token, expiry = session
+    return {'success': True, 'username': credentials.username, 'token': token, 'expires': expiry}
+
+
+@app.get('/metrics/auth')
+async def auth_metrics():
+    return USER_DB.hash_stats()
+
+
+@app.post('/user/logout')
+async def logout(token: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
+    if not USER_DB.revoke_session(token.credentials):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid session token")
+    return {'success': True}
+
+
+if NUM_SHARDS > 1:
+    # only reachable through the shard's local socket, the router never forwards /internal
+    @app.put('/internal/user/{username}', include_in_schema=False)
+    async def replicate_user(username: str, password_hash: str = Body(..., embed=True)):
+        USER_DB.add_hashed_user(username, password_hash.encode())
+        return {'success': True}
+
+    @app.post('/internal/revoke', include_in_schema=False)
+    async def replicate_revoke(token: str = Body(..., embed=True)):
+        return {'success': USER_DB.revoke_session(token)}
+
+    @app.get('/internal/results', include_in_schema=False)
+    async def finished_games(after: int = 0, limit: int = Query(1000, ge=1, le=1000)):
+        return {'results': await CHESS_DB.results_after(after, limit)}
+else:
+    @app.get('/leaderboard')
+    async def leaderboard(limit: int = Query(50, ge=1, le=200), offset: int = Query(0, ge=0)):
+        return {'players': RATINGS.page(limit, offset), 'total': len(RATINGS.leaderboard)}
+
+    @app.get('/user/{username}/rating')
+    async def user_rating(username: str):
+        return RATINGS.standing(username)
+
+
+@app.post('/matchmaking/join')
+async def join_matchmaking(match_request: MatchRequest,
+                           wait: float = Query(30.0, ge=0, le=60, description='seconds to wait for an opponent'),
+                           username: str = Depends(authenticate)):
+    """
+    Queues the authenticated user for a game against a player of a close rating
+    with the same time control, using the ratings kept by the server.  Answers
+    with the game once paired, or with a 202 after wait seconds; the ticket
+    stays queued, poll GET /matchmaking.
+    """
+    if RATINGS is None:
+        # shards keep no ratings, the router runs the matchmaking of a sharded deployment
+        raise HTTPException(status.HTTP_404_NOT_FOUND, detail="Matchmaking is served by the router")
+    ticket = await MATCHMAKING.join(username, RATINGS.rating(username), match_request.time_control())
+    return await match_response(MATCHMAKING, ticket, wait)
+
+
+@app.get('/matchmaking')
+async def poll_matchmaking(wait: float = Query(30.0, ge=0, le=60, description='seconds to wait for an opponent'),
+                           username: str = Depends(authenticate)):
+    ticket = MATCHMAKING.ticket(username)
+    if ticket is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, detail=f"{username} is not in the matchmaking queue")
+    return await match_response(MATCHMAKING, ticket, wait)
+
+
+@app.delete('/matchmaking')
+async def leave_matchmaking(username: str = Depends(authenticate)):
+    if not MATCHMAKING.leave(username):
+        raise HTTPException(status.HTTP_404_NOT_FOUND, detail=f"{username} is not in the matchmaking queue")
+    return {'success': True}
+
+
+@app.get('/metrics/matchmaking')
+async def matchmaking_metrics():
+    return MATCHMAKING.stats()
+
+
+@app.get('/games')
+async def list_games(owner: Optional[str] = Query(None, description='only games owned by this user'),
+                     player: Optional[str] = Query(None, description='only games this user plays in'),
+                     cursor: Optional[int] = Query(None, description='next_cursor of the previous page'),
+                     limit: int = Query(50, ge=1, le=200)):
+    games, next_cursor = await CHESS_DB.page_games(owner, player, cursor, limit)
+    return {'games': [{'game_id': game_id, 'owner': info.owner, 'players': info.players} for game_id, info in games],
+            'next_cursor': next_cursor}
+
+
+@app.get('/games/export')
+async def export_games(export_format: str = Query('pgn', alias='format', pattern='^(pgn|ndjson)$'),
+                       player: Optional[str] = Query(None, description='only games this user played'),
+                       since: Optional[date] = Query(None, description='only games finished on or after this day'),
+                       until: Optional[date] = Query(None, description='only games finished on or before this day')):
+    """
+    Streams the finished games as PGN or newline-delimited JSON, read from
+    the results table in batches while the response is being sent.
+    """
+    games = CHESS_DB.export_results(player, *export_range(since, until))
+    return StreamingResponse(export_chunks(games, export_format), media_type=EXPORT_MEDIA_TYPES[export_format],
+                             headers={'Content-Disposition': f'attachment; filename="games.{export_format}"'})
+
+
 @app.get('/game/create_game', status_code=status.HTTP_201_CREATED)
-async def create_game(credentials: HTTPBasicCredentials = Depends(security)):
-    new_uuid, new_term_pass, owner_username = await CHESS_DB.add_game(owner=credentials.username)
-    CHESS_DB._current_games_info[new_uuid].players.append(owner_username)
+async def create_game(base: Optional[float] = Query(None, gt=0, description='seconds on each clock, untimed without'),
+                      increment: float = Query(0.0, ge=0, description='seconds added after each move'),
+                      username: str = Depends(authenticate)):
+    time_control = (base, increment) if base is not None else None
+    new_uuid, new_term_pass, owner_username = await CHESS_DB.add_game(owner=username, time_control=time_control)
+    await CHESS_DB.add_player(new_uuid, owner_username)
     return {'success': True, 'game_id': new_uuid, 'termination_password': new_term_pass, 'game_owner': owner_username}
 
 
+@app.post('/game/create_games', status_code=status.HTTP_201_CREATED)
+async def create_games(batch: GameBatch, username: str = Depends(authenticate)):
+    """
+    Creates many games owned by the authenticated user with their players
+    already added, such as a whole tournament round, in one request.
+    """
+    bye = None
+    if batch.games is not None:
+        pairings = batch.games
+    elif batch.players is not None:
+        pairings, bye = round_robin_pairings(batch.players, batch.round)
+    else:
+        raise HTTPException(status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Expected games or players")
+    if len(pairings) > MAX_BATCH_GAMES:
+        raise HTTPException(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                            detail=f"At most {MAX_BATCH_GAMES} games per batch")
+    time_control = (batch.base, batch.increment) if batch.base is not None else None
+    games = await CHESS_DB.add_games(username, pairings, time_control)
+    return {'success': True, 'game_owner': username, 'bye': bye,
+            'games': [{'game_id': game_id, 'termination_password': term_pass, 'players': players}
+                      for (game_id, term_pass), players in zip(games, pairings)]}
+
+
 @app.post('/game/{game_id}/add_player')
-async def add_player_to_game(game_id: str, username: str, credentials: HTTPBasicCredentials = Depends(security)):
+async def add_player_to_game(game_id: str, username: str, requester: str = Depends(authenticate)):
     owner, players = await CHESS_DB.game_info(game_id)
-    if owner == credentials.username:
+    if owner == requester:
         player_idx = await CHESS_DB.add_player(game_id, username)
     else:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Must be Owner to Execute Function")
@@ -55,20 +364,17 @@ async def add_player_to_game(game_id: str, username: str, credentials: HTTPBasic
 
 
 @app.get('/game/{game_id}/get_player_idx')
-async def get_player_idx(game_id: str, username: str, credentials: HTTPBasicCredentials = Depends(security)):
-    owner, players = CHESS_DB.game_info(game_id)
-    if USER_DB.is_valid(credentials.username, credentials.password) is True:
-        player_idx = players.index(username)
-    else:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Must be Owner to Execute Function")
-    return {'success': True, 'game_id': game_id, 'player_username': credentials.username, 'player_idx': player_idx}
+async def get_player_idx(game_id: str, username: str, requester: str = Depends(authenticate)):
+    owner, players = await CHESS_DB.game_info(game_id)
+    player_idx = players.index(username)
+    return {'success': True, 'game_id': game_id, 'player_username': requester, 'player_idx': player_idx}
 
 
 @app.post('/game/{game_id}/initialize')
 async def init_game(game_id: str = Path(..., description='the unique game id'),
-                    credentials: HTTPBasicCredentials = Depends(security)):
+                    username: str = Depends(authenticate)):
     owner, players = await CHESS_DB.game_info(game_id)
-    if credentials.username == owner:
+    if username == owner:
         the_game = await get_game(game_id)
         the_game.board.print_board()
     else:
@@ -76,32 +382,200 @@ async def init_game(game_id: str = Path(..., description='the unique game id'),
     return {'success': True}
 
 
-@app.post('/game/{game_id}/player/{player_idx}/{player_move}}', status_code=status.HTTP_401_UNAUTHORIZED)
+@app.post('/game/{game_id}/player/{player_idx}/{player_move}')
 async def player_move(game_id: str = Path(..., description='the unique game id'),
                       player_idx: int = Path(..., description='the player index (zero-indexed)'),
                       player_move: str = Path(..., description='the players move'),
-                      credentials: HTTPBasicCredentials = Depends(security)):
+                      username: str = Depends(authenticate)):
     owner, players = await CHESS_DB.game_info(game_id)
-    request_idx = players.index(credentials.username)
-    if USER_DB.is_valid(credentials.username, credentials.password):
-        if player_idx == request_idx:
-            the_game = await get_game(game_id)
-            if the_game.get_move(player_idx, player_move):
-                the_game.execute_move(player_idx)
-                current_move = the_game.move(player_idx)
-            else:
-                raise HTTPException(status.HTTP_401_UNAUTHORIZED)
-        else:
+    # a user may hold both seats, so the requested seat is checked rather than the user's first one
+    if 0 <= player_idx < len(players) and players[player_idx] == username:
+        try:
+            played = await CHESS_DB.make_move(game_id, player_idx, player_move)
+        except KeyError:
+            # deleted while the move was queued
+            raise HTTPException(status.HTTP_404_NOT_FOUND, detail=f"Game {game_id} not found.")
+        if not played:
             raise HTTPException(status.HTTP_401_UNAUTHORIZED)
+        # fetched after the move, an idle game may have been hibernated and rehydrated meanwhile
+        the_game = await get_game(game_id)
     else:
         raise HTTPException(status.HTTP_401_UNAUTHORIZED)
     return {'player': player_idx,
-            'current_move': str(current_move),
-            'player_stack': the_game.move.current_move()}
+            'current_move': player_move,
+            'winner': the_game.who_won()}
+
+
+@app.websocket('/game/{game_id}/ws')
+async def game_channel(websocket: WebSocket, game_id: str):
+    """
+    Game channel: the client sends {"move": "e2e4"} to play as the
+    authenticated user.  It receives a snapshot of the position, then every
+    move of the game as it is accepted ({"type": "move", ...} with the changed
+    squares), then {"type": "game_over", ...} and {"type": "terminated", ...}
+    events.  Rejected moves are answered with {"type": "error", ...} to the
+    sender only.  Anyone logged in can follow a game, only its players can move.
+    """
+    username = websocket_user(websocket)
+    if username is None:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Invalid credentials")
+        return
+    try:
+        events = CHESS_DB.subscribe(game_id)
+    except KeyError:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason=f"Game {game_id} not found.")
+        return
+    await websocket.accept()
+
+    async def receive_moves():
+        # errors go through the subscription so only one task ever sends on the socket
+        try:
+            while True:
+                try:
+                    player_move = json.loads(await websocket.receive_text())['move']
+                except (ValueError, KeyError, TypeError):
+                    events.send({'type': 'error', 'detail': 'Expected {"move": "<move>"}'})
+                    continue
+                result, = await CHESS_DB.make_moves(username, [(game_id, player_move)])
+                if result == 'not_player':
+                    events.send({'type': 'error', 'move': player_move, 'detail': 'Not a player of this game'})
+                elif result != 'played':
+                    events.send({'type': 'error', 'move': player_move, 'detail': 'Invalid move'})
+        except WebSocketDisconnect:
+            pass
+
+    async def send_events():
+        while True:
+            message = await events.get()
+            if message is None:
+                await websocket.close()
+                return
+            await websocket.send_text(message)
+
+    tasks = [asyncio.create_task(receive_moves()), asyncio.create_task(send_events())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        CHESS_DB.unsubscribe(game_id, events)
+
+
+@app.get('/game/{game_id}/events')
+async def game_events(game_id: str = Path(..., description='the unique game id')):
+    """
+    Server-sent events stream of a game for spectators, with the same events as the game channel.
+    """
+    try:
+        events = CHESS_DB.subscribe(game_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Game {game_id} not found.")
+
+    async def stream():
+        try:
+            while True:
+                message = await events.get()
+                if message is None:
+                    return
+                yield f'data: {message}\n\n'
+        finally:
+            CHESS_DB.unsubscribe(game_id, events)
+
+    return StreamingResponse(stream(), media_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+
+@app.get('/game/{game_id}/state')
+async def get_state(game_id: str = Path(..., description='the unique game id'),
+                    if_none_match: Optional[str] = Header(None)):
+    try:
+        etag, document = await CHESS_DB.game_state(game_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Game {game_id} not found.")
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+    return Response(document, media_type='application/json', headers={'ETag': etag, 'Cache-Control': 'no-cache'})
+
+
+@app.post('/moves/batch')
+async def batch_moves(moves: List[BatchMove], username: str = Depends(authenticate)):
+    """
+    Plays many moves of the authenticated user in one request, such as one
+    move on each board of a simul.  Moves on different games run in parallel.
+    """
+    if len(moves) > MAX_BATCH_MOVES:
+        raise HTTPException(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                            detail=f"At most {MAX_BATCH_MOVES} moves per batch")
+    results = await CHESS_DB.make_moves(username, [(move.game_id, move.move) for move in moves])
+    return {'results': [{'game_id': move.game_id, 'move': move.move, 'success': result == 'played',
+                         'result': result} for move, result in zip(moves, results)]}
+
+
+@app.put('/game/{game_id}/premoves')
+async def set_premoves(premoves: Dict[str, ConditionalMove],
+                       game_id: str = Path(..., description='the unique game id'),
+                       username: str = Depends(authenticate)):
+    """
+    Queues the authenticated player's replies to the opponent's next moves, as a
+    tree keyed by the opponent's move in simple chess notation or '*' for any
+    move.  The matching reply is played as soon as the opponent moves; an empty
+    tree clears the queue.
+    """
+    if sum(branch.size() for branch in premoves.values()) > MAX_PREMOVES:
+        raise HTTPException(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                            detail=f"At most {MAX_PREMOVES} queued moves per game")
+    tree = {move: branch.model_dump() for move, branch in premoves.items()}
+    # a user holding both seats queues replies for the side waiting for its opponent
+    result = await CHESS_DB.set_user_premoves(username, game_id, tree)
+    if result == 'not_found':
+        raise HTTPException(status.HTTP_404_NOT_FOUND, detail=f"Game {game_id} not found.")
+    if result == 'not_player':
+        raise HTTPException(status.HTTP_401_UNAUTHORIZED)
+    if result != 'queued':
+        raise HTTPException(status.HTTP_409_CONFLICT, detail="Game is over or it is already your turn")
+    return {'success': True, 'game_id': game_id, 'premoves': tree}
+
+
+@app.get('/game/{game_id}/premoves')
+async def get_premoves(game_id: str = Path(..., description='the unique game id'),
+                       username: str = Depends(authenticate)):
+    try:
+        premoves = await CHESS_DB.get_user_premoves(username, game_id)
+    except KeyError:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, detail=f"Game {game_id} not found.")
+    if premoves is None:
+        raise HTTPException(status.HTTP_401_UNAUTHORIZED)
+    return {'game_id': game_id, 'premoves': premoves}
+
+
+@app.get('/game/{game_id}/clock')
+async def get_clock(game_id: str = Path(..., description='the unique game id')):
+    try:
+        clock = await CHESS_DB.clock_state(game_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Game {game_id} not found.")
+    return {'game_id': game_id, 'clock': clock}
+
+
+@app.get('/game/{game_id}/legal_moves')
+async def get_legal_moves(game_id: str = Path(..., description='the unique game id')):
+    the_game = await get_game(game_id)
+    is_white = the_game.players[the_game.current_turn % 2].is_white
+    moves = the_game.move.legal_moves(the_game.board, is_white)
+    return {'game_id': game_id,
+            'legal_moves': [the_game.move.format_move(move) for move in moves]}
 
 
 @app.get('/game/{game_id}/winners')
 async def get_winners(game_id: str = Path(..., description='the unique game id')):
+    if SHARED_STORE is not None:
+        # any worker can answer from shared memory, even for games owned by another process
+        try:
+            state = SHARED_STORE.read(game_id)
+        except ValueError:
+            raise HTTPException(status_code=404, detail=f"Game {game_id} not found.")
+        if state is not None:
+            return {'game_id': game_id,
+                    'winner': state.who_won()}
     the_game = await get_game(game_id)
     winner = the_game.who_won()
     return {'game_id': game_id,
@@ -111,15 +585,12 @@ async def get_winners(game_id: str = Path(..., description='the unique game id')
 @app.post('/game/{game_id}/terminate')
 async def delete_game(game_id: str = Path(..., description='the unique game id'),
                       password: str = Query(..., description='the termination password'),
-                      credentials: HTTPBasicCredentials = Depends(security)):
+                      username: str = Depends(authenticate)):
     owner, players = await CHESS_DB.game_info(game_id)
-    if USER_DB.is_valid(credentials.username, credentials.password):
-        if owner == credentials.username:
-            the_game = await CHESS_DB.del_game(game_id, password, credentials.username)
-            if the_game is False:
-                raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Game not found.")
-        else:
-            raise HTTPException(status.HTTP_401_UNAUTHORIZED)
+    if owner == username:
+        the_game = await CHESS_DB.del_game(game_id, password, username)
+        if the_game is False:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Game not found.")
     else:
         raise HTTPException(status.HTTP_401_UNAUTHORIZED)
     return {'success': True, 'deleted_id': game_id}
@@ -128,5 +599,5 @@ async def delete_game(game_id: str = Path(..., description='the unique game id')
 if __name__ == '__main__':
     # running from main instead of terminal allows for debugger
     # TODO: modify the below to add HTTPS (SSL/TLS) support
-    uvicorn.run('web_chess:app', port=8000, log_level='info', reload=True, ssl_keyfile='./keys/private.pem',
+    uvicorn.run(app, port=8000, log_level='info', ssl_keyfile='./keys/private.pem',
                 ssl_certfile='./keys/public.pem')